@@ -1,7 +1,10 @@
 from collections import defaultdict
 import datetime as dt
 import logging
+import re
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytz
 import requests
@@ -67,3 +70,114 @@ def get_ohlcv(key_file: str, api_path: str, tz, search_params: dict = {}) -> pd.
         raise Exception(f"Error on [{url}]: {resp.status_code}|{resp.text}")
     return to_df(resp.json(), local_tz=tz)
 
+
+##
+# Local bar store, as written by `brokerplatform.barstore.BarStore` (IB bars via
+# `HistoricalDataCollector.store_as()`/`Backfill(store=...)`). Read straight
+# from the files, so divdetect doesn't depend on the tws-ibapi project:
+#
+#   <root>/<source>/<symbol>/<bar_size>/<YYYY-MM>.npy  structured arrays sorted by `time`
+#   <root>/<source>/<symbol>/<bar_size>/columns.current  names the consolidated columns directory
+#
+# `time` is the bar's start in nanoseconds since the epoch (UTC).
+##
+
+BAR_COLUMNS = ['time', 'open', 'high', 'low', 'close', 'volume']
+
+
+def _series_dir(root: str, source: str, symbol: str, bar_size: str) -> Path:
+    return Path(root).joinpath(*(re.sub(r'[^A-Za-z0-9_.-]+', '_', p) for p in (source, symbol, bar_size)))
+
+
+def _time_ns(t) -> int | None:
+    if t is None:
+        return None
+    t = pd.Timestamp(t)
+    if t.tz is not None:
+        t = t.tz_convert('UTC').tz_localize(None)
+    return t.as_unit('ns').value
+
+
+def read_bars(root: str, source: str, symbol: str, bar_size: str, start=None, end=None, tz=None) -> pd.DataFrame:
+    '''
+    Stored bars in `[start, end)`, in the same layout as `get_ohlcv`. Naive
+    `start`/`end` are taken to be in UTC, e.g.
+    `read_bars('../tmp/bars', 'ib', 'MCL-CONTFUT-NYMEX-MIDPOINT', '2 mins', tz=LOCAL_TZ)`.
+    '''
+    t0, t1 = _time_ns(start), _time_ns(end)
+    m0 = None if t0 is None else str(np.datetime64(t0, 'ns').astype('datetime64[M]'))
+    m1 = None if t1 is None else str(np.datetime64(t1, 'ns').astype('datetime64[M]'))
+    chunks = []
+    for path in sorted(_series_dir(root, source, symbol, bar_size).glob('????-??.npy')):
+        if (m0 is not None and path.stem < m0) or (m1 is not None and path.stem > m1):
+            continue
+        part = np.load(path, mmap_mode='r')
+        lo = 0 if t0 is None else np.searchsorted(part['time'], t0, side='left')
+        hi = len(part) if t1 is None else np.searchsorted(part['time'], t1, side='left')
+        chunks.append(np.array(part[lo:hi]))
+    bars = {col: np.concatenate([c[col] for c in chunks]) if chunks else np.empty(0) for col in BAR_COLUMNS}
+    idx = pd.to_datetime(bars['time'].astype(np.int64), unit='ns', utc=True)
+    if tz is not None:
+        idx = idx.tz_convert(tz)
+    return pd.DataFrame({col: bars[col] for col in BAR_COLUMNS[1:]}, index=idx)
+
+
+def load_bar_columns(root: str, source: str, symbol: str, bar_size: str) -> dict[str, np.ndarray]:
+    '''
+    The consolidated columns of a stored series (see `BarStore.consolidate()`)
+    as read-only memory-mapped arrays, by name in `BAR_COLUMNS`.
+    '''
+    d = _series_dir(root, source, symbol, bar_size)
+    pointer = d / 'columns.current'
+    if not pointer.exists():
+        raise FileNotFoundError(f"No consolidated columns in {d}, run BarStore.consolidate() first")
+    cols_dir = d / pointer.read_text().strip()
+    return {col: np.load(cols_dir / f"{col}.npy", mmap_mode='r') for col in BAR_COLUMNS}
+
+
+##
+# Indicators. These take either a pandas Series or a plain/memory-mapped
+# numpy array (e.g. from `load_bar_columns()`), and return the same kind of
+# object.
+##
+
+def _rolling_mean(arr: np.ndarray, window: int) -> np.ndarray:
+    out = np.full(len(arr), np.nan)
+    if len(arr) >= window:
+        out[window - 1:] = np.lib.stride_tricks.sliding_window_view(arr, window).mean(axis=1)
+    return out
+
+
+def find_peaks(ser: pd.Series | np.ndarray):
+    if isinstance(ser, pd.Series):
+        # centre bar is higher than previous and next
+        peaks = (ser.shift(1) > ser.shift(2)) & (ser.shift(1) > ser)
+        # shift result forward so that the peak is marked on the centre bar
+        return peaks.shift(-1)
+    peaks = np.zeros(len(ser), dtype=bool)
+    peaks[1:-1] = (ser[1:-1] > ser[:-2]) & (ser[1:-1] > ser[2:])
+    return peaks
+
+
+def find_valleys(ser: pd.Series | np.ndarray):
+    if isinstance(ser, pd.Series):
+        # centre bar is lower than previous and next
+        valleys = (ser.shift(1) < ser.shift(2)) & (ser.shift(1) < ser)
+        # shift result forward so that the valley is marked on the centre bar
+        return valleys.shift(-1)
+    valleys = np.zeros(len(ser), dtype=bool)
+    valleys[1:-1] = (ser[1:-1] < ser[:-2]) & (ser[1:-1] < ser[2:])
+    return valleys
+
+
+def lbr310(ser: pd.Series | np.ndarray) -> tuple:
+    if isinstance(ser, pd.Series):
+        fast_ser = ser.rolling(window=3).mean()
+        slow_ser = ser.rolling(window=10).mean()
+        macd = fast_ser - slow_ser
+        signal = macd.rolling(window=16).mean()
+        return (macd, signal)
+    arr = np.asarray(ser, dtype=np.float64)
+    macd = _rolling_mean(arr, 3) - _rolling_mean(arr, 10)
+    signal = _rolling_mean(macd, 16)
+    return (macd, signal)
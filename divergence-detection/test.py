@@ -33,19 +33,9 @@ df = dd.get_ohlcv(
         'to': dd.to_utc_timestamp('2024-04-11 00:00:00'),
     })
 
+# Or bars the IB side keeps in the local store, see HistoricalDataCollector.store_as()
+# df = dd.read_bars('../tmp/bars', 'ib', 'MCL-CONTFUT-NYMEX-MIDPOINT', '2 mins', tz=LOCAL_TZ)
 
-def find_peaks(ser: pd.Series):
-    # centre bar is higher than previous and next
-    peaks = (ser.shift(1) > ser.shift(2)) & (ser.shift(1) > ser)
-    # shift result forward so that the peak is marked on the centre bar
-    return peaks.shift(-1)
-
-
-def find_valleys(ser: pd.Series):
-    # centre bar is lower than previous and next
-    valleys = (ser.shift(1) < ser.shift(2)) & (ser.shift(1) < ser)
-    # shift result forward so that the valley is marked on the centre bar
-    return valleys.shift(-1)
 
 def mark_divergence(df: pd.DataFrame,
                     series_peak_col_name: str,
@@ -141,14 +131,6 @@ def mark_divergence(df: pd.DataFrame,
     }
 
 
-def lbr310(ser: pd.Series) -> (pd.Series, pd.Series):
-    fast_ser = ser.rolling(window=3).mean()
-    slow_ser = ser.rolling(window=10).mean()
-    macd = fast_ser - slow_ser
-    signal = macd.rolling(window=16).mean()
-    return (macd, signal)
-
-
 def plot_gapless(df: pd.DataFrame, cols: list[str]):
     df = df.copy()
 
@@ -166,12 +148,12 @@ def plot_gapless(df: pd.DataFrame, cols: list[str]):
 # df = df.tail(lookback).copy()
 
 # Price peaks, use the highs
-df['peaks'] = find_peaks(df['high'])
+df['peaks'] = dd.find_peaks(df['high'])
 # Price peaks, use the lows
-df['valleys'] = find_valleys(df['low'])
+df['valleys'] = dd.find_valleys(df['low'])
 
 # LBR 3-10 oscillator
-macd, signal = lbr310(df['close'])
+macd, signal = dd.lbr310(df['close'])
 df['macd'] = macd
 df['signal'] = signal
 
@@ -184,9 +166,9 @@ df['signal'] = signal
 # plt.show()
 
 # For the MACD, we need to find peaks only on the positive zone
-df['macd_peaks'] = find_peaks(macd.where(macd > 0))
+df['macd_peaks'] = dd.find_peaks(macd.where(macd > 0))
 # For the MACD, we need to find valleys only on the negative zone
-df['macd_valleys'] = find_valleys(macd.where(macd < 0))
+df['macd_valleys'] = dd.find_valleys(macd.where(macd < 0))
 
 print(df[['macd', 'macd_peaks', 'macd_valleys']])
 
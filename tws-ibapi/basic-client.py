@@ -16,12 +16,12 @@
 
 import sys
 sys.path.append('./src')
-from collections import defaultdict
 import datetime as dt
-import time
 
 from brokerplatform.ib import init_logging
 from brokerplatform.ib.app import TwsApp
+from brokerplatform.barstore import BarStore
+from brokerplatform.ib.history import HistoricalDataCollector, store_symbol
 init_logging()
 
 import logging
@@ -30,7 +30,6 @@ from ibapi.wrapper import EWrapper
 from ibapi.contract import Contract, ContractDetails
 from ibapi.common import BarData
 
-import pandas as pd
 import pytz
 
 
@@ -43,9 +42,10 @@ class AppMessageHandler(EWrapper):
 
     def __init__(self):
         EWrapper.__init__(self)
-        self.hist_data = None
-        self.tmp_hist_data_idx = []
-        self.tmp_hist_data_dict = defaultdict(list)
+        # Buffers bars per reqId, converting to our local timezone once per request,
+        # and keeps the requests registered with `store_as()` on disk for research
+        self.hist_data = HistoricalDataCollector(tz=pytz.timezone('Asia/Jakarta'),
+                                                 store=BarStore('../tmp/bars'))
 
     def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
         '''Overriden method'''
@@ -71,31 +71,12 @@ class AppMessageHandler(EWrapper):
             for TRADES).
         WAP -   the bar's Weighted Average Price
         hasGaps  -indicates if the data has gaps or not."""
-        log.info(f"[HistoricalData] reqId={reqId}|bar={bar}")
-
-        local_tz = pytz.timezone('Asia/Jakarta')
-        # Incoming timestamp is in UTC
-        bar_dt = dt.datetime.fromtimestamp(float(bar.date), tz=dt.UTC)
-        # Now convert to local timezone
-        bar_dt = bar_dt.astimezone(local_tz)
-        # then convert to pandas Timestamp
-        pd_ts = pd.Timestamp(bar_dt)
-        self.tmp_hist_data_idx.append(pd_ts)
-        row_dict = self.tmp_hist_data_dict
-        row_dict['open'].append(bar.open)
-        row_dict['high'].append(bar.high)
-        row_dict['low'].append(bar.low)
-        row_dict['close'].append(bar.close)
-        row_dict['volume'].append(bar.volume)
-
+        self.hist_data.historicalData(reqId, bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         """Marks the ending of the historical bars reception."""
         log.info(f"[HistoricalDataEnd] reqId={reqId}|start={start}|end={end}")
-        self.hist_data = pd.DataFrame(self.tmp_hist_data_dict, index=self.tmp_hist_data_idx)
-        # reset holding vars
-        self.tmp_hist_data_dict = defaultdict(list)
-        self.tmp_hist_data_idx = []
+        self.hist_data.historicalDataEnd(reqId, start, end)
 
 
 
@@ -126,8 +107,10 @@ app.client.reqContractDetails(app.nextId, c)
 # our local time.
 utc_fmt = "%Y%m%d-%H:%M:%S"
 
+hist_req_id = app.nextId
+handler.hist_data.store_as(hist_req_id, store_symbol(c, "MIDPOINT"), "2 mins")
 app.client.reqHistoricalData(
-    reqId=app.nextId,
+    reqId=hist_req_id,
     contract=c,
     #endDateTime="", # Till now
     #endDateTime=dt.datetime.now(tz).strftime(f"%Y%m%d %H:%M:%S {tz.zone}"), # Till now
@@ -141,8 +124,7 @@ app.client.reqHistoricalData(
     chartOptions=[], # internal use, just specify empty list
 )
 
-time.sleep(10) # Wait to get async response
-df = handler.hist_data
+df = handler.hist_data.pop(hist_req_id, timeout=10) # Wait to get async response
 #app.stop()
 # app.start()
 
@@ -0,0 +1,250 @@
+import logging
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+_log = logging.getLogger(__name__)
+
+OHLCV_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# One record per bar, `time` is the bar's start in nanoseconds since the epoch (UTC)
+BAR_DTYPE = np.dtype([('time', '<i8')] + [(col, '<f8') for col in OHLCV_COLUMNS])
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+def _to_ns(idx: pd.DatetimeIndex) -> np.ndarray:
+    # Naive timestamps are taken to be in UTC
+    if idx.tz is not None:
+        idx = idx.tz_convert('UTC').tz_localize(None)
+    return idx.as_unit('ns').asi8
+
+
+def _ts_ns(t) -> int | None:
+    if t is None:
+        return None
+    t = pd.Timestamp(t)
+    if t.tz is not None:
+        t = t.tz_convert('UTC').tz_localize(None)
+    return t.as_unit('ns').value
+
+
+def _month(t_ns: int | None) -> str | None:
+    return None if t_ns is None else str(np.datetime64(t_ns, 'ns').astype('datetime64[M]'))
+
+
+@dataclass
+class OHLCVArrays:
+    """
+    OHLCV columns as plain 1-D arrays, `time` being the sidecar index in
+    nanoseconds since the epoch (UTC). When loaded with `mmap=True` the
+    columns are `np.memmap` views, so several processes share one page cache
+    copy, and indicators such as `divdetect.lbr310` run on them directly.
+    """
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    def __len__(self):
+        return len(self.time)
+
+    def index(self, tz=None) -> pd.DatetimeIndex:
+        idx = pd.to_datetime(self.time, unit='ns', utc=True)
+        return idx if tz is None else idx.tz_convert(tz)
+
+    def to_frame(self, tz=None) -> pd.DataFrame:
+        '''Materialises the columns in memory, in the `divdetect.get_ohlcv` layout.'''
+        return pd.DataFrame({col: np.asarray(getattr(self, col)) for col in OHLCV_COLUMNS}, index=self.index(tz))
+
+
+class BarStore:
+    """
+    Local OHLCV bar store, so history is read from disk rather than
+    re-downloaded each session.
+
+    Bars are partitioned by source, symbol, bar size and (UTC) month:
+
+    ```
+    <root>/<source>/<symbol>/<bar_size>/<YYYY-MM>.npy
+    ```
+
+    Each partition is a NumPy structured array (see `BAR_DTYPE`) sorted by
+    time. Ingestion is append-only, bars already in the store are never
+    modified, and partitions are replaced atomically so readers never see a
+    partial write. That makes each append rewrite the whole month file it
+    touches: append in batches (a request or backfill window at a time), not
+    bar by bar. Range reads use the months to prune partitions and binary
+    search on the time column within them.
+
+    A single writer per partition is assumed.
+
+    The store only needs NumPy and pandas. IB bars are stored by
+    `HistoricalDataCollector.store_as()` and `Backfill(store=...)`, research
+    code reads them with `divdetect.read_bars()`/`load_bar_columns()`, which
+    read this layout directly: keep them in step when changing it.
+
+    For memory-mapped reads `consolidate()` additionally writes the series as
+    one fixed-width `.npy` file per column plus a `time.npy` sidecar index,
+    which `load(..., mmap=True)` maps without reading it into memory.
+
+    ```
+    store = BarStore('../tmp/bars')
+    store.append('eodhd', 'AAPL.US', '1h', dd.get_ohlcv(...))
+    df = store.read('eodhd', 'AAPL.US', '1h', start='2024-03-08', end='2024-04-11', tz=LOCAL_TZ)
+    ```
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def series_dir(self, source: str, symbol: str, bar_size: str) -> Path:
+        return self.root / _safe_name(source) / _safe_name(symbol) / _safe_name(bar_size)
+
+    def partitions(self, source: str, symbol: str, bar_size: str) -> list[Path]:
+        '''Partition files, oldest month first.'''
+        d = self.series_dir(source, symbol, bar_size)
+        if not d.is_dir():
+            return []
+        return sorted(d.glob('????-??.npy'))
+
+    def append(self, source: str, symbol: str, bar_size: str, df: pd.DataFrame) -> int:
+        '''
+        Adds the bars in `df` (DatetimeIndex, OHLCV columns) that are not in the
+        store yet. Returns the number of bars added.
+        '''
+        if df.empty:
+            return 0
+        bars = np.empty(len(df), dtype=BAR_DTYPE)
+        bars['time'] = _to_ns(pd.DatetimeIndex(df.index))
+        for col in OHLCV_COLUMNS:
+            bars[col] = df[col].to_numpy(dtype=np.float64)
+        bars = bars[np.argsort(bars['time'], kind='stable')]
+        # Keep the last of any duplicated timestamps in the incoming bars
+        keep = np.append(bars['time'][1:] != bars['time'][:-1], True)
+        bars = bars[keep]
+
+        d = self.series_dir(source, symbol, bar_size)
+        d.mkdir(parents=True, exist_ok=True)
+        months = bars['time'].astype('datetime64[ns]').astype('datetime64[M]')
+        bounds = np.flatnonzero(np.append(True, months[1:] != months[:-1]))
+        added = 0
+        for lo, hi in zip(bounds, np.append(bounds[1:], len(bars))):
+            added += self._append_partition(d / f"{months[lo]}.npy", bars[lo:hi])
+        _log.info(f"Stored {added} of {len(df)} bars in {d}")
+        return added
+
+    def read_array(self, source: str, symbol: str, bar_size: str, start=None, end=None) -> np.ndarray:
+        '''Bars in `[start, end)` as a `BAR_DTYPE` array.'''
+        t0, t1 = _ts_ns(start), _ts_ns(end)
+        m0, m1 = _month(t0), _month(t1)
+
+        chunks = []
+        for path in self.partitions(source, symbol, bar_size):
+            month = path.stem
+            if (m0 is not None and month < m0) or (m1 is not None and month > m1):
+                continue
+            part = np.load(path, mmap_mode='r')
+            times = part['time']
+            lo = 0 if t0 is None else np.searchsorted(times, t0, side='left')
+            hi = len(part) if t1 is None else np.searchsorted(times, t1, side='left')
+            if hi > lo:
+                chunks.append(np.array(part[lo:hi]))
+        if not chunks:
+            return np.empty(0, dtype=BAR_DTYPE)
+        return np.concatenate(chunks)
+
+    def read(self, source: str, symbol: str, bar_size: str, start=None, end=None, tz=None) -> pd.DataFrame:
+        '''
+        Bars in `[start, end)` as a DataFrame, in the same layout as
+        `divdetect.get_ohlcv`. Naive `start`/`end` are taken to be in UTC.
+        '''
+        bars = self.read_array(source, symbol, bar_size, start, end)
+        idx = pd.to_datetime(bars['time'], unit='ns', utc=True)
+        if tz is not None:
+            idx = idx.tz_convert(tz)
+        return pd.DataFrame({col: bars[col] for col in OHLCV_COLUMNS}, index=idx)
+
+    def consolidate(self, source: str, symbol: str, bar_size: str) -> Path:
+        '''
+        Writes the whole series as columnar files for memory-mapped loading.
+        Re-run after appending. The new columns are written to a fresh
+        directory and then switched to by atomically replacing the
+        `columns.current` pointer. The previous generation is kept until the
+        next consolidate, so a reader that read the old pointer can still open
+        its files; older generations are removed.
+        '''
+        d = self.series_dir(source, symbol, bar_size)
+        bars = self.read_array(source, symbol, bar_size)
+        cols_dir = d / f"columns.{time.time_ns()}"
+        cols_dir.mkdir(parents=True)
+        for col in ['time'] + OHLCV_COLUMNS:
+            np.save(cols_dir / f"{col}.npy", np.ascontiguousarray(bars[col]))
+        pointer = d / 'columns.current'
+        old = pointer.read_text().strip() if pointer.exists() else None
+        tmp = d / 'columns.current.tmp'
+        tmp.write_text(cols_dir.name)
+        os.replace(tmp, pointer)
+        for gen in d.glob('columns.*'):
+            if gen.is_dir() and gen.name not in (cols_dir.name, old):
+                shutil.rmtree(gen, ignore_errors=True)
+        _log.info(f"Consolidated {len(bars)} bars into {cols_dir}")
+        return cols_dir
+
+    def load(self, source: str, symbol: str, bar_size: str, start=None, end=None, mmap: bool = False) -> OHLCVArrays:
+        '''
+        Bars in `[start, end)` as columns. With `mmap=True` the columns are
+        zero-copy `np.memmap` slices over the files written by `consolidate()`,
+        otherwise they are read from the partitions into memory.
+        '''
+        if not mmap:
+            bars = self.read_array(source, symbol, bar_size, start, end)
+            return OHLCVArrays(**{col: np.ascontiguousarray(bars[col]) for col in ['time'] + OHLCV_COLUMNS})
+
+        d = self.series_dir(source, symbol, bar_size)
+        pointer = d / 'columns.current'
+        if not pointer.exists():
+            raise FileNotFoundError(f"No consolidated columns in {d}, run BarStore.consolidate() first")
+        cols_dir = d / pointer.read_text().strip()
+        cols = {col: np.load(cols_dir / f"{col}.npy", mmap_mode='r') for col in ['time'] + OHLCV_COLUMNS}
+        t0, t1 = _ts_ns(start), _ts_ns(end)
+        lo = 0 if t0 is None else np.searchsorted(cols['time'], t0, side='left')
+        hi = len(cols['time']) if t1 is None else np.searchsorted(cols['time'], t1, side='left')
+        return OHLCVArrays(**{col: arr[lo:hi] for col, arr in cols.items()})
+
+    def last_time(self, source: str, symbol: str, bar_size: str) -> pd.Timestamp | None:
+        '''Time of the newest stored bar, handy to only download what is missing.'''
+        parts = self.partitions(source, symbol, bar_size)
+        if not parts:
+            return None
+        part = np.load(parts[-1], mmap_mode='r')
+        return pd.Timestamp(int(part['time'][-1]), unit='ns', tz='UTC') if len(part) else None
+
+    def _append_partition(self, path: Path, bars: np.ndarray) -> int:
+        if path.exists():
+            existing = np.load(path)
+            # Existing bars win, the store is append-only
+            bars = bars[~np.isin(bars['time'], existing['time'])]
+            if len(bars) == 0:
+                return 0
+            merged = np.concatenate([existing, bars])
+            merged = merged[np.argsort(merged['time'], kind='stable')]
+        else:
+            merged = bars
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, merged)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path) # atomic
+        return len(bars)
@@ -1,7 +1,10 @@
+import copy
 import threading
 import logging
 from dataclasses import dataclass
+from typing import Callable
 
+from ibapi import comm
 from ibapi.client import EClient
 from ibapi.wrapper import EWrapper
 
@@ -16,6 +19,22 @@ log = logging.getLogger(__name__)
 # Max request id (use a practical value on 32 bit system), before we reset.
 MAX_REQUEST_ID = 2**31 - 1
 
+# TWS disconnects clients sending more than 50 messages per second
+MAX_MESSAGES_PER_SECOND = 50
+
+
+@dataclass(eq=False)
+class Subscription:
+    '''A streaming request to replay after a reconnect, see `TwsApp.subscribe_*`.'''
+    reqId: int
+    request: str # EClient method, e.g. 'reqMktData'
+    args: tuple
+    cancel: str
+    cancel_args: tuple = ()
+    # (server version, message) as last encoded by the EClient method
+    encoded: tuple[int, str] | None = None
+
+
 @dataclass
 class TwsApp:
     """
@@ -40,6 +59,15 @@ class TwsApp:
     app.stop()
     ```
 
+    With `reconnect=True` the app reconnects with exponential backoff when
+    the connection drops (e.g. a gateway restart), and replays the market
+    data, scanner and account subscriptions made with `subscribe_mkt_data()`,
+    `subscribe_tick_by_tick()`, `subscribe_mkt_depth()`,
+    `subscribe_realtime_bars()`, `subscribe_scanner()`, `subscribe_pnl()`,
+    `subscribe_pnl_single()` and `subscribe_account_summary()`, in batches
+    kept under the TWS message rate limit. Subscriptions made before
+    `start()` are sent the same way once connected.
+
     References:
     * Old page: https://interactivebrokers.github.io/tws-api/index.html
     * New page: https://ibkrcampus.com/ibkr-api-page/twsapi-doc/
@@ -50,6 +78,11 @@ class TwsApp:
     port: int = IBGATEWAY_PAPER_TRADING_PORT
     max_request_id: int = MAX_REQUEST_ID
     client_id: int = 0
+    # Builds the EClient from the message handler, e.g. to use an EClient subclass
+    client_factory: Callable[[EWrapper], EClient] = EClient
+    reconnect: bool = False
+    reconnect_backoff: float = 1.0
+    max_reconnect_backoff: float = 60.0
 
     """
     This is a generic TWS/IB Gateway client application class.
@@ -64,35 +97,97 @@ class TwsApp:
         assert self.port >= 0 and self.port <= 65535, "port must be a valid port number"
         assert self.client_id >= 0, "client_id must be a positive integer"
         assert self.max_request_id >= 0, "max_request_id must be 0 or greater"
+        assert self.reconnect_backoff > 0, "reconnect_backoff must be greater than 0"
         self._client = None
         self._curr_request_id = 0
+        self._request_id_lock = threading.Lock() # nextId is taken from several threads
         self._running = False
+        self._stopping = threading.Event()
+        self._subscriptions: dict[int, Subscription] = {}
+        self._subscriptions_lock = threading.Lock()
 
     def start(self):
         log.info("Starting TwsApp")
         if not self._client:
-            self._client = EClient(self.message_handler)
+            self._client = self.client_factory(self.message_handler)
+        self._stopping.clear()
         self._connect()
         self._runInThread()
 
     def stop(self):
         log.info("Stopping TwsApp")
+        self._stopping.set()
         self._disconnect() # Stops the message handler's run() loop and thread
         self._running = False
 
     @property
     def nextId(self):
-        '''Generates a request id for use in various `client.req*` calls.'''
-        self._curr_request_id += 1
-        if self._curr_request_id >= MAX_REQUEST_ID:
-            self._curr_request_id = 1
-        return self._curr_request_id
+        '''Generates a request id for use in various `client.req*` calls, from any thread.'''
+        with self._request_id_lock:
+            self._curr_request_id += 1
+            if self._curr_request_id >= MAX_REQUEST_ID:
+                self._curr_request_id = 1
+            return self._curr_request_id
 
     @property
     def client(self):
         '''Access the EClient instance, to make `req*` calls.'''
         return self._client
 
+    @property
+    def subscriptions(self) -> dict[int, Subscription]:
+        return dict(self._subscriptions)
+
+    def subscribe_mkt_data(self, contract, genericTickList: str = "", snapshot: bool = False,
+                           regulatorySnapshot: bool = False, mktDataOptions=None) -> int:
+        '''`client.reqMktData`, replayed on reconnect. Returns the reqId.'''
+        return self._subscribe('reqMktData', (contract, genericTickList, snapshot, regulatorySnapshot,
+                                              mktDataOptions or []), 'cancelMktData')
+
+    def subscribe_tick_by_tick(self, contract, tickType: str, numberOfTicks: int = 0, ignoreSize: bool = False) -> int:
+        '''`client.reqTickByTickData`, replayed on reconnect. Returns the reqId.'''
+        return self._subscribe('reqTickByTickData', (contract, tickType, numberOfTicks, ignoreSize),
+                               'cancelTickByTickData')
+
+    def subscribe_mkt_depth(self, contract, numRows: int, isSmartDepth: bool = False, mktDepthOptions=None) -> int:
+        '''`client.reqMktDepth`, replayed on reconnect. Returns the reqId.'''
+        return self._subscribe('reqMktDepth', (contract, numRows, isSmartDepth, mktDepthOptions or []),
+                               'cancelMktDepth', (isSmartDepth,))
+
+    def subscribe_realtime_bars(self, contract, barSize: int = 5, whatToShow: str = 'TRADES', useRTH: bool = False,
+                                realTimeBarsOptions=None) -> int:
+        '''`client.reqRealTimeBars`, replayed on reconnect. Returns the reqId.'''
+        return self._subscribe('reqRealTimeBars', (contract, barSize, whatToShow, useRTH, realTimeBarsOptions or []),
+                               'cancelRealTimeBars')
+
+    def subscribe_scanner(self, subscription, scannerSubscriptionOptions=None,
+                          scannerSubscriptionFilterOptions=None) -> int:
+        '''`client.reqScannerSubscription`, replayed on reconnect. Returns the reqId.'''
+        return self._subscribe('reqScannerSubscription', (subscription, scannerSubscriptionOptions or [],
+                                                          scannerSubscriptionFilterOptions or []),
+                               'cancelScannerSubscription')
+
+    def subscribe_pnl(self, account: str, modelCode: str = "", reqId: int | None = None) -> int:
+        '''
+        `client.reqPnL`, replayed on reconnect. Returns the reqId, pass one
+        from `nextId` to route its callbacks before the request is sent.
+        '''
+        return self._subscribe('reqPnL', (account, modelCode), 'cancelPnL', reqId=reqId)
+
+    def subscribe_pnl_single(self, account: str, conId: int, modelCode: str = "", reqId: int | None = None) -> int:
+        '''`client.reqPnLSingle`, replayed on reconnect. Returns the reqId, see `subscribe_pnl()`.'''
+        return self._subscribe('reqPnLSingle', (account, modelCode, conId), 'cancelPnLSingle', reqId=reqId)
+
+    def subscribe_account_summary(self, tags: str, groupName: str = "All", reqId: int | None = None) -> int:
+        '''`client.reqAccountSummary`, replayed on reconnect. Returns the reqId, see `subscribe_pnl()`.'''
+        return self._subscribe('reqAccountSummary', (groupName, tags), 'cancelAccountSummary', reqId=reqId)
+
+    def unsubscribe(self, reqId: int):
+        with self._subscriptions_lock:
+            sub = self._subscriptions.pop(reqId, None)
+        if sub and self._client and self._client.isConnected():
+            getattr(self._client, sub.cancel)(reqId, *sub.cancel_args)
+
     def _connect(self):
         log.info(f"Connecting to TWS[{self.host}:{self.port}]")
         if self._client.isConnected():
@@ -113,8 +208,85 @@ class TwsApp:
             return
         log.info("Running application")
         def _run():
-            self._client.run()
-            # A disconnect() call will stop the client's run() loop
+            if self._client.isConnected():
+                self._replay_subscriptions() # made before start(), if any
+            while True:
+                self._client.run()
+                # A disconnect() call will stop the client's run() loop
+                if not self.reconnect or self._stopping.is_set() or not self._reconnect():
+                    break
             log.info("Client stopped, exiting thread")
+            self._running = False
         threading.Thread(target=_run).start()
         self._running = True
+
+    def _reconnect(self) -> bool:
+        '''Reconnects with exponential backoff, False if stopped meanwhile.'''
+        log.warning(f"Connection to TWS[{self.host}:{self.port}] lost")
+        delay = self.reconnect_backoff
+        while not self._stopping.wait(delay):
+            log.info(f"Reconnecting to TWS[{self.host}:{self.port}]")
+            self._client.connect(self.host, self.port, clientId=self.client_id)
+            if self._client.isConnected():
+                log.info("Reconnected")
+                if self._replay_subscriptions():
+                    return True
+            delay = min(delay * 2, self.max_reconnect_backoff)
+            log.info(f"Reconnect failed, next attempt in {delay:.1f}s")
+        return False
+
+    def _subscribe(self, request: str, args: tuple, cancel: str, cancel_args: tuple = (),
+                   reqId: int | None = None) -> int:
+        sub = Subscription(self.nextId if reqId is None else reqId, request, args, cancel, cancel_args)
+        with self._subscriptions_lock:
+            self._subscriptions[sub.reqId] = sub
+        if self._client and self._client.isConnected():
+            msg = self._encode(sub)
+            if msg:
+                self._client.sendMsg(msg)
+        return sub.reqId
+
+    def _encode(self, sub: Subscription) -> str | None:
+        '''
+        The request's message, as encoded by the EClient method. Kept for as
+        long as the server version stays the same.
+        '''
+        version = self._client.serverVersion()
+        if sub.encoded is None or sub.encoded[0] != version:
+            captured = []
+            # Encode on a shallow copy sharing the connection, so messages other
+            # threads send through the live client meanwhile are not captured
+            encoder = copy.copy(self._client)
+            encoder.sendMsg = captured.append
+            getattr(encoder, sub.request)(sub.reqId, *sub.args)
+            # Nothing is sent when the EClient method rejects the request (reported via error())
+            sub.encoded = (version, captured[0]) if captured else None
+        return sub.encoded[1] if sub.encoded else None
+
+    def _replay_subscriptions(self) -> bool:
+        '''
+        Sends the subscriptions again. On a send error the client is
+        disconnected and False returned, to go back to reconnecting.
+        '''
+        with self._subscriptions_lock:
+            subs = list(self._subscriptions.values())
+        if not subs:
+            return True
+        log.info(f"Replaying {len(subs)} subscriptions")
+        msgs = [msg for msg in map(self._encode, subs) if msg]
+        batch = MAX_MESSAGES_PER_SECOND - 5 # headroom for the app's own requests
+        conn = self._client.conn
+        for i in range(0, len(msgs), batch):
+            if i and self._stopping.wait(1):
+                return False
+            data = b"".join(comm.make_msg(msg) for msg in msgs[i:i + batch])
+            try:
+                with conn.lock:
+                    if not conn.isConnected():
+                        return False
+                    conn.socket.sendall(data)
+            except OSError as e: # includes socket.timeout
+                log.warning(f"Replaying subscriptions failed: {e}")
+                self._client.disconnect()
+                return False
+        return True
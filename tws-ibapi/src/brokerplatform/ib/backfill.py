@@ -0,0 +1,259 @@
+import datetime as dt
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from ibapi.common import BarData
+from ibapi.contract import Contract
+
+from brokerplatform.barstore import BarStore
+from brokerplatform.ib.history import (IB_SOURCE, OHLCV_COLUMNS, HistoricalDataCollector, empty_columns,
+                                       store_symbol, to_frame, utc)
+from brokerplatform.ib.pacing import BARS, HistoricalDataScheduler, HistoricalJob
+
+log = logging.getLogger(__name__)
+
+# Specify date times in UTC, see the notes in basic-client.py
+UTC_FORMAT = "%Y%m%d-%H:%M:%S"
+
+_DAY = dt.timedelta(days=1)
+
+# Longest `durationStr` IB accepts for each `barSizeSetting`, along with the
+# span each window steps back by. Calendar based units (W, M, Y) use a
+# conservative span, overlapping bars are de-duplicated when stitching.
+# See: https://ibkrcampus.com/ibkr-api-page/twsapi-doc/#hist-step-size
+MAX_DURATIONS = {
+    '1 secs': ('1800 S', dt.timedelta(seconds=1800)),
+    '5 secs': ('3600 S', dt.timedelta(seconds=3600)),
+    '10 secs': ('14400 S', dt.timedelta(seconds=14400)),
+    '15 secs': ('14400 S', dt.timedelta(seconds=14400)),
+    '30 secs': ('28800 S', dt.timedelta(seconds=28800)),
+    '1 min': ('1 D', _DAY),
+    '2 mins': ('2 D', 2 * _DAY),
+    '3 mins': ('1 W', 7 * _DAY),
+    '5 mins': ('1 W', 7 * _DAY),
+    '10 mins': ('1 W', 7 * _DAY),
+    '15 mins': ('1 W', 7 * _DAY),
+    '20 mins': ('1 W', 7 * _DAY),
+    '30 mins': ('1 M', 28 * _DAY),
+    '1 hour': ('1 M', 28 * _DAY),
+    '2 hours': ('1 M', 28 * _DAY),
+    '3 hours': ('1 M', 28 * _DAY),
+    '4 hours': ('1 M', 28 * _DAY),
+    '8 hours': ('1 M', 28 * _DAY),
+    '1 day': ('1 Y', 365 * _DAY),
+    '1 week': ('1 Y', 365 * _DAY),
+    '1 month': ('1 Y', 365 * _DAY),
+}
+
+
+class Backfill:
+    """
+    Builds long bar histories by walking `endDateTime` back from `end` to
+    `start` in windows of the largest `durationStr` allowed for the bar size.
+    Windows are issued through a `HistoricalDataScheduler` so they run
+    concurrently at the maximum compliant rate.
+
+    Windows end on a fixed grid (multiples of the step since the epoch), so
+    runs with a different `start` or `end` (e.g. `end=now`) share them. With
+    a `state_dir`, each completed window is written to disk, so an
+    interrupted or later backfill requests only the missing windows, plus
+    the newest one when `end` falls inside it. With a
+    `store`, each completed window is also appended to the `BarStore` series
+    `store_symbol(contract, what_to_show)`, for research to read from disk.
+
+    ```
+    class Handler(EWrapper):
+        def historicalData(self, reqId, bar):
+            backfill.historicalData(reqId, bar)
+        def historicalDataEnd(self, reqId, start, end):
+            scheduler.historicalDataEnd(reqId, start, end)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            scheduler.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+
+    backfill = Backfill(scheduler, contract, '1 min',
+                        start=dt.datetime(2015, 1, 1), end=dt.datetime(2025, 1, 1),
+                        state_dir='./tmp/backfill', store=BarStore('../tmp/bars'))
+    df = backfill.run()
+    ```
+
+    `run()` raises if windows still failed after the scheduler's retries,
+    listed in `failed`; run it again to request just those, or take the
+    partial `frame()`.
+    """
+
+    def __init__(self, scheduler: HistoricalDataScheduler, contract: Contract, bar_size: str,
+                 start: dt.datetime, end: dt.datetime,
+                 what_to_show: str = 'TRADES',
+                 use_rth: bool = False,
+                 tz=dt.UTC,
+                 state_dir: str | None = None,
+                 store: BarStore | None = None):
+        assert bar_size in MAX_DURATIONS, f"bar_size must be one of {list(MAX_DURATIONS)}"
+        self.scheduler = scheduler
+        self.contract = contract
+        self.bar_size = bar_size
+        self.start_time = utc(start)
+        self.end_time = utc(end)
+        assert self.start_time < self.end_time, "start must be before end"
+        self.what_to_show = what_to_show
+        self.use_rth = use_rth
+        self.tz = tz
+        self.state_path = Path(state_dir) / self.key if state_dir else None
+        self.store = store
+        self.failed: dict[dt.datetime, tuple[int, str]] = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._outstanding = 0
+        self._collector = HistoricalDataCollector()
+        self._windows: dict[dt.datetime, dict[str, np.ndarray]] = {}
+
+    @property
+    def key(self) -> str:
+        '''Identifies the backfill, used to name its state directory.'''
+        c = self.contract
+        parts = [c.symbol, c.secType, c.exchange, c.currency, c.lastTradeDateOrContractMonth,
+                 str(c.conId or ''), self.bar_size, self.what_to_show, 'rth' if self.use_rth else 'all']
+        return re.sub(r'[^A-Za-z0-9_.-]+', '_', '-'.join(p for p in parts if p))
+
+    def windows(self) -> list[dt.datetime]:
+        '''Window end times, newest first: the grid points covering the range, the newest capped at `end`.'''
+        _, step = MAX_DURATIONS[self.bar_size]
+        epoch = dt.datetime.fromtimestamp(0, dt.UTC)
+        end = epoch + ((self.start_time - epoch) // step + 1) * step
+        ends = []
+        while True:
+            ends.append(min(end, self.end_time))
+            if end >= self.end_time:
+                break
+            end += step
+        return ends[::-1]
+
+    def start(self):
+        '''Submits the windows that have not completed yet.'''
+        duration, _ = MAX_DURATIONS[self.bar_size]
+        jobs = []
+        for end in self.windows():
+            if end in self._windows or self._load_window(end):
+                continue
+            jobs.append(HistoricalJob(BARS, self.contract, dict(
+                endDateTime=end.strftime(UTC_FORMAT),
+                durationStr=duration,
+                barSizeSetting=self.bar_size,
+                whatToShow=self.what_to_show,
+                useRTH=int(self.use_rth),
+                formatDate=2, # Epoch, converted to `tz` when stitching
+                keepUpToDate=False,
+                chartOptions=[],
+            ), on_done=self._on_done, on_error=self._on_error, tag=(self, end)))
+        log.info(f"Backfill {self.key}: {len(jobs)} of {len(self.windows())} windows to request")
+        with self._lock:
+            for job in jobs:
+                self.failed.pop(job.tag[1], None) # requested again
+            self._outstanding += len(jobs)
+            if self._outstanding == 0:
+                self._done.set()
+            else:
+                self._done.clear()
+        self.scheduler.submit_all(jobs)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def run(self, timeout: float | None = None) -> pd.DataFrame:
+        self.start()
+        if not self.wait(timeout):
+            raise TimeoutError(f"Backfill {self.key} did not complete within {timeout}s")
+        if self.failed:
+            failed = ', '.join(f"{end:%Y-%m-%d %H:%M} ({code})" for end, (code, _) in sorted(self.failed.items()))
+            raise RuntimeError(f"Backfill {self.key}: {len(self.failed)} windows failed: {failed}")
+        return self.frame()
+
+    def frame(self) -> pd.DataFrame:
+        '''Stitches the completed windows into one frame, de-duplicated and trimmed to the range.'''
+        with self._lock:
+            windows = list(self._windows.values())
+        cols = {col: np.concatenate([w[col] for w in [empty_columns()] + windows]) for col in ['time'] + OHLCV_COLUMNS}
+        t = cols['time']
+        in_range = (t >= int(self.start_time.timestamp())) & (t < int(self.end_time.timestamp()))
+        df = to_frame({col: v[in_range] for col, v in cols.items()}, self.tz)
+        df = df[~df.index.duplicated(keep='last')]
+        return df.sort_index()
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def historicalData(self, reqId: int, bar: BarData):
+        job = self.scheduler.job(reqId)
+        if job is None or not (isinstance(job.tag, tuple) and job.tag[0] is self):
+            return
+        self._collector.historicalData(reqId, bar)
+
+    ##
+    # Internals
+    ##
+
+    def _on_done(self, job: HistoricalJob):
+        self._complete(job.tag[1], self._collector.take_columns(job.req_id))
+
+    def _on_error(self, job: HistoricalJob, errorCode: int, errorString: str):
+        self._collector.discard(job.req_id)
+        end = job.tag[1]
+        if 'no data' in errorString.lower():
+            # Weekends, holidays, before the contract existed, etc.
+            self._complete(end, empty_columns())
+            return
+        log.warning(f"Backfill {self.key}: window ending {end} failed: {errorCode}|{errorString}")
+        with self._lock:
+            self.failed[end] = (errorCode, errorString)
+            self._finish_one()
+
+    def _complete(self, end: dt.datetime, window: dict[str, np.ndarray]):
+        self._save_window(end, window)
+        if self.store is not None and len(window['time']):
+            self.store.append(IB_SOURCE, store_symbol(self.contract, self.what_to_show), self.bar_size,
+                              to_frame(window))
+        with self._lock:
+            self._windows[end] = window
+            self._finish_one()
+
+    def _finish_one(self):
+        self._outstanding -= 1
+        if self._outstanding <= 0:
+            log.info(f"Backfill {self.key} complete, {len(self.failed)} failed windows")
+            self._done.set()
+
+    def _window_file(self, end: dt.datetime) -> Path:
+        return self.state_path / f"{end:%Y%m%dT%H%M%S}.npz"
+
+    def _on_grid(self, end: dt.datetime) -> bool:
+        # Only whole grid windows are kept on disk, the newest may be capped at `end`
+        _, step = MAX_DURATIONS[self.bar_size]
+        return (end - dt.datetime.fromtimestamp(0, dt.UTC)) % step == dt.timedelta(0)
+
+    def _load_window(self, end: dt.datetime) -> bool:
+        if not self.state_path or not self._on_grid(end):
+            return False
+        path = self._window_file(end)
+        if not path.exists():
+            return False
+        with np.load(path) as data:
+            window = {col: data[col] for col in data.files}
+        with self._lock:
+            self._windows[end] = window
+        return True
+
+    def _save_window(self, end: dt.datetime, window: dict[str, np.ndarray]):
+        if not self.state_path or not self._on_grid(end):
+            return
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        path = self._window_file(end)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez(f, **window)
+        os.replace(tmp, path) # atomic, a window file is either complete or absent
@@ -0,0 +1,166 @@
+import datetime as dt
+import logging
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from brokerplatform.ib.history import OHLCV_COLUMNS, to_frame
+
+log = logging.getLogger(__name__)
+
+TIME = 'time'
+VOLUME = 'volume'
+TICKS = 'ticks'
+
+
+@dataclass(frozen=True)
+class BarSpec:
+    """
+    How ticks are grouped into bars:
+
+    * `BarSpec(TIME, 60)`: 1 minute bars, aligned to the epoch.
+    * `BarSpec(VOLUME, 1000)`: a bar closes once it has traded 1000 or more.
+    * `BarSpec(TICKS, 500)`: a bar closes after 500 ticks.
+    """
+    kind: str
+    size: float
+
+    def __post_init__(self):
+        assert self.kind in (TIME, VOLUME, TICKS), f"kind must be one of '{TIME}', '{VOLUME}', '{TICKS}'"
+        assert self.size > 0, "size must be greater than 0"
+
+    @classmethod
+    def seconds(cls, n: int) -> 'BarSpec':
+        return cls(TIME, n)
+
+    @classmethod
+    def minutes(cls, n: int) -> 'BarSpec':
+        return cls(TIME, n * 60)
+
+
+@dataclass(frozen=True)
+class Bar:
+    '''A completed bar, `time` is the epoch second of its first tick (its bucket start for time bars).'''
+    time: int
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+    count: int
+
+
+def bars_to_frame(bars: list[Bar], tz=dt.UTC) -> pd.DataFrame:
+    '''Bars as a frame in the `divdetect.get_ohlcv` layout.'''
+    columns = {'time': np.fromiter((b.time for b in bars), dtype=np.int64, count=len(bars))}
+    for col in OHLCV_COLUMNS:
+        columns[col] = np.fromiter((getattr(b, col) for b in bars), dtype=np.float64, count=len(bars))
+    return to_frame(columns, tz)
+
+
+class _BarState:
+    __slots__ = ('spec', 'callback', 'time', 'open', 'high', 'low', 'close', 'volume', 'count')
+
+    def __init__(self, spec: BarSpec, callback: Callable[[int, BarSpec, Bar], None]):
+        self.spec = spec
+        self.callback = callback
+        self.count = 0
+
+    def emit(self, reqId: int):
+        bar = Bar(self.time, self.open, self.high, self.low, self.close, self.volume, self.count)
+        self.count = 0
+        self.callback(reqId, self.spec, bar)
+
+    def add(self, reqId: int, time: int, price: float, size: float):
+        spec = self.spec
+        if spec.kind == TIME:
+            bucket = time - time % int(spec.size)
+            if self.count and bucket != self.time:
+                self.emit(reqId)
+            time = bucket
+        if self.count == 0:
+            self.time = time
+            self.open = self.high = self.low = price
+            self.volume = 0.0
+        elif price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += size
+        self.count += 1
+        if (spec.kind == VOLUME and self.volume >= spec.size) or (spec.kind == TICKS and self.count >= spec.size):
+            self.emit(reqId)
+
+
+class BarAggregator:
+    """
+    Builds time, volume or tick-count bars from `reqTickByTickData` streams,
+    in O(1) per tick with fixed-size state per (reqId, BarSpec).
+
+    `Last`/`AllLast` ticks use the trade price and size, `BidAsk` ticks the
+    mid price and `MidPoint` ticks the midpoint, both with no volume. Time bars
+    close on the first tick of the next bar, call `flush()` to close them
+    early (e.g. at the end of a session).
+
+    ```
+    agg = BarAggregator()
+
+    class Handler(EWrapper):
+        def tickByTickAllLast(self, reqId, tickType, time, price, size, tickAttribLast, exchange, specialConditions):
+            agg.tickByTickAllLast(reqId, tickType, time, price, size, tickAttribLast, exchange, specialConditions)
+
+    req_id = app.nextId
+    agg.add(req_id, BarSpec.seconds(15), lambda reqId, spec, bar: print(bar))
+    agg.add(req_id, BarSpec(VOLUME, 500), on_volume_bar)
+    app.client.reqTickByTickData(req_id, contract, 'AllLast', 0, False)
+    ```
+    """
+
+    def __init__(self):
+        self._states: dict[int, list[_BarState]] = {}
+
+    def add(self, reqId: int, spec: BarSpec, callback: Callable[[int, BarSpec, Bar], None]):
+        '''Subscribes `callback(reqId, spec, bar)` to the bars built from reqId's ticks.'''
+        self._states.setdefault(reqId, []).append(_BarState(spec, callback))
+
+    def remove(self, reqId: int, spec: BarSpec | None = None):
+        '''Drops all aggregations of a reqId, or only those for `spec`.'''
+        if spec is None:
+            self._states.pop(reqId, None)
+            return
+        states = [s for s in self._states.get(reqId, []) if s.spec != spec]
+        if states:
+            self._states[reqId] = states
+        else:
+            self._states.pop(reqId, None)
+
+    def flush(self, reqId: int):
+        '''Emits the bars in progress for a reqId.'''
+        for state in self._states.get(reqId, []):
+            if state.count:
+                state.emit(reqId)
+
+    def on_tick(self, reqId: int, time: int, price: float, size: float = 0.0):
+        states = self._states.get(reqId)
+        if states is None:
+            return
+        for state in states:
+            state.add(reqId, time, price, size)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float, size,
+                          tickAttribLast, exchange: str, specialConditions: str):
+        self.on_tick(reqId, time, price, float(size))
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize, askSize, tickAttribBidAsk):
+        self.on_tick(reqId, time, (bidPrice + askPrice) / 2)
+
+    def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
+        self.on_tick(reqId, time, midPoint)
@@ -0,0 +1,280 @@
+"""
+Wire capture and replay, to benchmark the `ibapi` decode path without a live
+TWS/IB Gateway.
+
+Capture the raw byte stream of a session by running the app with a
+`CapturingClient`:
+
+```
+app = TwsApp(message_handler=handler,
+             client_factory=functools.partial(CapturingClient, capture_path='./tmp/session.ibcap'))
+```
+
+Then replay it through `EReader`, `comm.read_fields` and `Decoder.interpret`
+into a counting wrapper, as fast as possible or at the recorded pace:
+
+```
+python -m brokerplatform.ib.capture ./tmp/session.ibcap [--realtime] [--trace-allocations]
+```
+"""
+import argparse
+import inspect
+import logging
+import queue
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+
+import numpy as np
+from ibapi import client as ib_client
+from ibapi import comm
+from ibapi.client import EClient
+from ibapi.connection import Connection
+from ibapi.decoder import Decoder
+from ibapi.message import IN
+from ibapi.reader import EReader
+from ibapi.wrapper import EWrapper
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'IBWIRE1\n'
+# Per chunk returned by `Connection.recvMsg`: receive time (epoch seconds) and length
+_RECORD = struct.Struct('<dI')
+
+MSG_NAMES = {v: k for k, v in vars(IN).items() if isinstance(v, int)}
+
+
+class CaptureWriter:
+    '''Appends timestamped chunks of the raw (framed) byte stream to a capture file.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(_RECORD.pack(time.time(), len(data)))
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_capture(path: str):
+    '''Yields the (time, chunk) records of a capture file.'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a wire capture file")
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t, size = _RECORD.unpack(header)
+            yield t, f.read(size)
+
+
+class CapturingConnection(Connection):
+    '''A `Connection` that also writes everything `recvMsg` returns to a capture.'''
+
+    def __init__(self, host, port, capture: CaptureWriter):
+        super().__init__(host, port)
+        self.capture = capture
+
+    def recvMsg(self):
+        buf = super().recvMsg()
+        self.capture.write(buf)
+        return buf
+
+    def disconnect(self):
+        super().disconnect()
+        self.capture.close()
+
+
+# `EClient.connect` creates its `Connection` inline, so the class is swapped
+# in `ibapi.client` for the duration of the call.
+_connect_lock = threading.Lock()
+
+
+class CapturingClient(EClient):
+    '''An `EClient` recording the incoming byte stream, including the handshake, to `capture_path`.'''
+
+    def __init__(self, wrapper, capture_path: str):
+        super().__init__(wrapper)
+        self.capture_path = capture_path
+
+    def connect(self, host, port, clientId):
+        writer = CaptureWriter(self.capture_path)
+        log.info(f"Capturing incoming messages to {self.capture_path}")
+        with _connect_lock:
+            original = ib_client.Connection
+            ib_client.Connection = lambda h, p: CapturingConnection(h, p, writer)
+            try:
+                super().connect(host, port, clientId)
+            finally:
+                ib_client.Connection = original
+
+
+class CountingWrapper(EWrapper):
+    '''Counts callbacks instead of handling them, so replays measure decoding only.'''
+
+    def __init__(self):
+        EWrapper.__init__(self)
+        self.counts = Counter()
+
+
+def _counting(name):
+    def count(self, *args, **kwargs):
+        self.counts[name] += 1
+    count.__name__ = name
+    return count
+
+
+for _name, _ in inspect.getmembers(EWrapper, inspect.isfunction):
+    if not _name.startswith('_'):
+        setattr(CountingWrapper, _name, _counting(_name))
+
+
+class _ReplayConnection:
+    '''Stands in for `Connection`, handing recorded chunks to `EReader`.'''
+
+    def __init__(self, records, realtime: bool):
+        self._records = iter(records)
+        self._realtime = realtime
+        self._start = None
+        self._connected = True
+
+    def isConnected(self):
+        return self._connected
+
+    def recvMsg(self):
+        record = next(self._records, None)
+        if record is None:
+            self._connected = False
+            return b""
+        t, data = record
+        if self._realtime:
+            now = time.monotonic()
+            if self._start is None:
+                self._start = (now, t)
+            delay = (t - self._start[1]) - (now - self._start[0])
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+
+@dataclass
+class ReplayReport:
+    messages: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    # Message id -> decode latencies (read_fields + Decoder.interpret + wrapper call), in ns
+    latencies: dict[int, list[int]] = field(default_factory=lambda: defaultdict(list))
+    callbacks: Counter = field(default_factory=Counter)
+    allocated_blocks: int = 0
+    traced_peak_bytes: int | None = None
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    def percentiles(self, q=(50, 90, 99, 99.9)) -> dict[str, np.ndarray]:
+        '''Decode latency percentiles in microseconds per message type.'''
+        return {MSG_NAMES.get(msg_id, str(msg_id)): np.percentile(np.array(lat) / 1e3, q)
+                for msg_id, lat in self.latencies.items()}
+
+    def __str__(self):
+        lines = [f"{self.messages} messages, {self.bytes} bytes in {self.seconds:.3f}s "
+                 f"({self.messages_per_second:,.0f} msg/s)",
+                 f"allocated blocks delta: {self.allocated_blocks:,}"]
+        if self.traced_peak_bytes is not None:
+            lines.append(f"traced peak: {self.traced_peak_bytes:,} bytes")
+        lines.append(f"{'message':<32}{'count':>10}{'p50 us':>10}{'p90 us':>10}{'p99 us':>10}{'p99.9 us':>10}")
+        counts = {MSG_NAMES.get(msg_id, str(msg_id)): len(lat) for msg_id, lat in self.latencies.items()}
+        for name, pct in sorted(self.percentiles().items()):
+            lines.append(f"{name:<32}{counts[name]:>10}" + ''.join(f"{p:>10.1f}" for p in pct))
+        return '\n'.join(lines)
+
+
+def _split_handshake(records) -> tuple[int, list]:
+    '''
+    Finds the server version reply at the start of the capture. Returns the
+    server version and the records following it, the first one holding any
+    bytes that arrived with the reply.
+    '''
+    buf = b""
+    records = list(records)
+    for i, (t, data) in enumerate(records):
+        buf += data
+        while buf:
+            size, msg, rest = comm.read_msg(buf)
+            if not msg:
+                break
+            buf = rest
+            fields = comm.read_fields(msg)
+            if len(fields) == 2:
+                return int(fields[0]), [(t, buf)] + records[i + 1:]
+    raise ValueError("No server version reply found in the capture")
+
+
+def replay(path: str, wrapper: EWrapper | None = None, realtime: bool = False,
+           trace_allocations: bool = False) -> ReplayReport:
+    '''
+    Feeds a capture through `EReader`, `comm.read_fields` and
+    `Decoder.interpret` into `wrapper` (a `CountingWrapper` by default).
+    '''
+    server_version, records = _split_handshake(read_capture(path))
+    wrapper = wrapper or CountingWrapper()
+    decoder = Decoder(wrapper, server_version)
+    msg_queue = queue.Queue()
+    report = ReplayReport(bytes=sum(len(data) for _, data in records))
+
+    if trace_allocations:
+        tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    reader = EReader(_ReplayConnection(records, realtime), msg_queue)
+    started = time.perf_counter()
+    reader.start()
+    latencies = report.latencies
+    while reader.is_alive() or not msg_queue.empty():
+        try:
+            text = msg_queue.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        t0 = time.perf_counter_ns()
+        fields = comm.read_fields(text)
+        decoder.interpret(fields)
+        latencies[int(fields[0])].append(time.perf_counter_ns() - t0)
+        report.messages += 1
+    report.seconds = time.perf_counter() - started
+    report.allocated_blocks = sys.getallocatedblocks() - blocks
+    if trace_allocations:
+        report.traced_peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if isinstance(wrapper, CountingWrapper):
+        report.callbacks = wrapper.counts
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a wire capture through the ibapi decoder")
+    parser.add_argument('capture', help="capture file written by CapturingClient")
+    parser.add_argument('--realtime', action='store_true', help="replay at the recorded pace")
+    parser.add_argument('--trace-allocations', action='store_true', help="track peak memory with tracemalloc (slower)")
+    args = parser.parse_args()
+    print(replay(args.capture, realtime=args.realtime, trace_allocations=args.trace_allocations))
+
+
+if __name__ == '__main__':
+    main()
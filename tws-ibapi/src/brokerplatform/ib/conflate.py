@@ -0,0 +1,149 @@
+import inspect
+import logging
+import threading
+import time
+from typing import Callable
+
+from ibapi.common import TickAttrib
+from ibapi.wrapper import EWrapper
+
+log = logging.getLogger(__name__)
+
+
+class ConflatingWrapper(EWrapper):
+    """
+    Wraps a message handler and merges `tickPrice`/`tickSize` updates per
+    (reqId, tickType), so only the latest value of each is delivered, once per
+    `interval` seconds or whenever `flush()` is called. Every other callback
+    is forwarded to the handler straight away.
+
+    On delivery, `on_update(reqId, ticks)` gets one call per reqId with
+    `{tickType: value}` for the ticks changed since the last delivery. Without
+    `on_update` the merged ticks are replayed as `tickPrice`/`tickSize` calls
+    on the handler.
+
+    By default delivery happens on the client's thread, like every other
+    callback, so existing handlers work unchanged with fewer calls: incoming
+    messages flush the merged ticks once `interval` has passed since the last
+    delivery, changes at the end of a burst go out with the next message.
+    `start()` delivers every `interval` from a background thread instead,
+    which requires `on_update` and makes it run concurrently with the
+    handler's callbacks.
+
+    `latest[reqId]` always holds the latest value of every tick type seen.
+
+    ```
+    conflator = ConflatingWrapper(Handler(), on_update=strategy.on_quotes, interval=0.1)
+    app = TwsApp(message_handler=conflator)
+    app.start()
+    conflator.start() # optional, or call conflator.poll() from the strategy loop
+    ```
+    """
+
+    def __init__(self, handler: EWrapper, on_update: Callable[[int, dict[int, float]], None] | None = None,
+                 interval: float = 0.1):
+        EWrapper.__init__(self)
+        assert interval > 0, "interval must be greater than 0"
+        self.handler = handler
+        self.on_update = on_update
+        self.interval = interval
+        self.latest: dict[int, dict[int, float]] = {}
+        self.received = 0
+        self.delivered = 0
+        self._pending: dict[int, dict[int, float]] = {}
+        self._attribs: dict[tuple[int, int], TickAttrib] = {}
+        self._sizes: set[tuple[int, int]] = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''Delivers conflated ticks to `on_update` every `interval` seconds from a background thread.'''
+        assert self.on_update, "on_update is required to deliver from a background thread"
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ConflatingWrapper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def poll(self) -> dict[int, dict[int, float]]:
+        '''Takes the ticks changed since the last delivery, `{reqId: {tickType: value}}`, without delivering them.'''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self):
+        '''Delivers the ticks changed since the last delivery, on the calling thread.'''
+        self._last_flush = time.monotonic()
+        for reqId, ticks in self.poll().items():
+            self.delivered += 1
+            if self.on_update:
+                self.on_update(reqId, ticks)
+                continue
+            for tickType, value in ticks.items():
+                if (reqId, tickType) in self._sizes:
+                    self.handler.tickSize(reqId, tickType, value)
+                else:
+                    self.handler.tickPrice(reqId, tickType, value, self._attribs.get((reqId, tickType)))
+
+    ##
+    # EWrapper callbacks, the rest are forwarded to the handler as they are
+    ##
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib: TickAttrib):
+        self._attribs[reqId, tickType] = attrib
+        self._merge(reqId, tickType, price)
+        self._flush_due()
+
+    def tickSize(self, reqId: int, tickType: int, size):
+        self._sizes.add((reqId, tickType))
+        self._merge(reqId, tickType, size)
+        self._flush_due()
+
+    ##
+    # Internals
+    ##
+
+    def _merge(self, reqId: int, tickType: int, value):
+        with self._lock:
+            self.received += 1
+            pending = self._pending.get(reqId)
+            if pending is None:
+                pending = self._pending[reqId] = {}
+            pending[tickType] = value
+            latest = self.latest.get(reqId)
+            if latest is None:
+                latest = self.latest[reqId] = {}
+            latest[tickType] = value
+
+    def _flush_due(self):
+        # On the client's thread, unless a background thread delivers
+        if self._thread is None and time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error delivering conflated ticks")
+
+
+def _forward(name: str):
+    def forward(self, *args, **kwargs):
+        self._flush_due()
+        return getattr(self.handler, name)(*args, **kwargs)
+    forward.__name__ = name
+    return forward
+
+
+for _name, _ in inspect.getmembers(EWrapper, inspect.isfunction):
+    if not _name.startswith('_') and _name not in ('tickPrice', 'tickSize', 'logAnswer'):
+        setattr(ConflatingWrapper, _name, _forward(_name))
@@ -0,0 +1,311 @@
+import datetime as dt
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+from ibapi.contract import Contract, ContractDescription, ContractDetails
+
+from brokerplatform.ib.app import MAX_MESSAGES_PER_SECOND
+from brokerplatform.ib.pacing import is_warning
+
+log = logging.getLogger(__name__)
+
+# Requests in flight at once while preloading
+MAX_PRELOAD_IN_FLIGHT = 20
+# Headroom under the TWS message rate limit for the app's other requests
+PRELOAD_RATE = MAX_MESSAGES_PER_SECOND - 10
+
+
+def contract_key(c: Contract) -> tuple[str, str, str, str]:
+    return (c.symbol, c.secType, c.exchange, c.currency)
+
+
+class _Request:
+    __slots__ = ('query', 'details', 'done', 'error')
+
+    def __init__(self, query: Contract):
+        self.query = query
+        self.details: list[ContractDetails] = []
+        self.done = False
+        self.error = None
+
+
+class ContractMaster:
+    """
+    Local contract master: `ContractDetails` cached by conId, with indexes on
+    (symbol, secType, exchange, currency), localSymbol and expiry, so
+    resolving contracts is a lookup instead of a round trip to the gateway.
+
+    Entries older than `ttl` are stale: `resolve()` fetches them again and
+    `refresh_stale()` re-requests all of them. With `path` the cache is kept on
+    disk across runs (saved after each completed request batch).
+
+    ```
+    master = ContractMaster(app, path='./tmp/contracts.pickle', ttl=dt.timedelta(days=1))
+
+    class Handler(EWrapper):
+        def contractDetails(self, reqId, contractDetails):
+            master.contractDetails(reqId, contractDetails)
+        def contractDetailsEnd(self, reqId):
+            master.contractDetailsEnd(reqId)
+        def symbolSamples(self, reqId, contractDescriptions):
+            master.symbolSamples(reqId, contractDescriptions)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            master.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+
+    master.preload(universe) # list of Contract, requested in parallel
+    master.lookup(symbol='MCL', secType='FUT', exchange='NYMEX', currency='USD')
+    master.resolve(c) # from the cache, or requested and cached
+    ```
+    """
+
+    def __init__(self, app, path: str | None = None, ttl: dt.timedelta = dt.timedelta(days=1),
+                 max_in_flight: int = MAX_PRELOAD_IN_FLIGHT):
+        self.app = app
+        self.path = Path(path) if path else None
+        self.ttl = ttl.total_seconds()
+        self.max_in_flight = max_in_flight
+        self._details: dict[int, ContractDetails] = {}
+        self._fetched: dict[int, float] = {}
+        self._by_key: dict[tuple, set[int]] = defaultdict(set)
+        self._by_local_symbol: dict[str, set[int]] = defaultdict(set)
+        self._by_expiry: dict[str, set[int]] = defaultdict(set)
+        self._requests: dict[int, _Request] = {}
+        self._samples: dict[str, tuple[float, list[ContractDescription]]] = {}
+        self._sample_requests: dict[int, str] = {}
+        self._cond = threading.Condition()
+        if self.path and self.path.exists():
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._details)
+
+    def get(self, conId: int) -> ContractDetails | None:
+        return self._details.get(conId)
+
+    def lookup(self, symbol: str | None = None, secType: str | None = None, exchange: str | None = None,
+               currency: str | None = None, localSymbol: str | None = None, expiry: str | None = None,
+               strike: float | None = None, right: str | None = None) -> list[ContractDetails]:
+        '''
+        Cached contracts matching all the given attributes. `expiry` matches
+        `lastTradeDateOrContractMonth` by prefix, so '202406' matches '20240621'.
+        '''
+        with self._cond:
+            if localSymbol is not None:
+                ids = set(self._by_local_symbol.get(localSymbol, ()))
+            elif None not in (symbol, secType, exchange, currency):
+                ids = set(self._by_key.get((symbol, secType, exchange, currency), ()))
+            else:
+                ids = set(self._details)
+            if expiry is not None and len(expiry) == 8:
+                ids &= self._by_expiry.get(expiry, set())
+            found = [self._details[i] for i in ids]
+        return [d for d in found if _matches(d, symbol, secType, exchange, currency, localSymbol, expiry, strike, right)]
+
+    def find(self, query: Contract) -> list[ContractDetails]:
+        '''Cached contracts matching the set attributes of a query contract.'''
+        if query.conId:
+            d = self._details.get(query.conId)
+            return [d] if d else []
+        return self.lookup(symbol=query.symbol or None, secType=query.secType or None,
+                           exchange=query.exchange or None, currency=query.currency or None,
+                           localSymbol=query.localSymbol or None,
+                           expiry=query.lastTradeDateOrContractMonth or None,
+                           strike=query.strike or None, right=query.right or None)
+
+    def is_stale(self, conId: int) -> bool:
+        fetched = self._fetched.get(conId)
+        return fetched is None or time.time() - fetched > self.ttl
+
+    def resolve(self, query: Contract, timeout: float | None = 10) -> list[ContractDetails]:
+        '''Matching contracts from the cache if fresh, otherwise requested from the gateway.'''
+        found = self.find(query)
+        if found and not any(self.is_stale(d.contract.conId) for d in found):
+            return found
+        self.preload([query], timeout)
+        return self.find(query)
+
+    def preload(self, queries: list[Contract], timeout: float | None = None) -> dict[int, str]:
+        '''
+        Requests contract details for many contracts, `max_in_flight` at a time
+        and within the TWS message rate, then saves the cache. Returns the
+        errors per query index.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        errors = {}
+        pending = deque(enumerate(queries))
+        in_flight: dict[int, int] = {} # reqId -> query index
+        sent = []
+        while pending or in_flight:
+            to_send = []
+            with self._cond:
+                for reqId, i in list(in_flight.items()):
+                    req = self._requests[reqId]
+                    if req.done:
+                        del in_flight[reqId], self._requests[reqId]
+                        if req.error:
+                            errors[i] = req.error
+                while pending and len(in_flight) < self.max_in_flight:
+                    now = time.monotonic()
+                    sent = [t for t in sent if now - t < 1]
+                    if len(sent) >= PRELOAD_RATE:
+                        break
+                    i, query = pending.popleft()
+                    reqId = self.app.nextId
+                    self._requests[reqId] = _Request(query)
+                    in_flight[reqId] = i
+                    sent.append(now)
+                    to_send.append((reqId, query))
+            # Sent without holding the lock, the callbacks need it on the client's thread
+            for reqId, query in to_send:
+                self.app.client.reqContractDetails(reqId, query)
+            with self._cond:
+                if not pending and not in_flight:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    for reqId in in_flight:
+                        self._requests.pop(reqId, None)
+                    raise TimeoutError(f"{len(in_flight) + len(pending)} contract details requests did not complete")
+                if not any(self._requests[reqId].done for reqId in in_flight):
+                    self._cond.wait(0.1 if remaining is None else min(0.1, remaining))
+        log.info(f"Preloaded {len(queries)} contract queries, {len(errors)} failed, {len(self)} contracts cached")
+        if self.path:
+            self.save()
+        return errors
+
+    def refresh_stale(self, timeout: float | None = None) -> dict[int, str]:
+        '''Requests the stale entries again, by conId.'''
+        queries = []
+        for conId in [i for i in list(self._details) if self.is_stale(i)]:
+            c = Contract()
+            c.conId = conId
+            c.exchange = self._details[conId].contract.exchange
+            queries.append(c)
+        return self.preload(queries, timeout) if queries else {}
+
+    def matching_symbols(self, pattern: str, timeout: float | None = 10) -> list[ContractDescription]:
+        '''
+        `reqMatchingSymbols`, cached per pattern for `ttl`. The descriptions
+        are partial contracts, `resolve()` them to get their details.
+        '''
+        cached = self._samples.get(pattern)
+        if cached and time.time() - cached[0] <= self.ttl:
+            return cached[1]
+        reqId = self.app.nextId
+        with self._cond:
+            self._sample_requests[reqId] = pattern
+        self.app.client.reqMatchingSymbols(reqId, pattern)
+        with self._cond:
+            if not self._cond.wait_for(lambda: reqId not in self._sample_requests, timeout):
+                self._sample_requests.pop(reqId, None)
+                raise TimeoutError(f"reqMatchingSymbols('{pattern}') did not complete within {timeout}s")
+        return self._samples[pattern][1] if pattern in self._samples else []
+
+    def add(self, details: ContractDetails, fetched: float | None = None):
+        with self._cond:
+            self._add(details, time.time() if fetched is None else fetched)
+
+    def save(self):
+        '''Writes the cache to `path`, atomically.'''
+        with self._cond:
+            entries = [(d, self._fetched[i]) for i, d in self._details.items()]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            entries = pickle.load(f)
+        with self._cond:
+            for details, fetched in entries:
+                self._add(details, fetched)
+        log.info(f"Loaded {len(entries)} contracts from {self.path}")
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def contractDetails(self, reqId: int, contractDetails: ContractDetails):
+        with self._cond:
+            req = self._requests.get(reqId)
+            self._add(contractDetails, time.time())
+            if req:
+                req.details.append(contractDetails)
+
+    def bondContractDetails(self, reqId: int, contractDetails: ContractDetails):
+        self.contractDetails(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId: int):
+        self._finish(reqId)
+
+    def symbolSamples(self, reqId: int, contractDescriptions: list[ContractDescription]):
+        with self._cond:
+            pattern = self._sample_requests.pop(reqId, None)
+            if pattern is None:
+                return
+            self._samples[pattern] = (time.time(), list(contractDescriptions))
+            self._cond.notify_all()
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        if is_warning(errorCode):
+            return
+        if reqId in self._requests:
+            self._finish(reqId, f"{errorCode}|{errorString}")
+        elif reqId in self._sample_requests:
+            with self._cond:
+                self._sample_requests.pop(reqId, None)
+                self._cond.notify_all()
+
+    ##
+    # Internals
+    ##
+
+    def _add(self, details: ContractDetails, fetched: float):
+        c = details.contract
+        old = self._details.get(c.conId)
+        if old is not None:
+            self._unindex(old)
+        self._details[c.conId] = details
+        self._fetched[c.conId] = fetched
+        self._by_key[contract_key(c)].add(c.conId)
+        if c.primaryExchange and c.primaryExchange != c.exchange:
+            self._by_key[(c.symbol, c.secType, c.primaryExchange, c.currency)].add(c.conId)
+        if c.localSymbol:
+            self._by_local_symbol[c.localSymbol].add(c.conId)
+        if c.lastTradeDateOrContractMonth:
+            self._by_expiry[c.lastTradeDateOrContractMonth].add(c.conId)
+
+    def _unindex(self, details: ContractDetails):
+        c = details.contract
+        self._by_key[contract_key(c)].discard(c.conId)
+        self._by_key[(c.symbol, c.secType, c.primaryExchange, c.currency)].discard(c.conId)
+        self._by_local_symbol[c.localSymbol].discard(c.conId)
+        self._by_expiry[c.lastTradeDateOrContractMonth].discard(c.conId)
+
+    def _finish(self, reqId: int, error: str | None = None):
+        with self._cond:
+            req = self._requests.get(reqId)
+            if req is None:
+                return
+            req.done = True
+            req.error = error
+            self._cond.notify_all()
+
+
+def _matches(d: ContractDetails, symbol, secType, exchange, currency, localSymbol, expiry, strike, right) -> bool:
+    c = d.contract
+    return ((symbol is None or c.symbol == symbol)
+            and (secType is None or c.secType == secType)
+            and (exchange is None or exchange in (c.exchange, c.primaryExchange))
+            and (currency is None or c.currency == currency)
+            and (localSymbol is None or c.localSymbol == localSymbol)
+            and (expiry is None or c.lastTradeDateOrContractMonth.startswith(expiry))
+            and (strike is None or c.strike == strike)
+            and (right is None or c.right == right))
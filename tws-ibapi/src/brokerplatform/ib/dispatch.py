@@ -0,0 +1,146 @@
+import inspect
+import logging
+import queue
+import threading
+
+from ibapi.wrapper import EWrapper
+
+log = logging.getLogger(__name__)
+
+# Handled in order on their own lane, away from market data and history
+ORDER_CALLBACKS = frozenset({
+    'nextValidId', 'openOrder', 'openOrderEnd', 'orderStatus', 'orderBound', 'execDetails',
+    'execDetailsEnd', 'commissionReport', 'completedOrder', 'completedOrdersEnd',
+})
+# First parameter names of the callbacks sharded by request id
+KEY_PARAMS = frozenset({'reqId', 'requestId', 'tickerId'})
+
+ORDER_LANE = -1
+_STOP = object()
+
+
+class _Lane:
+    def __init__(self, name: str):
+        self.name = name
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        get = self.queue.get
+        while True:
+            item = get()
+            if item is _STOP:
+                return
+            method, args, kwargs = item
+            try:
+                method(*args, **kwargs)
+            except Exception:
+                log.exception(f"Unhandled exception in {method.__name__}|lane={self.name}")
+
+
+class DispatchingWrapper(EWrapper):
+    """
+    Sits between the client and the message handler, so callbacks run on
+    worker threads instead of the client's message loop. The loop only decodes
+    and enqueues, and a slow handler no longer holds up every other stream.
+
+    * Callbacks with a request id (`reqId`, `tickerId`, `requestId`) go to one
+      of `workers` lanes, by request id. Callbacks for one request are called
+      in the order they arrived.
+    * Order and execution callbacks (`ORDER_CALLBACKS`) go to a dedicated
+      order lane, as do errors for known order ids and errors without a
+      request id (-1). Order ids are learnt from `openOrder`/`orderStatus`,
+      call `track_order()` when placing an order to also route early rejects.
+    * Everything else (account, positions, news bulletins...) goes to lane 0.
+
+    Handlers now run on several threads at once: state shared across request
+    ids must be thread-safe, state per request id is only touched by one lane.
+
+    ```
+    dispatcher = DispatchingWrapper(Handler(), workers=4)
+    app = TwsApp(message_handler=dispatcher)
+    app.start()
+
+    order_id = app.nextId
+    dispatcher.track_order(order_id)
+    app.client.placeOrder(order_id, contract, order)
+    ...
+    app.stop()
+    dispatcher.stop()
+    ```
+    """
+
+    def __init__(self, handler: EWrapper, workers: int = 4):
+        EWrapper.__init__(self)
+        assert workers > 0, "workers must be greater than 0"
+        self.handler = handler
+        self.workers = workers
+        self._lanes = [_Lane(f"dispatch-{i}") for i in range(workers)]
+        self._order_lane = _Lane('dispatch-orders')
+        self._order_ids: set[int] = set()
+        for lane in self._all_lanes():
+            lane.thread.start()
+
+    def track_order(self, orderId: int):
+        '''Routes errors for orderId to the order lane.'''
+        self._order_ids.add(orderId)
+
+    def lane_of(self, reqId: int) -> int:
+        return reqId % self.workers
+
+    def depths(self) -> dict[str, int]:
+        '''Callbacks waiting per lane.'''
+        return {lane.name: lane.queue.qsize() for lane in self._all_lanes()}
+
+    def stop(self, timeout: float | None = None):
+        '''Lets the lanes run what is already queued, then stops their threads.'''
+        for lane in self._all_lanes():
+            lane.queue.put(_STOP)
+        for lane in self._all_lanes():
+            lane.thread.join(timeout)
+
+    ##
+    # Routing, the EWrapper methods are generated below
+    ##
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        args = (reqId, errorCode, errorString, advancedOrderRejectJson)
+        if reqId in self._order_ids or reqId < 0:
+            self._order_lane.queue.put((self.handler.error, args, {}))
+        else:
+            self._lanes[reqId % self.workers].queue.put((self.handler.error, args, {}))
+
+    def _all_lanes(self) -> list[_Lane]:
+        return self._lanes + [self._order_lane]
+
+    def _to_order_lane(self, name: str, args: tuple, kwargs: dict):
+        if name in ('openOrder', 'orderStatus'):
+            self._order_ids.add(args[0])
+        self._order_lane.queue.put((getattr(self.handler, name), args, kwargs))
+
+    def _to_keyed_lane(self, name: str, args: tuple, kwargs: dict):
+        self._lanes[args[0] % self.workers].queue.put((getattr(self.handler, name), args, kwargs))
+
+    def _to_lane_0(self, name: str, args: tuple, kwargs: dict):
+        self._lanes[0].queue.put((getattr(self.handler, name), args, kwargs))
+
+
+def _route(name: str, first_param: str | None):
+    if name in ORDER_CALLBACKS:
+        target = DispatchingWrapper._to_order_lane
+    elif first_param in KEY_PARAMS:
+        target = DispatchingWrapper._to_keyed_lane
+    else:
+        target = DispatchingWrapper._to_lane_0
+
+    def dispatch(self, *args, **kwargs):
+        target(self, name, args, kwargs)
+    dispatch.__name__ = name
+    return dispatch
+
+
+for _name, _func in inspect.getmembers(EWrapper, inspect.isfunction):
+    if _name.startswith('_') or _name in ('error', 'logAnswer'):
+        continue
+    _params = list(inspect.signature(_func).parameters)[1:]
+    setattr(DispatchingWrapper, _name, _route(_name, _params[0] if _params else None))
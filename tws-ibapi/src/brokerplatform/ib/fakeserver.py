@@ -0,0 +1,358 @@
+"""
+A local stand-in for TWS/IB Gateway, for load, latency and reconnect testing
+without a network or an IB account.
+
+It performs the `API\\0` + version handshake, answers `startApi` with
+`nextValidId` and `managedAccounts`, then serves synthetic data:
+
+* `reqContractDetails`: one `contractDetails` echoing the requested contract, then `contractDetailsEnd`.
+* `reqHistoricalData`: `history_bars` random walk bars (epoch dates, as with `formatDate=2`).
+* `reqMktData`: bid/ask/last ticks at `tick_rate` messages per second per subscription.
+* `reqMktDepth`: depth updates at `depth_rate` messages per second per subscription.
+* `placeOrder`/`cancelOrder`: `Submitted`, then `Filled` after `fill_delay` seconds, or `Cancelled`.
+
+Anything else can be scripted by passing `handlers`, a dict of `OUT` message
+id -> `handler(session, fields)`, and pushed with `FakeTwsSession.send()`.
+
+```
+server = FakeTwsServer(port=0, tick_rate=100_000)
+server.start_in_thread()
+app = TwsApp(message_handler=handler, port=server.port)
+app.start()
+...
+server.drop_connections() # e.g. to test reconnecting
+server.stop()
+```
+
+Or standalone: `python -m brokerplatform.ib.fakeserver --port 4002 --tick-rate 10000`
+"""
+import argparse
+import asyncio
+import datetime as dt
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+from ibapi import comm
+from ibapi.message import IN, OUT
+from ibapi.server_versions import MAX_CLIENT_VER
+from ibapi.ticktype import TickTypeEnum
+
+from brokerplatform.ib.app import IBAPI_HOST
+
+log = logging.getLogger(__name__)
+
+SERVER_VERSION = MAX_CLIENT_VER
+API_PREFIX = b"API\0"
+# Shortest sleep between batches of streamed messages, higher rates send several per batch
+MIN_INTERVAL = 0.001
+
+
+def encode(*fields) -> bytes:
+    '''Frames one message the way TWS sends it.'''
+    return comm.make_msg(''.join(comm.make_field(f) for f in fields))
+
+
+class FakeTwsSession:
+    '''One client connection, see `FakeTwsServer`.'''
+
+    def __init__(self, server: 'FakeTwsServer', reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.messages_sent = 0
+        self._streams: dict[int, asyncio.Task] = {}
+        self._order_ids = itertools.count(1)
+
+    def send(self, *fields):
+        self.writer.write(encode(*fields))
+        self.messages_sent += 1
+
+    def close(self):
+        for task in self._streams.values():
+            task.cancel()
+        self._streams.clear()
+        self.writer.close()
+
+    async def serve(self):
+        peer = self.writer.get_extra_info('peername')
+        try:
+            if not await self._handshake():
+                return
+            log.info(f"Client connected|peer={peer}|clientId={self.client_id}")
+            buf = b""
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                buf += data
+                while True:
+                    size, msg, buf = comm.read_msg(buf)
+                    if not msg:
+                        break
+                    self._dispatch(comm.read_fields(msg))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            log.info(f"Client disconnected|peer={peer}|clientId={self.client_id}|sent={self.messages_sent}")
+            self.close()
+            self.server.sessions.discard(self)
+
+    ##
+    # Internals
+    ##
+
+    async def _handshake(self) -> bool:
+        if await self.reader.readexactly(len(API_PREFIX)) != API_PREFIX:
+            return False
+        size = int.from_bytes(await self.reader.readexactly(4), 'big')
+        versions = (await self.reader.readexactly(size)).decode()
+        log.debug(f"Handshake|versions={versions}")
+        now = dt.datetime.now(dt.UTC).strftime('%Y%m%d %H:%M:%S UTC')
+        self.send(SERVER_VERSION, now)
+        await self.writer.drain()
+        return True
+
+    def _dispatch(self, fields: tuple[bytes, ...]):
+        msg_id = int(fields[0])
+        handler = self.server.handlers.get(msg_id) or _HANDLERS.get(msg_id)
+        if handler is None:
+            log.debug(f"Ignoring message|id={msg_id}")
+            return
+        handler(self, fields)
+
+    def _stream(self, reqId: int, rate: float, make: Callable[[], tuple]):
+        '''Sends `make()` messages for reqId at `rate` per second until cancelled.'''
+        async def run():
+            loop = asyncio.get_running_loop()
+            start, sent = loop.time(), 0
+            interval = max(1 / rate, MIN_INTERVAL)
+            while True:
+                due = int((loop.time() - start) * rate) + 1 - sent
+                for _ in range(due):
+                    self.send(*make())
+                sent += due
+                await self.writer.drain()
+                await asyncio.sleep(interval)
+        self._cancel(reqId)
+        self._streams[reqId] = asyncio.create_task(run())
+
+    def _cancel(self, reqId: int):
+        task = self._streams.pop(reqId, None)
+        if task:
+            task.cancel()
+
+    def _start_api(self, fields):
+        self.client_id = int(fields[2])
+        self.send(IN.NEXT_VALID_ID, 1, next(self._order_ids))
+        self.send(IN.MANAGED_ACCTS, 1, self.server.accounts)
+
+    def _req_ids(self, fields):
+        self.send(IN.NEXT_VALID_ID, 1, next(self._order_ids))
+
+    def _req_current_time(self, fields):
+        self.send(IN.CURRENT_TIME, 1, int(time.time()))
+
+    def _req_contract_details(self, fields):
+        reqId = int(fields[2])
+        conId, symbol, secType, expiry, strike, right, multiplier, exchange, primary, currency, local = \
+            (f.decode() for f in fields[3:14])
+        conId = int(conId) or 100000 + reqId
+        self.send(IN.CONTRACT_DATA, reqId, symbol, secType, expiry, expiry, strike, right, exchange or 'SMART',
+                  currency or 'USD', local or symbol, symbol, symbol, conId, 0.01, multiplier,
+                  'LMT,MKT,STP', 'SMART,' + (primary or 'NYSE'), 1, 0, f"{symbol} Fake", primary,
+                  '', '', '', '', 'US/Eastern', '', '', '', 0, 0, 1, '', '', '26', expiry, 'COMMON',
+                  1, 1, 1)
+        self.send(IN.CONTRACT_DATA_END, 1, reqId)
+
+    def _req_historical_data(self, fields):
+        reqId = int(fields[1])
+        n = self.server.history_bars
+        end = int(time.time()) // 60 * 60
+        price = 100.0
+        bars = []
+        for t in range(end - 60 * n, end, 60):
+            o = price
+            c = price = max(0.01, price + self.server.random.gauss(0, 0.1))
+            h, l = max(o, c) + 0.05, min(o, c) - 0.05
+            bars += [t, round(o, 2), round(h, 2), round(l, 2), round(c, 2), 100, round((o + c) / 2, 4), 10]
+        start_str = dt.datetime.fromtimestamp(end - 60 * n, dt.UTC).strftime('%Y%m%d %H:%M:%S UTC')
+        end_str = dt.datetime.fromtimestamp(end, dt.UTC).strftime('%Y%m%d %H:%M:%S UTC')
+        self.send(IN.HISTORICAL_DATA, reqId, start_str, end_str, n, *bars)
+
+    def _req_mkt_data(self, fields):
+        reqId = int(fields[2])
+        rnd = self.server.random
+        price = [100.0]
+        types = itertools.cycle((TickTypeEnum.BID, TickTypeEnum.ASK, TickTypeEnum.LAST))
+        def tick():
+            tick_type = next(types)
+            if tick_type == TickTypeEnum.LAST:
+                price[0] = max(0.01, price[0] + rnd.gauss(0, 0.01))
+            offset = {TickTypeEnum.BID: -0.01, TickTypeEnum.ASK: 0.01}.get(tick_type, 0.0)
+            return IN.TICK_PRICE, 6, reqId, tick_type, round(price[0] + offset, 2), rnd.randint(1, 500), 0
+        self._stream(reqId, self.server.tick_rate, tick)
+
+    def _req_mkt_depth(self, fields):
+        reqId = int(fields[2])
+        rnd = self.server.random
+        rows = self.server.depth_rows
+        filled = [0, 0]
+        def update():
+            side = rnd.randint(0, 1)
+            position = rnd.randrange(rows)
+            operation = 1 if position < filled[side] else 0
+            if operation == 0:
+                position = filled[side]
+                filled[side] += 1
+            price = 100.0 + (position + 1) * 0.01 * (1 if side == 0 else -1)
+            return IN.MARKET_DEPTH, 1, reqId, position, operation, side, round(price, 2), rnd.randint(1, 1000)
+        self._stream(reqId, self.server.depth_rate, update)
+
+    def _cancel_stream(self, fields):
+        self._cancel(int(fields[2]))
+
+    def _place_order(self, fields):
+        orderId, quantity = int(fields[1]), fields[17].decode()
+        permId = 1_000_000 + orderId
+        self.send(IN.ORDER_STATUS, orderId, 'Submitted', 0, quantity, 0.0, permId, 0, 0.0, self.client_id, '', 0.0)
+        async def fill():
+            await asyncio.sleep(self.server.fill_delay)
+            self.send(IN.ORDER_STATUS, orderId, 'Filled', quantity, 0, 100.0, permId, 0, 100.0,
+                      self.client_id, '', 0.0)
+            await self.writer.drain()
+        self._streams[-orderId] = asyncio.create_task(fill())
+
+    def _cancel_order(self, fields):
+        orderId = int(fields[2])
+        self._cancel(-orderId)
+        self.send(IN.ORDER_STATUS, orderId, 'Cancelled', 0, 0, 0.0, 1_000_000 + orderId, 0, 0.0,
+                  self.client_id, '', 0.0)
+
+
+_HANDLERS = {
+    OUT.START_API: FakeTwsSession._start_api,
+    OUT.REQ_IDS: FakeTwsSession._req_ids,
+    OUT.REQ_CURRENT_TIME: FakeTwsSession._req_current_time,
+    OUT.REQ_CONTRACT_DATA: FakeTwsSession._req_contract_details,
+    OUT.REQ_HISTORICAL_DATA: FakeTwsSession._req_historical_data,
+    OUT.REQ_MKT_DATA: FakeTwsSession._req_mkt_data,
+    OUT.CANCEL_MKT_DATA: FakeTwsSession._cancel_stream,
+    OUT.REQ_MKT_DEPTH: FakeTwsSession._req_mkt_depth,
+    OUT.CANCEL_MKT_DEPTH: FakeTwsSession._cancel_stream,
+    OUT.PLACE_ORDER: FakeTwsSession._place_order,
+    OUT.CANCEL_ORDER: FakeTwsSession._cancel_order,
+}
+
+
+class FakeTwsServer:
+    """
+    asyncio server speaking enough of the TWS API protocol to drive `TwsApp`,
+    see the module docstring. Use `port=0` to pick a free port, read it back
+    from `port` once started.
+
+    Run it on an existing event loop with `await server.start()`, or on its own
+    thread with `start_in_thread()` when the test code is blocking.
+    """
+
+    def __init__(self, host: str = IBAPI_HOST, port: int = 0, tick_rate: float = 10.0,
+                 depth_rate: float = 10.0, depth_rows: int = 10, history_bars: int = 100,
+                 fill_delay: float = 0.0, accounts: str = 'DU0000000',
+                 handlers: dict[int, Callable[[FakeTwsSession, tuple], None]] | None = None,
+                 seed: int | None = None):
+        assert tick_rate > 0 and depth_rate > 0, "rates must be greater than 0"
+        self.host = host
+        self.port = port
+        self.tick_rate = tick_rate
+        self.depth_rate = depth_rate
+        self.depth_rows = depth_rows
+        self.history_bars = history_bars
+        self.fill_delay = fill_delay
+        self.accounts = accounts
+        self.handlers = handlers or {}
+        self.random = random.Random(seed)
+        self.sessions: set[FakeTwsSession] = set()
+        self._tasks: set[asyncio.Task] = set() # connection handlers
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info(f"Fake TWS listening on {self.host}:{self.port}")
+
+    async def close(self):
+        '''Closes the connections and waits for their tasks to finish.'''
+        self._server.close()
+        streams = set()
+        for session in list(self.sessions):
+            streams.update(session._streams.values())
+            session.close() # cancels its streams, the handler then reads EOF and returns
+        await asyncio.gather(*streams, *self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start_in_thread(self):
+        '''Runs the server on its own event loop thread, returns once it is listening.'''
+        ready = threading.Event()
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.close())
+            loop.close()
+        self._thread = threading.Thread(target=run, name='FakeTwsServer', daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        '''Stops a server started with `start_in_thread()`.'''
+        if self._thread:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def drop_connections(self):
+        '''Closes every client connection, as a gateway restart would.'''
+        def drop():
+            for session in list(self.sessions):
+                session.close()
+        self._loop.call_soon_threadsafe(drop)
+
+    async def _accept(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        session = FakeTwsSession(self, reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.serve()
+        finally:
+            self._tasks.discard(task)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake TWS/IB Gateway")
+    parser.add_argument('--host', default=IBAPI_HOST)
+    parser.add_argument('--port', type=int, default=4002)
+    parser.add_argument('--tick-rate', type=float, default=10.0, help="ticks per second per reqMktData")
+    parser.add_argument('--depth-rate', type=float, default=10.0, help="updates per second per reqMktDepth")
+    parser.add_argument('--history-bars', type=int, default=100)
+    parser.add_argument('--fill-delay', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = FakeTwsServer(host=args.host, port=args.port, tick_rate=args.tick_rate, depth_rate=args.depth_rate,
+                           history_bars=args.history_bars, fill_delay=args.fill_delay)
+    async def serve():
+        await server.start()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from ibapi.ticktype import TickTypeEnum
+
+from brokerplatform.ib.history import iso_date
+from brokerplatform.ib.options import OptionChain
+
+GREEKS_FIELDS = ['impliedVol', 'delta', 'optPrice', 'pvDividend', 'gamma', 'vega', 'theta', 'undPrice', 'updated']
+# Computation slots per option, delayed ticks land in the same slots as live ones
+BID, ASK, LAST, MODEL = 0, 1, 2, 3
+SLOTS = 4
+_TICK_SLOTS = {
+    TickTypeEnum.BID_OPTION_COMPUTATION: BID,
+    TickTypeEnum.ASK_OPTION_COMPUTATION: ASK,
+    TickTypeEnum.LAST_OPTION_COMPUTATION: LAST,
+    TickTypeEnum.MODEL_OPTION: MODEL,
+    TickTypeEnum.DELAYED_BID_OPTION: BID,
+    TickTypeEnum.DELAYED_ASK_OPTION: ASK,
+    TickTypeEnum.DELAYED_LAST_OPTION: LAST,
+    TickTypeEnum.DELAYED_MODEL_OPTION: MODEL,
+}
+_F = {name: i for i, name in enumerate(GREEKS_FIELDS)}
+
+
+class GreeksSnapshot:
+    """
+    Consistent copy of a `GreeksSurface`, with vectorized risk queries.
+    `values[row, slot, field]` follows `GREEKS_FIELDS`, NaN where not computed.
+    """
+
+    def __init__(self, version: int, rows: np.ndarray, values: np.ndarray):
+        self.version = version
+        self.conId = rows['conId']
+        self.expiry = rows['expiry']
+        self.strike = rows['strike']
+        self.right = rows['right']
+        self.multiplier = rows['multiplier']
+        self.position = rows['position']
+        self.values = values
+
+    def field(self, name: str, slot: int = MODEL) -> np.ndarray:
+        return self.values[:, slot, _F[name]]
+
+    def portfolio_delta(self, slot: int = MODEL) -> float:
+        '''Delta of the positions, in underlying units.'''
+        return float(np.nansum(self.field('delta', slot) * self.position * self.multiplier))
+
+    def portfolio_greeks(self, slot: int = MODEL) -> dict[str, float]:
+        weight = self.position * self.multiplier
+        return {name: float(np.nansum(self.field(name, slot) * weight)) for name in ('delta', 'gamma', 'vega', 'theta')}
+
+    def by_expiry(self, name: str = 'vega', slot: int = MODEL) -> pd.Series:
+        '''A Greek of the positions summed per expiry, e.g. vega per expiry.'''
+        expiries, idx = np.unique(self.expiry, return_inverse=True)
+        weighted = np.nan_to_num(self.field(name, slot) * self.position * self.multiplier)
+        return pd.Series(np.bincount(idx, weights=weighted, minlength=len(expiries)), index=expiries, name=name)
+
+    def smile(self, expiry, right: str | None = None, slot: int = MODEL) -> pd.Series:
+        '''Implied volatility by strike for one expiry ('YYYYMMDD' or 'YYYY-MM-DD'), calls and puts unless `right` is given.'''
+        mask = self.expiry == np.datetime64(iso_date(str(expiry)), 'D')
+        if right is not None:
+            mask &= self.right == right
+        iv = self.field('impliedVol', slot)[mask]
+        strikes = self.strike[mask]
+        order = np.argsort(strikes, kind='stable')
+        s = pd.Series(iv[order], index=strikes[order], name='impliedVol')
+        return s[~np.isnan(s.values)]
+
+    def frame(self, slot: int = MODEL) -> pd.DataFrame:
+        df = pd.DataFrame({'conId': self.conId, 'expiry': self.expiry, 'strike': self.strike, 'right': self.right,
+                           'position': self.position})
+        for name in GREEKS_FIELDS:
+            df[name] = self.field(name, slot)
+        return df
+
+
+ROW_DTYPE = np.dtype([('conId', '<i8'), ('expiry', 'datetime64[D]'), ('strike', '<f8'), ('right', 'U1'),
+                      ('multiplier', '<f8'), ('position', '<f8')])
+
+
+class GreeksSurface:
+    """
+    Latest `tickOptionComputation` values per option and computation tick
+    type (bid/ask/last/model), in preallocated NumPy columns with one row per
+    subscription. Risk is aggregated on `snapshot()`s with array operations.
+
+    Each row has a sequence number used as a seqlock (odd while the row is
+    being written), and `version` counts updates, so a reader can tell if
+    anything changed since its last snapshot without copying.
+
+    Each conId has at most one row. `remove()`/`remove_chain()` free the rows
+    of cancelled subscriptions for reuse, e.g. before adding a refreshed chain
+    under new reqIds.
+
+    ```
+    surface = GreeksSurface(capacity=2000)
+
+    class Handler(EWrapper):
+        def tickOptionComputation(self, reqId, tickType, tickAttrib, impliedVol, delta, optPrice, pvDividend, gamma, vega, theta, undPrice):
+            surface.tickOptionComputation(reqId, tickType, tickAttrib, impliedVol, delta, optPrice, pvDividend, gamma, vega, theta, undPrice)
+
+    for expiry, strike, right, conId in chain.table:
+        req_id = app.nextId
+        surface.add(req_id, conId, expiry, strike, right, multiplier=100)
+        app.client.reqMktData(req_id, chain.details[conId].contract, '', False, False, [])
+    surface.set_position(conId, -10)
+    ...
+    snap = surface.snapshot()
+    snap.portfolio_delta(), snap.by_expiry('vega'), snap.smile('2024-06-21', 'C')
+    ...
+    for req_id in surface.remove_chain(req_ids):
+        app.client.cancelMktData(req_id)
+    ```
+    """
+
+    def __init__(self, capacity: int = 2000):
+        assert capacity > 0, "capacity must be greater than 0"
+        self.capacity = capacity
+        self._meta = np.zeros(capacity, dtype=ROW_DTYPE)
+        self._values = np.full((capacity, SLOTS, len(GREEKS_FIELDS)), np.nan)
+        self._seq = np.zeros(capacity, dtype=np.int64)
+        self._rows: dict[int, int] = {}
+        self._by_conId: dict[int, int] = {}
+        self._n = 0 # rows ever used, freed ones are reused first
+        self._free: list[int] = []
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def add(self, reqId: int, conId: int, expiry, strike: float, right: str, multiplier: float = 100.0) -> int:
+        '''
+        Assigns a row to an option's market data subscription, before
+        requesting it. A conId already on the surface under another reqId is
+        rejected, `remove()` it first.
+        '''
+        assert conId, "conId must be set"
+        with self._lock:
+            if reqId in self._rows:
+                return self._rows[reqId]
+            if conId in self._by_conId:
+                raise ValueError(f"conId {conId} is already on the surface, remove its subscription first")
+            if self._free:
+                row = self._free.pop()
+            elif self._n < self.capacity:
+                row = self._n
+                self._n += 1
+            else:
+                raise OverflowError(f"All {self.capacity} Greeks rows are in use")
+            self._write_row(row, (conId, np.datetime64(expiry, 'D'), strike, right, multiplier, 0.0))
+            self._rows[reqId] = row
+            self._by_conId[conId] = row
+            return row
+
+    def add_chain(self, chain: OptionChain, req_ids, multiplier: float = 100.0):
+        '''Adds a row per chain contract, `req_ids` in the order of `chain.table`.'''
+        for reqId, (expiry, strike, right, conId) in zip(req_ids, chain.table):
+            self.add(reqId, int(conId), expiry, float(strike), str(right), multiplier)
+
+    def remove(self, reqId: int) -> bool:
+        '''Frees a subscription's row for reuse, after cancelling its market data.'''
+        with self._lock:
+            row = self._rows.pop(reqId, None)
+            if row is None:
+                return False
+            del self._by_conId[int(self._meta['conId'][row])]
+            self._write_row(row, (0, np.datetime64('NaT'), np.nan, '', 0.0, 0.0))
+            self._free.append(row)
+            return True
+
+    def remove_chain(self, req_ids) -> list[int]:
+        '''Frees the rows of several subscriptions, returns the reqIds that were on the surface.'''
+        return [reqId for reqId in req_ids if self.remove(reqId)]
+
+    def set_position(self, conId: int, position: float):
+        row = self._by_conId.get(conId)
+        if row is None:
+            raise KeyError(f"conId {conId} is not on the surface")
+        seq = self._seq
+        seq[row] += 1
+        self._meta['position'][row] = position
+        seq[row] += 1
+        self.version += 1
+
+    def snapshot(self) -> GreeksSnapshot:
+        '''Consistent copy of all rows, rows being written meanwhile are copied again.'''
+        n = self._n
+        version = self.version
+        before = self._seq[:n].copy()
+        meta, values = self._meta[:n].copy(), self._values[:n].copy()
+        torn = np.flatnonzero((before != self._seq[:n]) | (before & 1))
+        for row in torn:
+            meta[row], values[row] = self._read_row(row)
+        used = meta['conId'] != 0 # freed rows have no conId
+        return GreeksSnapshot(version, meta[used], values[used])
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def tickOptionComputation(self, reqId: int, tickType: int, tickAttrib: int, impliedVol: float, delta: float,
+                              optPrice: float, pvDividend: float, gamma: float, vega: float, theta: float,
+                              undPrice: float):
+        row = self._rows.get(reqId)
+        slot = _TICK_SLOTS.get(tickType)
+        if row is None or slot is None:
+            return
+        # The decoder passes None for "not computed"
+        values = [np.nan if v is None else v
+                  for v in (impliedVol, delta, optPrice, pvDividend, gamma, vega, theta, undPrice)]
+        values.append(time.time())
+        seq = self._seq
+        seq[row] += 1
+        self._values[row, slot] = values
+        seq[row] += 1
+        self.version += 1
+
+    ##
+    # Internals
+    ##
+
+    def _write_row(self, row: int, meta: tuple):
+        seq = self._seq
+        seq[row] += 1
+        self._meta[row] = meta
+        self._values[row] = np.nan
+        seq[row] += 1
+        self.version += 1
+
+    def _read_row(self, row: int):
+        seq = self._seq
+        while True:
+            s = seq[row]
+            if s & 1:
+                continue # write in progress
+            meta, values = self._meta[row].copy(), self._values[row].copy()
+            if seq[row] == s:
+                return meta, values
@@ -0,0 +1,156 @@
+import datetime as dt
+import logging
+import threading
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from ibapi.common import BarData
+from ibapi.contract import Contract
+
+from brokerplatform.barstore import BarStore
+
+log = logging.getLogger(__name__)
+
+OHLCV_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# `source` of IB bars in a `BarStore`
+IB_SOURCE = 'ib'
+
+
+def bar_epoch(date: str) -> int:
+    '''
+    Epoch seconds of a bar requested with `formatDate=2`. Daily and longer bars
+    still come back as `yyyymmdd`, those are taken as midnight UTC.
+    '''
+    if len(date) == 8:
+        return int(dt.datetime.strptime(date, '%Y%m%d').replace(tzinfo=dt.UTC).timestamp())
+    return int(date)
+
+
+def utc(d: dt.datetime) -> dt.datetime:
+    '''`d` in UTC, naive datetimes are taken to be in UTC already.'''
+    return d.replace(tzinfo=dt.UTC) if d.tzinfo is None else d.astimezone(dt.UTC)
+
+
+def iso_date(expiry: str) -> str:
+    '''`yyyy-mm-dd` of an IB `yyyymmdd` date (e.g. `lastTradeDateOrContractMonth`), ISO dates are kept.'''
+    return expiry if '-' in expiry else f"{expiry[:4]}-{expiry[4:6]}-{expiry[6:8]}"
+
+
+def store_symbol(contract: Contract, what_to_show: str) -> str:
+    '''Names an IB series in a `BarStore`, bars of another `whatToShow` are a different series.'''
+    c = contract
+    parts = [c.symbol, c.secType, c.exchange, c.currency, c.lastTradeDateOrContractMonth, what_to_show]
+    return '-'.join(p for p in parts if p)
+
+
+def empty_columns() -> dict[str, np.ndarray]:
+    return {col: np.empty(0, dtype=np.int64 if col == 'time' else np.float64) for col in ['time'] + OHLCV_COLUMNS}
+
+
+def to_frame(columns: dict[str, np.ndarray], tz=dt.UTC) -> pd.DataFrame:
+    '''
+    OHLCV frame in the `divdetect.get_ohlcv` layout, from epoch second `time`
+    and OHLCV columns. The index is converted to `tz` in one vectorized step.
+    '''
+    idx = pd.to_datetime(columns['time'], unit='s', utc=True).tz_convert(tz)
+    return pd.DataFrame({col: columns[col] for col in OHLCV_COLUMNS}, index=idx)
+
+
+class HistoricalDataCollector:
+    """
+    Collects `historicalData` bars per reqId, for any number of concurrent
+    requests, and turns each request into a DataFrame at `historicalDataEnd`.
+
+    Bars are buffered as raw epoch ints and floats, timezone conversion and
+    DataFrame construction happen once per request. Requests must use
+    `formatDate=2` (epoch).
+
+    ```
+    class Handler(EWrapper):
+        def __init__(self):
+            EWrapper.__init__(self)
+            self.hist_data = HistoricalDataCollector(tz=pytz.timezone('Asia/Jakarta'))
+        def historicalData(self, reqId, bar):
+            self.hist_data.historicalData(reqId, bar)
+        def historicalDataEnd(self, reqId, start, end):
+            self.hist_data.historicalDataEnd(reqId, start, end)
+
+    req_id = app.nextId
+    app.client.reqHistoricalData(reqId=req_id, ..., formatDate=2, ...)
+    df = handler.hist_data.pop(req_id, timeout=10)
+    ```
+
+    Supply `on_complete(reqId, df)` to be called (on the client's thread) as
+    each request completes instead of keeping the frames for `pop()`.
+
+    With a `store`, the bars of the requests registered with `store_as()`
+    are also appended to it as they complete:
+
+    ```
+    collector = HistoricalDataCollector(store=BarStore('../tmp/bars'))
+    req_id = app.nextId
+    collector.store_as(req_id, store_symbol(contract, 'TRADES'), '1 min')
+    app.client.reqHistoricalData(reqId=req_id, ..., barSizeSetting='1 min', whatToShow='TRADES', formatDate=2, ...)
+    ```
+    """
+
+    def __init__(self, tz=dt.UTC, on_complete: Callable[[int, pd.DataFrame], None] | None = None,
+                 store: BarStore | None = None):
+        self.tz = tz
+        self.on_complete = on_complete
+        self.store = store
+        self._series: dict[int, tuple[str, str]] = {} # reqId -> (symbol, bar size) in the store
+        self._rows: dict[int, list] = {}
+        self._frames: dict[int, pd.DataFrame] = {}
+        self._cond = threading.Condition()
+
+    def historicalData(self, reqId: int, bar: BarData):
+        rows = self._rows.get(reqId)
+        if rows is None:
+            rows = self._rows[reqId] = []
+        rows.append((bar_epoch(bar.date), bar.open, bar.high, bar.low, bar.close, float(bar.volume)))
+
+    def historicalDataEnd(self, reqId: int, start: str, end: str):
+        log.debug(f"[HistoricalDataEnd] reqId={reqId}|start={start}|end={end}|bars={len(self._rows.get(reqId, []))}")
+        df = to_frame(self.take_columns(reqId), self.tz)
+        series = self._series.pop(reqId, None)
+        if series is not None and self.store is not None:
+            self.store.append(IB_SOURCE, *series, df)
+        if self.on_complete:
+            self.on_complete(reqId, df)
+            return
+        with self._cond:
+            self._frames[reqId] = df
+            self._cond.notify_all()
+
+    def store_as(self, reqId: int, symbol: str, bar_size: str):
+        '''Appends the request's bars to the `store` as `symbol` (see `store_symbol()`) and `bar_size`.'''
+        assert self.store is not None, "no store to write to"
+        self._series[reqId] = (symbol, bar_size)
+
+    def take_columns(self, reqId: int) -> dict[str, np.ndarray]:
+        '''Removes and returns the buffered bars of a request as `time` + OHLCV columns.'''
+        rows = self._rows.pop(reqId, None)
+        if not rows:
+            return empty_columns()
+        arr = np.array(rows, dtype=np.float64)
+        columns = {'time': arr[:, 0].astype(np.int64)}
+        for i, col in enumerate(OHLCV_COLUMNS, start=1):
+            columns[col] = arr[:, i].copy()
+        return columns
+
+    def discard(self, reqId: int):
+        '''Drops anything buffered for a request, e.g. after an error.'''
+        self._rows.pop(reqId, None)
+        self._series.pop(reqId, None)
+        with self._cond:
+            self._frames.pop(reqId, None)
+
+    def pop(self, reqId: int, timeout: float | None = None) -> pd.DataFrame | None:
+        '''Waits for a request to complete and returns its frame, None on timeout.'''
+        with self._cond:
+            if not self._cond.wait_for(lambda: reqId in self._frames, timeout):
+                return None
+            return self._frames.pop(reqId)
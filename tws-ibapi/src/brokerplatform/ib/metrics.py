@@ -0,0 +1,320 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from ibapi import comm
+from ibapi.client import EClient
+from ibapi.const import MAX_MSG_LEN, NO_VALID_ID
+from ibapi.errors import BAD_LENGTH
+from ibapi.utils import BadMessage
+
+from brokerplatform.ib.capture import MSG_NAMES
+
+log = logging.getLogger(__name__)
+
+# Histogram resolution: 2**SUB_BITS linear sub-buckets per power of two, ~3% relative error
+SUB_BITS = 6
+MAX_VALUE_BITS = 40 # ~18 minutes in ns, larger values are clamped
+_SUB = 1 << SUB_BITS
+_HALF = _SUB >> 1
+N_BUCKETS = _SUB + (MAX_VALUE_BITS - SUB_BITS) * _HALF
+_MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+
+
+def _bucket(value: int) -> int:
+    if value < _SUB:
+        return value if value > 0 else 0
+    if value > _MAX_VALUE:
+        value = _MAX_VALUE
+    shift = value.bit_length() - SUB_BITS
+    return _SUB + (shift - 1) * _HALF + (value >> shift) - _HALF
+
+
+def _bucket_upper_bounds() -> np.ndarray:
+    idx = np.arange(N_BUCKETS, dtype=np.int64)
+    k = np.maximum(idx - _SUB, 0)
+    shift = k // _HALF + 1
+    sub = k % _HALF + _HALF
+    return np.where(idx < _SUB, idx, ((sub + 1) << shift) - 1)
+
+
+_UPPER_BOUNDS = _bucket_upper_bounds()
+
+
+class Histogram:
+    """
+    Fixed-memory HDR-style histogram of non-negative integer values (ns here):
+    log2 buckets split into linear sub-buckets, so recording is O(1) and the
+    relative error of percentiles is bounded (~3%) over the whole range.
+
+    Recording is meant for a single thread. Reads from other threads are not
+    locked and may be off by the values being recorded concurrently.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(N_BUCKETS, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        self.counts[_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> int:
+        '''Highest value equivalent to the q-th percentile (0-100), 0 when empty.'''
+        return int(self.percentiles([q])[0])
+
+    def percentiles(self, qs) -> np.ndarray:
+        counts = self.counts.copy()
+        n = counts.sum()
+        if n == 0:
+            return np.zeros(len(qs), dtype=np.int64)
+        cum = np.cumsum(counts)
+        ranks = np.maximum(np.ceil(np.asarray(qs, dtype=np.float64) / 100 * n), 1)
+        return np.minimum(_UPPER_BOUNDS[np.searchsorted(cum, ranks)], self.max)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        self.counts.fill(0)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+class LatencyMetrics:
+    """
+    Latency histograms per incoming message id, for the three stages of the
+    client's message loop:
+
+    * `queue_wait`: from `EReader` putting the message on `EClient.msg_queue` to the loop taking it.
+    * `decode`: `Decoder.interpret`, excluding the wrapper callbacks.
+    * `callback`: time spent in the wrapper callbacks (the strategy code), per message.
+
+    Plus the received bytes and the queue depth, see `snapshot()` and
+    `prometheus_text()`. Filled in by `InstrumentedClient`.
+
+    Set `slow_callback` (seconds) to log the callbacks slower than that, as
+    they hold up every message queued behind them. Set `enabled = False` to
+    stop recording without replacing the client.
+    """
+
+    STAGES = ('queue_wait', 'decode', 'callback')
+
+    def __init__(self, slow_callback: float | None = None):
+        self.enabled = True
+        self.slow_callback_ns = int(slow_callback * 1e9) if slow_callback else None
+        self.histograms: dict[str, dict[int, Histogram]] = {
+            stage: collections.defaultdict(Histogram) for stage in self.STAGES}
+        self.bytes_received = 0
+        self.messages = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self._last_pull = (time.monotonic(), 0)
+
+    def record(self, stage: str, msg_id: int, ns: int):
+        self.histograms[stage][msg_id].record(ns)
+
+    def reset(self):
+        for stage in self.STAGES:
+            self.histograms[stage].clear()
+        self.max_queue_depth = 0
+
+    def snapshot(self, qs=(50, 90, 99, 99.9)) -> dict:
+        '''
+        Pull API: per stage and message name, count, mean and percentiles (in
+        µs), plus gauges. `bytes_per_second` covers the time since the previous
+        snapshot.
+        '''
+        now, received = time.monotonic(), self.bytes_received
+        last_time, last_received = self._last_pull
+        self._last_pull = (now, received)
+        stages = {}
+        for stage in self.STAGES:
+            stages[stage] = {
+                MSG_NAMES.get(msg_id, str(msg_id)): {
+                    'count': h.count,
+                    'mean_us': h.mean() / 1e3,
+                    'max_us': h.max / 1e3,
+                    **{f"p{q:g}_us": float(v) / 1e3 for q, v in zip(qs, h.percentiles(qs))},
+                }
+                for msg_id, h in list(self.histograms[stage].items())
+            }
+        return {
+            'stages': stages,
+            'messages': self.messages,
+            'bytes_received': received,
+            'bytes_per_second': (received - last_received) / (now - last_time) if now > last_time else 0.0,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def prometheus_text(self, prefix: str = 'ibapi', qs=(50, 90, 99, 99.9)) -> str:
+        '''The metrics in the Prometheus text exposition format, latencies as summaries in seconds.'''
+        lines = []
+        for stage in self.STAGES:
+            name = f"{prefix}_{stage}_seconds"
+            lines += [f"# HELP {name} Message loop {stage.replace('_', ' ')} time per message type",
+                      f"# TYPE {name} summary"]
+            for msg_id, h in sorted(list(self.histograms[stage].items())):
+                label = f'msg="{MSG_NAMES.get(msg_id, msg_id)}"'
+                for q, v in zip(qs, h.percentiles(qs)):
+                    lines.append(f'{name}{{{label},quantile="{q / 100:g}"}} {v / 1e9:.9f}')
+                lines.append(f"{name}_sum{{{label}}} {h.total / 1e9:.9f}")
+                lines.append(f"{name}_count{{{label}}} {h.count}")
+        lines += [f"# TYPE {prefix}_received_bytes_total counter",
+                  f"{prefix}_received_bytes_total {self.bytes_received}",
+                  f"# TYPE {prefix}_received_messages_total counter",
+                  f"{prefix}_received_messages_total {self.messages}",
+                  f"# TYPE {prefix}_queue_depth gauge",
+                  f"{prefix}_queue_depth {self.queue_depth}",
+                  f"# TYPE {prefix}_queue_depth_max gauge",
+                  f"{prefix}_queue_depth_max {self.max_queue_depth}"]
+        return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(metrics: LatencyMetrics, port: int = 9464, host: str = '') -> ThreadingHTTPServer:
+    '''Serves `metrics.prometheus_text()` on http://host:port/metrics from a daemon thread.'''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='PrometheusExporter', daemon=True).start()
+    log.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
+
+
+class _TimestampedQueue(queue.Queue):
+    '''`msg_queue` stand-in: `get()` returns (enqueue time in ns, message).'''
+
+    def __init__(self, metrics: LatencyMetrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def _put(self, item):
+        self.queue.append((time.perf_counter_ns(), item))
+        metrics = self.metrics
+        metrics.bytes_received += len(item) + 4
+        depth = len(self.queue)
+        metrics.queue_depth = depth
+        if depth > metrics.max_queue_depth:
+            metrics.max_queue_depth = depth
+
+    def _get(self):
+        item = self.queue.popleft()
+        self.metrics.queue_depth = len(self.queue)
+        return item
+
+
+class _TimedWrapper:
+    '''Proxies the message handler for the decoder, adding up the time spent in callbacks.'''
+
+    def __init__(self, wrapper, metrics: LatencyMetrics):
+        self._wrapper = wrapper
+        self._metrics = metrics
+        self.elapsed = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._wrapper, name)
+        if not callable(method):
+            return method
+        metrics = self._metrics
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                ns = time.perf_counter_ns() - t0
+                self.elapsed += ns
+                if metrics.slow_callback_ns and ns > metrics.slow_callback_ns:
+                    log.warning(f"Slow callback|name={name}|ms={ns / 1e6:.1f}|queue_depth={metrics.queue_depth}")
+        # Cached on the proxy, later calls skip __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+class InstrumentedClient(EClient):
+    """
+    `EClient` recording `LatencyMetrics` for its message loop. A plain
+    `EClient` has no instrumentation overhead at all, use this one only where
+    the numbers are wanted:
+
+    ```
+    metrics = LatencyMetrics(slow_callback=0.005)
+    app = TwsApp(message_handler=handler,
+                 client_factory=lambda handler: InstrumentedClient(handler, metrics))
+    app.start()
+    serve_prometheus(metrics, port=9464) # optional
+    ...
+    metrics.snapshot()['stages']['callback']['TICK_PRICE']['p99_us']
+    ```
+    """
+
+    def __init__(self, wrapper, metrics: LatencyMetrics | None = None):
+        super().__init__(wrapper)
+        self.metrics = metrics or LatencyMetrics()
+        self.msg_queue = _TimestampedQueue(self.metrics)
+        self._timed_wrapper = _TimedWrapper(wrapper, self.metrics)
+
+    def connect(self, host, port, clientId):
+        super().connect(host, port, clientId)
+        if self.decoder is not None:
+            self.decoder.wrapper = self._timed_wrapper
+
+    def run(self):
+        '''`EClient.run()` with timing around each stage.'''
+        metrics, timed_wrapper = self.metrics, self._timed_wrapper
+        perf_counter_ns = time.perf_counter_ns
+        try:
+            while self.isConnected() or not self.msg_queue.empty():
+                try:
+                    try:
+                        queued_at, text = self.msg_queue.get(block=True, timeout=0.2)
+                        if len(text) > MAX_MSG_LEN:
+                            self.wrapper.error(NO_VALID_ID, BAD_LENGTH.code(), f"{BAD_LENGTH.msg()}:{len(text)}:{text}")
+                            break
+                    except queue.Empty:
+                        self.msgLoopTmo()
+                    else:
+                        t0 = perf_counter_ns()
+                        fields = comm.read_fields(text)
+                        msg_id = int(fields[0]) if fields else 0
+                        timed_wrapper.elapsed = 0
+                        self.decoder.interpret(fields)
+                        t1 = perf_counter_ns()
+                        metrics.messages += 1
+                        if metrics.enabled:
+                            metrics.record('queue_wait', msg_id, t0 - queued_at)
+                            metrics.record('decode', msg_id, t1 - t0 - timed_wrapper.elapsed)
+                            metrics.record('callback', msg_id, timed_wrapper.elapsed)
+                        self.msgLoopRec()
+                except (KeyboardInterrupt, SystemExit):
+                    log.info("detected KeyboardInterrupt, SystemExit")
+                    self.keyboardInterrupt()
+                    self.keyboardInterruptHard()
+                except BadMessage:
+                    log.info("BadMessage")
+        finally:
+            self.disconnect()
@@ -0,0 +1,164 @@
+import logging
+import queue
+import time
+from collections import Counter
+from typing import Callable
+
+from ibapi.client import EClient
+from ibapi.message import IN
+from ibapi.ticktype import TickTypeEnum
+
+log = logging.getLogger(__name__)
+
+# What to do with a message arriving while the queue is full
+BLOCK = 'block'       # wait for room, which stops the reader and backs up the socket
+CONFLATE = 'conflate' # replace the queued message with the same key (always, not only when full)
+DROP = 'drop'         # discard it and count it in `dropped`
+
+# Conflation key: message id plus the (reqId, tickType) fields, starting at this index.
+# Tick option computations have no version field (server version >= 156).
+CONFLATE_KEY_FIELD = {
+    IN.TICK_PRICE: 2,
+    IN.TICK_SIZE: 2,
+    IN.TICK_GENERIC: 2,
+    IN.TICK_STRING: 2,
+    IN.TICK_OPTION_COMPUTATION: 1,
+}
+# Tick types that are never conflated, each message is a separate trade print
+# rather than the latest value of a field (time & sales via RT_VOLUME).
+UNCONFLATED_TICK_TYPES = {
+    IN.TICK_STRING: frozenset(str(t).encode() for t in (TickTypeEnum.RT_VOLUME, TickTypeEnum.RT_TRD_VOLUME)),
+}
+DEFAULT_POLICIES = {msg_id: CONFLATE for msg_id in CONFLATE_KEY_FIELD}
+DEFAULT_MAXSIZE = 10_000
+
+
+class BoundedMessageQueue(queue.Queue):
+    """
+    Drop-in for `EClient.msg_queue` (filled by `EReader`, drained by
+    `EClient.run`) that holds at most `maxsize` messages, with an overload
+    policy per incoming message id (`BLOCK` unless set in `policies`).
+
+    By default quotes are conflated: a `tickPrice`, `tickSize`,
+    `tickGeneric`, `tickString` or `tickOptionComputation` message replaces
+    the one still queued for the same reqId and tick type, in its place, so
+    the handler gets the latest value instead of a backlog of stale ones.
+    Trade prints (`UNCONFLATED_TICK_TYPES`) are always queued. When
+    the queue is full and there is nothing to conflate with, quotes block like
+    everything else. Depth updates, orders and history are never conflated
+    or dropped unless configured to.
+
+    `on_high_water(depth)` is called once the queue reaches `high_water`
+    messages, `on_low_water(depth)` once it is back under `low_water`.
+    Both default to logging a warning/info, on the reader/client threads.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, policies: dict[int, str] | None = None,
+                 high_water: int | None = None, low_water: int | None = None,
+                 on_high_water: Callable[[int], None] | None = None,
+                 on_low_water: Callable[[int], None] | None = None):
+        assert maxsize > 0, "maxsize must be greater than 0"
+        super().__init__(maxsize)
+        self.policies = DEFAULT_POLICIES if policies is None else policies
+        for msg_id, policy in self.policies.items():
+            assert policy in (BLOCK, CONFLATE, DROP), f"unknown policy '{policy}'"
+            assert policy != CONFLATE or msg_id in CONFLATE_KEY_FIELD, f"message id {msg_id} cannot be conflated"
+        self.high_water = high_water or int(maxsize * 0.8)
+        self.low_water = low_water or self.high_water // 2
+        self.on_high_water = on_high_water or self._warn_high_water
+        self.on_low_water = on_low_water or self._info_low_water
+        self.conflated = Counter()
+        self.dropped = Counter()
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self._pending: dict[tuple, list] = {}
+        self._above_high_water = False
+
+    def put(self, item, block=True, timeout=None):
+        msg_id = int(item[:item.index(b'\0')])
+        policy = self.policies.get(msg_id, BLOCK)
+        key = None
+        if policy == CONFLATE:
+            i = CONFLATE_KEY_FIELD[msg_id]
+            fields = item.split(b'\0', i + 2)
+            if fields[i + 1] not in UNCONFLATED_TICK_TYPES.get(msg_id, ()):
+                key = (msg_id, fields[i], fields[i + 1])
+        with self.not_full:
+            if key is not None:
+                entry = self._pending.get(key)
+                if entry is not None:
+                    entry[0] = item
+                    self.conflated[msg_id] += 1
+                    return
+            if self._qsize() >= self.maxsize:
+                if policy == DROP:
+                    self.dropped[msg_id] += 1
+                    return
+                started = time.monotonic()
+                while self._qsize() >= self.maxsize:
+                    if not block:
+                        raise queue.Full
+                    if not self.not_full.wait(timeout):
+                        raise queue.Full
+                self.blocked_seconds += time.monotonic() - started
+            entry = [item, key]
+            self.queue.append(entry)
+            if key is not None:
+                self._pending[key] = entry
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            depth = len(self.queue)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            crossed = not self._above_high_water and depth >= self.high_water
+            if crossed:
+                self._above_high_water = True
+        if crossed:
+            self.on_high_water(depth)
+
+    def get(self, block=True, timeout=None):
+        item = super().get(block, timeout)
+        if self._above_high_water:
+            with self.mutex:
+                depth = len(self.queue)
+                recovered = self._above_high_water and depth < self.low_water
+                if recovered:
+                    self._above_high_water = False
+            if recovered:
+                self.on_low_water(depth)
+        return item
+
+    ##
+    # Internals
+    ##
+
+    def _get(self):
+        item, key = entry = self.queue.popleft()
+        if key is not None and self._pending.get(key) is entry:
+            del self._pending[key]
+        return item
+
+    def _warn_high_water(self, depth: int):
+        log.warning(f"Message queue above high water mark|depth={depth}|maxsize={self.maxsize}"
+                    f"|conflated={sum(self.conflated.values())}|dropped={sum(self.dropped.values())}")
+
+    def _info_low_water(self, depth: int):
+        log.info(f"Message queue back under low water mark|depth={depth}")
+
+
+class BoundedClient(EClient):
+    """
+    `EClient` with a `BoundedMessageQueue`, for use as `TwsApp.client_factory`:
+
+    ```
+    app = TwsApp(message_handler=handler,
+                 client_factory=lambda handler: BoundedClient(handler, maxsize=5000,
+                                                              policies={**DEFAULT_POLICIES, IN.NEWS_BULLETINS: DROP}))
+    ```
+
+    Any other client can be bounded by replacing its `msg_queue` before connecting.
+    """
+
+    def __init__(self, wrapper, **queue_options):
+        super().__init__(wrapper)
+        self.msg_queue = BoundedMessageQueue(**queue_options)
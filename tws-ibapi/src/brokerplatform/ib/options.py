@@ -0,0 +1,193 @@
+import datetime as dt
+import logging
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from ibapi.contract import Contract, ContractDetails
+
+from brokerplatform.ib.contracts import ContractMaster
+from brokerplatform.ib.history import iso_date
+
+log = logging.getLogger(__name__)
+
+CALL, PUT = 'C', 'P'
+CHAIN_DTYPE = np.dtype([('expiry', 'datetime64[D]'), ('strike', '<f8'), ('right', 'U1'), ('conId', '<i8')])
+
+
+@dataclass
+class OptionParams:
+    '''One `securityDefinitionOptionParameter` callback: the expirations and strikes listed on an exchange.'''
+    exchange: str
+    underlyingConId: int
+    tradingClass: str
+    multiplier: str
+    expirations: list[str]
+    strikes: np.ndarray
+
+
+class OptionChain:
+    """
+    Qualified option contracts as columns sorted by (expiry, right, strike),
+    see `CHAIN_DTYPE`, with an (expiry, strike, right) -> conId index.
+    """
+
+    def __init__(self, underlying: Contract, rows: np.ndarray, details: dict[int, ContractDetails]):
+        rows.sort(order=['expiry', 'right', 'strike'])
+        self.underlying = underlying
+        self.table = rows
+        self.details = details
+        self._index = {(e, s, r): int(c) for e, s, r, c in zip(rows['expiry'].astype(str), rows['strike'],
+                                                               rows['right'], rows['conId'])}
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @property
+    def expiries(self) -> np.ndarray:
+        return np.unique(self.table['expiry'])
+
+    def strikes(self, expiry: str, right: str = CALL) -> np.ndarray:
+        t = self.table
+        mask = (t['expiry'] == np.datetime64(iso_date(expiry))) & (t['right'] == right)
+        return t['strike'][mask]
+
+    def conId(self, expiry: str, strike: float, right: str) -> int | None:
+        '''conId of a contract, expiry as 'YYYYMMDD' or 'YYYY-MM-DD'.'''
+        return self._index.get((iso_date(expiry), float(strike), right))
+
+    def contract(self, expiry: str, strike: float, right: str) -> Contract | None:
+        conId = self.conId(expiry, strike, right)
+        return self.details[conId].contract if conId is not None else None
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.table)
+
+
+class OptionChainLoader:
+    """
+    Builds option chains from `reqSecDefOptParams`: the listed expirations and
+    strikes are filtered by days to expiry and moneyness first, and only those
+    are qualified, with one `reqContractDetails` per expiry (all strikes and
+    both rights at once) through the `ContractMaster`, which paces them and
+    caches the results.
+
+    ```
+    master = ContractMaster(app)
+    chains = OptionChainLoader(app, master)
+
+    class Handler(EWrapper):
+        def securityDefinitionOptionParameter(self, reqId, exchange, underlyingConId, tradingClass, multiplier, expirations, strikes):
+            chains.securityDefinitionOptionParameter(reqId, exchange, underlyingConId, tradingClass, multiplier, expirations, strikes)
+        def securityDefinitionOptionParameterEnd(self, reqId):
+            chains.securityDefinitionOptionParameterEnd(reqId)
+        # plus the ContractMaster callbacks
+
+    spx = master.resolve(index_contract)[0].contract
+    chain = chains.load(spx, spot=5200, moneyness=0.05, max_dte=45, trading_class='SPXW')
+    chain.conId('20240621', 5200, 'C')
+    ```
+    """
+
+    def __init__(self, app, master: ContractMaster):
+        self.app = app
+        self.master = master
+        self._params: dict[int, list[OptionParams]] = {}
+        self._done: set[int] = set()
+        self._cond = threading.Condition()
+
+    def params(self, underlying: Contract, futFopExchange: str = "", timeout: float | None = 10) -> list[OptionParams]:
+        '''The `reqSecDefOptParams` results for an underlying (which must have its conId).'''
+        assert underlying.conId, "underlying must be qualified (have a conId)"
+        reqId = self.app.nextId
+        with self._cond:
+            self._params[reqId] = []
+        self.app.client.reqSecDefOptParams(reqId, underlying.symbol, futFopExchange, underlying.secType, underlying.conId)
+        with self._cond:
+            ok = self._cond.wait_for(lambda: reqId in self._done, timeout)
+            self._done.discard(reqId)
+            params = self._params.pop(reqId)
+        if not ok:
+            raise TimeoutError(f"reqSecDefOptParams for {underlying.symbol} did not complete within {timeout}s")
+        return params
+
+    def load(self, underlying: Contract, spot: float, moneyness: float = 0.1, min_dte: int = 0, max_dte: int = 60,
+             exchange: str = 'SMART', trading_class: str | None = None, rights: tuple[str, ...] = (CALL, PUT),
+             today: dt.date | None = None, timeout: float | None = 60) -> OptionChain:
+        '''
+        Qualifies the options with strikes within `moneyness` (fraction) of
+        `spot` and expiring in `min_dte` to `max_dte` days.
+        '''
+        today = today or dt.date.today()
+        sec_type = 'FOP' if underlying.secType == 'FUT' else 'OPT'
+        candidates = [p for p in self.params(underlying, underlying.exchange if sec_type == 'FOP' else "", timeout)
+                      if p.exchange == exchange and (trading_class is None or p.tradingClass == trading_class)]
+        if not candidates:
+            raise LookupError(f"No option parameters for {underlying.symbol} on {exchange}")
+
+        queries, wanted = [], {}
+        for p in candidates:
+            strikes = p.strikes[np.abs(p.strikes / spot - 1) <= moneyness]
+            for expiry in p.expirations:
+                dte = (dt.datetime.strptime(expiry, '%Y%m%d').date() - today).days
+                if not min_dte <= dte <= max_dte or len(strikes) == 0:
+                    continue
+                q = Contract()
+                q.symbol = underlying.symbol
+                q.secType = sec_type
+                q.exchange = exchange
+                q.currency = underlying.currency
+                q.lastTradeDateOrContractMonth = expiry
+                q.tradingClass = p.tradingClass
+                q.multiplier = p.multiplier
+                queries.append(q)
+                wanted[(expiry, p.tradingClass)] = set(strikes.tolist())
+
+        stale = [q for q in queries if self._needs_refresh(q)]
+        log.info(f"Option chain {underlying.symbol}: {len(queries)} expiries, {len(stale)} to qualify")
+        if stale:
+            errors = self.master.preload(stale, timeout)
+            for i, error in errors.items():
+                log.warning(f"Option chain {underlying.symbol}: expiry {stale[i].lastTradeDateOrContractMonth} failed: {error}")
+
+        rows, details = [], {}
+        for q in queries:
+            strikes = wanted[(q.lastTradeDateOrContractMonth, q.tradingClass)]
+            for d in self._expiry_details(q):
+                c = d.contract
+                if c.strike in strikes and c.right in rights:
+                    rows.append((iso_date(c.lastTradeDateOrContractMonth), c.strike, c.right, c.conId))
+                    details[c.conId] = d
+        return OptionChain(underlying, np.array(rows, dtype=CHAIN_DTYPE), details)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def securityDefinitionOptionParameter(self, reqId: int, exchange: str, underlyingConId: int, tradingClass: str,
+                                          multiplier: str, expirations, strikes):
+        with self._cond:
+            params = self._params.get(reqId)
+            if params is not None:
+                params.append(OptionParams(exchange, underlyingConId, tradingClass, multiplier,
+                                           sorted(expirations), np.array(sorted(strikes), dtype=np.float64)))
+
+    def securityDefinitionOptionParameterEnd(self, reqId: int):
+        with self._cond:
+            if reqId in self._params:
+                self._done.add(reqId)
+                self._cond.notify_all()
+
+    ##
+    # Internals
+    ##
+
+    def _expiry_details(self, q: Contract) -> list[ContractDetails]:
+        return [d for d in self.master.lookup(symbol=q.symbol, secType=q.secType, currency=q.currency,
+                                              expiry=q.lastTradeDateOrContractMonth)
+                if d.contract.tradingClass == q.tradingClass]
+
+    def _needs_refresh(self, q: Contract) -> bool:
+        found = self._expiry_details(q)
+        return not found or any(self.master.is_stale(d.contract.conId) for d in found)
@@ -0,0 +1,176 @@
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# `updateMktDepth`/`updateMktDepthL2` operation and side codes
+INSERT, UPDATE, DELETE = 0, 1, 2
+ASK, BID = 0, 1
+
+# Error code TWS sends when a depth subscription has been reset
+MKT_DEPTH_RESET = 317
+
+DEFAULT_MAX_DEPTH = 50
+
+
+@dataclass(frozen=True)
+class TopOfBook:
+    bid: float
+    bid_size: float
+    ask: float
+    ask_size: float
+
+
+class OrderBook:
+    """
+    Market depth for one subscription, held in preallocated NumPy arrays of
+    prices and sizes per side (row 0 = ask, row 1 = bid), best price at
+    position 0.
+
+    Updates by position are O(1). Inserts and deletes shift the rows below
+    the position, a single `memmove` within the fixed-size arrays.
+
+    `version` works as a seqlock: it is odd while a change is being applied
+    and bumped again once it is done. Readers on other threads use it to get
+    a consistent copy, see `snapshot()`.
+    """
+
+    def __init__(self, max_depth: int = DEFAULT_MAX_DEPTH):
+        assert max_depth > 0, "max_depth must be greater than 0"
+        self.max_depth = max_depth
+        self.prices = np.full((2, max_depth), np.nan)
+        self.sizes = np.zeros((2, max_depth))
+        self.depth = np.zeros(2, dtype=np.int64)
+        self.version = 0
+
+    def apply(self, position: int, operation: int, side: int, price: float, size: float):
+        if position < 0 or position >= self.max_depth:
+            return # deeper than we track
+        self.version += 1
+        prices, sizes = self.prices[side], self.sizes[side]
+        n = int(self.depth[side])
+        if operation == UPDATE and position < n:
+            prices[position] = price
+            sizes[position] = size
+        elif operation == INSERT or operation == UPDATE:
+            # An update past the last level is treated as an insert
+            position = min(position, n)
+            if n == self.max_depth:
+                n -= 1 # the last level drops off
+            prices[position + 1:n + 1] = prices[position:n]
+            sizes[position + 1:n + 1] = sizes[position:n]
+            prices[position] = price
+            sizes[position] = size
+            self.depth[side] = n + 1
+        elif operation == DELETE and position < n:
+            prices[position:n - 1] = prices[position + 1:n]
+            sizes[position:n - 1] = sizes[position + 1:n]
+            prices[n - 1] = np.nan
+            sizes[n - 1] = 0.0
+            self.depth[side] = n - 1
+        self.version += 1
+
+    def clear(self):
+        self.version += 1
+        self.prices.fill(np.nan)
+        self.sizes.fill(0.0)
+        self.depth.fill(0)
+        self.version += 1
+
+    def top(self) -> TopOfBook:
+        return TopOfBook(bid=float(self.prices[BID, 0]), bid_size=float(self.sizes[BID, 0]),
+                         ask=float(self.prices[ASK, 0]), ask_size=float(self.sizes[ASK, 0]))
+
+    def mid(self) -> float:
+        return (self.prices[BID, 0] + self.prices[ASK, 0]) / 2
+
+    def spread(self) -> float:
+        return self.prices[ASK, 0] - self.prices[BID, 0]
+
+    def microprice(self) -> float:
+        '''Top of book prices weighted by the opposite side's size.'''
+        bid, ask = self.prices[BID, 0], self.prices[ASK, 0]
+        bid_size, ask_size = self.sizes[BID, 0], self.sizes[ASK, 0]
+        total = bid_size + ask_size
+        if total <= 0:
+            return np.nan
+        return (bid * ask_size + ask * bid_size) / total
+
+    def cumulative_depth(self, side: int, levels: int | None = None) -> np.ndarray:
+        '''Running total of size from the best price outwards.'''
+        n = int(self.depth[side]) if levels is None else min(levels, int(self.depth[side]))
+        return np.cumsum(self.sizes[side, :n])
+
+    def snapshot(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Consistent copy of (prices, sizes, depth), safe to call from any thread.'''
+        while True:
+            version = self.version
+            if version & 1:
+                continue # update in progress
+            prices, sizes, depth = self.prices.copy(), self.sizes.copy(), self.depth.copy()
+            if version == self.version:
+                return prices, sizes, depth
+
+
+class OrderBooks:
+    """
+    Order books for any number of `reqMktDepth` subscriptions, keyed by reqId.
+
+    ```
+    books = OrderBooks()
+
+    class Handler(EWrapper):
+        def updateMktDepth(self, reqId, position, operation, side, price, size):
+            books.updateMktDepth(reqId, position, operation, side, price, size)
+        def updateMktDepthL2(self, reqId, position, marketMaker, operation, side, price, size, isSmartDepth):
+            books.updateMktDepthL2(reqId, position, marketMaker, operation, side, price, size, isSmartDepth)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            books.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+
+    req_id = app.nextId
+    books.add(req_id, max_depth=10)
+    app.client.reqMktDepth(req_id, contract, 10, True, [])
+    ...
+    books[req_id].microprice()
+    ```
+    """
+
+    def __init__(self, max_depth: int = DEFAULT_MAX_DEPTH):
+        self.max_depth = max_depth
+        self._books: dict[int, OrderBook] = {}
+
+    def add(self, reqId: int, max_depth: int | None = None) -> OrderBook:
+        '''Preallocates the book for a subscription, before requesting it.'''
+        book = self._books[reqId] = OrderBook(max_depth or self.max_depth)
+        return book
+
+    def remove(self, reqId: int):
+        self._books.pop(reqId, None)
+
+    def __getitem__(self, reqId: int) -> OrderBook:
+        return self._books[reqId]
+
+    def __contains__(self, reqId: int) -> bool:
+        return reqId in self._books
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def updateMktDepth(self, reqId: int, position: int, operation: int, side: int, price: float, size):
+        book = self._books.get(reqId)
+        if book is None:
+            book = self.add(reqId)
+        book.apply(position, operation, side, price, float(size))
+
+    def updateMktDepthL2(self, reqId: int, position: int, marketMaker: str, operation: int,
+                         side: int, price: float, size, isSmartDepth: bool):
+        self.updateMktDepth(reqId, position, operation, side, price, size)
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        book = self._books.get(reqId)
+        if book is not None and errorCode == MKT_DEPTH_RESET:
+            log.info(f"Market depth reset for reqId={reqId}, clearing book")
+            book.clear()
@@ -0,0 +1,361 @@
+import copy
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+
+from ibapi.commission_report import CommissionReport
+from ibapi.contract import Contract
+from ibapi.execution import Execution
+from ibapi.order import Order
+from ibapi.order_state import OrderState
+
+log = logging.getLogger(__name__)
+
+PENDING_SUBMIT = 'PendingSubmit'
+PENDING_CANCEL = 'PendingCancel'
+PRE_SUBMITTED = 'PreSubmitted'
+SUBMITTED = 'Submitted'
+API_PENDING = 'ApiPending'
+API_CANCELLED = 'ApiCancelled'
+CANCELLED = 'Cancelled'
+FILLED = 'Filled'
+INACTIVE = 'Inactive'
+# No further updates expected, except a fill that raced a cancel
+TERMINAL = frozenset([API_CANCELLED, CANCELLED, FILLED, INACTIVE])
+
+
+class OrderRecord:
+    '''Everything known about one order, joined from its callbacks.'''
+    __slots__ = ('orderId', 'permId', 'clientId', 'parentId', 'contract', 'order', 'status', 'filled', 'remaining',
+                 'avgFillPrice', 'lastFillPrice', 'whyHeld', 'warning', 'commission', 'realizedPNL', 'executions',
+                 'updated')
+
+    def __init__(self, orderId: int, permId: int = 0, contract: Contract | None = None, order: Order | None = None):
+        self.orderId = orderId
+        self.permId = permId
+        self.clientId = 0
+        self.parentId = 0
+        self.contract = contract
+        self.order = order
+        self.status = ''
+        self.filled = 0.0
+        self.remaining = float(order.totalQuantity) if order is not None else 0.0
+        self.avgFillPrice = 0.0
+        self.lastFillPrice = 0.0
+        self.whyHeld = ''
+        self.warning = ''
+        self.commission = 0.0
+        self.realizedPNL = 0.0
+        self.executions: dict[str, Execution] = {} # execId -> execution
+        self.updated = time.time()
+
+    @property
+    def is_open(self) -> bool:
+        return self.status not in TERMINAL
+
+    @property
+    def conId(self) -> int:
+        return self.contract.conId if self.contract is not None else 0
+
+    def __repr__(self) -> str:
+        symbol = self.contract.symbol if self.contract is not None else ''
+        return (f"OrderRecord(orderId={self.orderId}, permId={self.permId}, symbol={symbol}, status={self.status}, "
+                f"filled={self.filled}, remaining={self.remaining}, avgFillPrice={self.avgFillPrice})")
+
+
+class OrderManager:
+    """
+    Order book of record: joins `openOrder`, `orderStatus`, `execDetails`,
+    `commissionReport` and `completedOrder` into one `OrderRecord` per order,
+    indexed by orderId and permId (orders placed outside this client may
+    only have a permId).
+
+    Status updates are applied idempotently: repeats and stale updates (less
+    filled than already known) are ignored, as is anything after a terminal
+    status other than a fill that raced a cancel. Executions are matched by
+    execId, corrections (same execId up to the last `.` part) replace the
+    execution they correct along with its commission, and commissions are
+    matched to executions by execId whichever arrives first.
+
+    Open orders per conId and the executed position per conId are kept as
+    indexes, so those queries are dict lookups. `place()`, `modify()` and
+    `cancel()` send straight from the record, without any scan.
+
+    ```
+    orders = OrderManager(app, on_update=strategy.on_order)
+
+    class Handler(EWrapper):
+        def nextValidId(self, orderId):
+            orders.nextValidId(orderId)
+        def openOrder(self, orderId, contract, order, orderState):
+            orders.openOrder(orderId, contract, order, orderState)
+        def orderStatus(self, orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice):
+            orders.orderStatus(orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
+        def execDetails(self, reqId, contract, execution):
+            orders.execDetails(reqId, contract, execution)
+        def commissionReport(self, commissionReport):
+            orders.commissionReport(commissionReport)
+        def completedOrder(self, contract, order, orderState):
+            orders.completedOrder(contract, order, orderState)
+
+    order_id = orders.place(contract, limit_order)
+    orders.modify(order_id, lmtPrice=101.5)
+    orders.open_orders(contract.conId), orders.position(contract.conId)
+    orders.cancel(order_id)
+    ```
+
+    `on_update(record)` is called on the client's thread after each applied
+    change.
+    """
+
+    def __init__(self, app, on_update: Callable[[OrderRecord], None] | None = None):
+        self.app = app
+        self.on_update = on_update
+        self.ignored = 0 # duplicate or stale status updates
+        self._next_id = 0
+        self._by_id: dict[int, OrderRecord] = {}
+        self._by_perm_id: dict[int, OrderRecord] = {}
+        self._open: defaultdict[int, dict[int, OrderRecord]] = defaultdict(dict) # conId -> id(record) -> record
+        self._open_conIds: dict[int, int] = {} # id(record) -> conId it is indexed under in _open
+        self._positions: defaultdict[int, float] = defaultdict(float)
+        self._executions: dict[str, tuple[OrderRecord | None, Contract, Execution]] = {} # execId -> ...
+        self._corrections: dict[str, str] = {} # execId without its last part -> latest execId
+        self._commissions: dict[str, CommissionReport] = {}
+        self._charges: dict[str, tuple[float, float]] = {} # execId -> (commission, realizedPNL) added to its record
+        self._lock = threading.RLock()
+
+    def get(self, orderId: int) -> OrderRecord | None:
+        return self._by_id.get(orderId)
+
+    def by_perm_id(self, permId: int) -> OrderRecord | None:
+        return self._by_perm_id.get(permId)
+
+    def open_orders(self, conId: int | None = None) -> list[OrderRecord]:
+        '''Open orders of a contract, or all of them.'''
+        with self._lock:
+            if conId is not None:
+                return list(self._open.get(conId, {}).values())
+            return [r for records in self._open.values() for r in records.values()]
+
+    def position(self, conId: int) -> float:
+        '''Net executed quantity of a contract (bought - sold), from this session's executions.'''
+        return self._positions.get(conId, 0.0)
+
+    @property
+    def positions(self) -> dict[int, float]:
+        with self._lock:
+            return {conId: qty for conId, qty in self._positions.items() if qty}
+
+    def place(self, contract: Contract, order: Order) -> int:
+        '''Places a new order, returns its orderId. Needs `nextValidId` to have been forwarded.'''
+        with self._lock:
+            assert self._next_id > 0, "no order id yet, forward nextValidId first"
+            orderId = self._next_id
+            self._next_id += 1
+            record = OrderRecord(orderId, contract=contract, order=order)
+            record.status = PENDING_SUBMIT
+            self._by_id[orderId] = record
+            self._reindex(record)
+        order.orderId = orderId
+        self.app.client.placeOrder(orderId, contract, order)
+        return orderId
+
+    def modify(self, orderId: int, **changes) -> bool:
+        '''
+        Amends an open order with new `Order` attribute values, e.g.
+        `lmtPrice=101.5`. Returns False if the order is no longer open, or
+        only known from a slim record (see `slimorders`).
+        '''
+        record = self._by_id.get(orderId)
+        if record is None or not record.is_open or not isinstance(record.order, Order):
+            return False
+        order = copy.copy(record.order)
+        for name, value in changes.items():
+            assert hasattr(order, name), f"Order has no attribute '{name}'"
+            setattr(order, name, value)
+        record.order = order
+        self.app.client.placeOrder(orderId, record.contract, order)
+        return True
+
+    def cancel(self, orderId: int) -> bool:
+        '''Requests a cancel. Returns False if the order is unknown or no longer open.'''
+        record = self._by_id.get(orderId)
+        if record is None or not record.is_open:
+            return False
+        self.app.client.cancelOrder(orderId, "")
+        return True
+
+    def cancel_all(self, conId: int | None = None) -> int:
+        '''Cancels the open orders placed by this client, of one contract or all. Returns how many.'''
+        cancelled = 0
+        for record in self.open_orders(conId):
+            if record.orderId and self.cancel(record.orderId):
+                cancelled += 1
+        return cancelled
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def nextValidId(self, orderId: int):
+        with self._lock:
+            self._next_id = max(self._next_id, orderId)
+
+    def openOrder(self, orderId: int, contract: Contract, order: Order, orderState: OrderState):
+        with self._lock:
+            record = self._record(orderId, order.permId)
+            self._attach(record, contract, order)
+            record.clientId = order.clientId
+            record.parentId = order.parentId
+            if orderState.warningText:
+                record.warning = orderState.warningText
+            if not record.status:
+                record.remaining = float(order.totalQuantity)
+            self._transition(record, orderState.status, record.filled, record.remaining)
+            self._reindex(record)
+        self._notify(record)
+
+    def orderStatus(self, orderId: int, status: str, filled, remaining, avgFillPrice: float, permId: int,
+                    parentId: int, lastFillPrice: float, clientId: int, whyHeld: str, mktCapPrice: float):
+        with self._lock:
+            record = self._record(orderId, permId)
+            record.clientId = clientId
+            record.parentId = parentId
+            record.whyHeld = whyHeld
+            applied = self._transition(record, status, float(filled), float(remaining))
+            if applied:
+                record.avgFillPrice = avgFillPrice
+                record.lastFillPrice = lastFillPrice
+                self._reindex(record)
+        if applied:
+            self._notify(record)
+
+    def completedOrder(self, contract: Contract, order: Order, orderState: OrderState):
+        with self._lock:
+            record = self._record(order.orderId, order.permId)
+            self._attach(record, contract, order)
+            filled = float(order.filledQuantity)
+            self._transition(record, orderState.status, filled, float(order.totalQuantity) - filled)
+            self._reindex(record)
+        self._notify(record)
+
+    def execDetails(self, reqId: int, contract: Contract, execution: Execution):
+        execId = execution.execId
+        with self._lock:
+            if execId in self._executions:
+                return # also received through reqExecutions
+            record = self._by_id.get(execution.orderId) if execution.orderId else None
+            if record is None and execution.permId:
+                record = self._by_perm_id.get(execution.permId)
+            base = execId.rsplit('.', 1)[0]
+            corrected = self._corrections.get(base)
+            old_record = None
+            if corrected is not None:
+                # A correction replaces the execution it corrects, and its commission
+                old_record, old_contract, old = self._executions[corrected]
+                self._positions[old_contract.conId] -= _signed(old)
+                if old_record is not None:
+                    old_record.executions.pop(corrected, None)
+                    commission, realized = self._charges.pop(corrected, (0.0, 0.0))
+                    old_record.commission -= commission
+                    old_record.realizedPNL -= realized
+            self._corrections[base] = execId
+            self._executions[execId] = (record, contract, execution)
+            self._positions[contract.conId] += _signed(execution)
+            if record is not None:
+                record.executions[execId] = execution
+                if record.contract is None:
+                    record.contract = contract
+            report = self._commissions.pop(execId, None)
+        if old_record is not None and old_record is not record:
+            self._notify(old_record)
+        if report is not None:
+            self.commissionReport(report)
+        elif record is not None:
+            self._notify(record)
+
+    def commissionReport(self, commissionReport: CommissionReport):
+        execId = commissionReport.execId
+        with self._lock:
+            entry = self._executions.get(execId)
+            if entry is None:
+                self._commissions[execId] = commissionReport # execDetails still to come
+                return
+            record = entry[0]
+            if record is None or execId in self._charges:
+                return # also received through reqExecutions
+            if self._corrections.get(execId.rsplit('.', 1)[0]) != execId:
+                return # for an execution since corrected
+            commission = commissionReport.commission
+            realized = commissionReport.realizedPNL
+            if realized >= 1e300: # unset is sent as Double.MAX_VALUE
+                realized = 0.0
+            self._charges[execId] = (commission, realized)
+            record.commission += commission
+            record.realizedPNL += realized
+        self._notify(record)
+
+    ##
+    # Internals
+    ##
+
+    def _record(self, orderId: int, permId: int) -> OrderRecord:
+        record = self._by_id.get(orderId) if orderId else None
+        if record is None and permId:
+            record = self._by_perm_id.get(permId)
+        if record is None:
+            record = OrderRecord(orderId, permId)
+        if orderId and record.orderId in (0, orderId):
+            record.orderId = orderId
+            self._by_id[orderId] = record
+        if permId and not record.permId:
+            record.permId = permId
+        if record.permId:
+            self._by_perm_id[record.permId] = record
+        return record
+
+    def _attach(self, record: OrderRecord, contract: Contract, order: Order):
+        # A `SlimOrder` record doesn't replace the full objects an order was placed with
+        if isinstance(order, Order) or record.order is None:
+            record.order = order
+        if isinstance(contract, Contract) or record.contract is None:
+            record.contract = contract
+
+    def _transition(self, record: OrderRecord, status: str, filled: float, remaining: float) -> bool:
+        '''Applies a status update, unless it is a repeat, stale, or after a terminal status.'''
+        if not status:
+            return False
+        if (status == record.status and filled == record.filled and remaining == record.remaining) \
+                or filled < record.filled \
+                or (not record.is_open and not (status == FILLED and record.status != FILLED)):
+            self.ignored += 1
+            return False
+        record.status = status
+        record.filled = filled
+        record.remaining = remaining
+        record.updated = time.time()
+        return True
+
+    def _reindex(self, record: OrderRecord):
+        # The conId may have changed since, e.g. an order placed with an unqualified contract (conId 0)
+        key = id(record)
+        conId = self._open_conIds.pop(key, None)
+        if conId is not None:
+            records = self._open[conId]
+            del records[key]
+            if not records:
+                del self._open[conId]
+        if record.is_open and record.contract is not None:
+            self._open[record.conId][key] = record
+            self._open_conIds[key] = record.conId
+
+    def _notify(self, record: OrderRecord):
+        if self.on_update:
+            self.on_update(record)
+
+
+def _signed(execution: Execution) -> float:
+    shares = float(execution.shares)
+    return shares if execution.side == 'BOT' else -shares
@@ -0,0 +1,365 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+from ibapi.contract import Contract
+
+from brokerplatform.ib.app import TwsApp
+
+log = logging.getLogger(__name__)
+
+# Error code IB uses for historical data problems, including pacing violations.
+HISTORICAL_DATA_ERROR = 162
+# Informational warnings, sent with the reqId of a request that carries on
+# (e.g. 2174 about the time zone of endDateTime), not failures.
+WARNING_CODES = range(2100, 2200)
+# The connection to TWS (502, 504) or from TWS to IB (1100, 1300) is lost,
+# requests in flight will not complete.
+DISCONNECT_CODES = frozenset([502, 504, 1100, 1300])
+# IB allows at most 50 simultaneous open historical data requests.
+MAX_IN_FLIGHT = 50
+
+BARS = 'bars'
+TICKS = 'ticks'
+
+
+@dataclass(frozen=True)
+class PacingLimits:
+    """
+    Historical data pacing rules, see:
+    https://ibkrcampus.com/ibkr-api-page/twsapi-doc/#hist-pacing-violations
+    """
+    # No identical requests within this many seconds.
+    identical_window: float = 15.0
+    # No more than `same_contract_max` requests for the same
+    # contract/exchange/tick type within `same_contract_window` seconds.
+    same_contract_max: int = 6
+    same_contract_window: float = 2.0
+    # No more than `global_max` requests within `global_window` seconds.
+    global_max: int = 60
+    global_window: float = 600.0
+
+
+@dataclass(eq=False)
+class HistoricalJob:
+    """
+    A single `reqHistoricalData` (kind=BARS) or `reqHistoricalTicks`
+    (kind=TICKS) request. `params` are the keyword arguments of the matching
+    `EClient` call, except `reqId` and `contract`.
+    """
+    kind: str
+    contract: Contract
+    params: dict
+    on_done: Callable[['HistoricalJob'], None] | None = None
+    on_error: Callable[['HistoricalJob', int, str], None] | None = None
+    tag: object = None
+
+    req_id: int | None = field(default=None, init=False)
+    attempts: int = field(default=0, init=False)
+    not_before: float = field(default=0.0, init=False)
+
+    def __post_init__(self):
+        assert self.kind in (BARS, TICKS), f"kind must be '{BARS}' or '{TICKS}'"
+        assert not self.params.get('keepUpToDate'), "keepUpToDate requests never complete, they cannot be scheduled"
+
+    @property
+    def what_to_show(self) -> str:
+        return self.params.get('whatToShow', '')
+
+    def contract_key(self) -> tuple:
+        c = self.contract
+        return (c.conId or None, c.symbol, c.secType, c.exchange, c.currency,
+                c.lastTradeDateOrContractMonth, c.localSymbol)
+
+    def identity_key(self) -> tuple:
+        return (self.kind, self.contract_key(), repr(sorted(self.params.items())))
+
+    def pacing_key(self) -> tuple:
+        return (self.contract_key(), self.what_to_show)
+
+
+def is_pacing_violation(errorCode: int, errorString: str) -> bool:
+    return errorCode == HISTORICAL_DATA_ERROR and 'pacing violation' in errorString.lower()
+
+
+def is_warning(errorCode: int) -> bool:
+    return errorCode in WARNING_CODES
+
+
+def is_disconnect(errorCode: int) -> bool:
+    return errorCode in DISCONNECT_CODES
+
+
+class HistoricalDataScheduler:
+    """
+    Issues a backlog of historical data requests at the maximum rate allowed by
+    IB's pacing rules, with at most `max_in_flight` requests outstanding.
+
+    Requests are sent from a background thread as soon as the pacing rules
+    allow, jobs rejected with a pacing violation are retried with exponential
+    backoff. When the connection drops, jobs in flight are requeued with the
+    same backoff (and fail once out of attempts), to be sent again after a
+    reconnect. Forward the matching `EWrapper` callbacks from the message handler:
+
+    ```
+    class Handler(EWrapper):
+        def historicalData(self, reqId, bar):
+            ... # collect the bars, look up the job via scheduler.job(reqId)
+        def historicalDataEnd(self, reqId, start, end):
+            scheduler.historicalDataEnd(reqId, start, end)
+        def historicalTicksLast(self, reqId, ticks, done):
+            ...
+            scheduler.historicalTicksLast(reqId, ticks, done)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            scheduler.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+        def connectionClosed(self):
+            scheduler.connectionClosed()
+
+    scheduler = HistoricalDataScheduler(app)
+    scheduler.start()
+    scheduler.submit(HistoricalJob(BARS, contract, dict(endDateTime=..., durationStr='1 D', ...)))
+    scheduler.wait()
+    ```
+    """
+
+    def __init__(self, app: TwsApp,
+                 limits: PacingLimits = PacingLimits(),
+                 max_in_flight: int = MAX_IN_FLIGHT,
+                 max_attempts: int = 5,
+                 backoff: float = 15.0,
+                 max_backoff: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic):
+        assert max_in_flight > 0, "max_in_flight must be greater than 0"
+        assert max_attempts > 0, "max_attempts must be greater than 0"
+        assert limits.same_contract_max > 0 and limits.global_max > 0, "pacing limits must be greater than 0"
+        self.app = app
+        self.limits = limits
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._pending: deque[HistoricalJob] = deque()
+        self._in_flight: dict[int, HistoricalJob] = {}
+        # Issue times, oldest first
+        self._global_sent: deque[float] = deque()
+        self._key_sent: defaultdict[tuple, deque[float]] = defaultdict(deque)
+        self._identical_sent: dict[tuple, float] = {}
+        self._running = False
+        self._thread = None
+
+    def submit(self, job: HistoricalJob) -> HistoricalJob:
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify_all()
+        return job
+
+    def submit_all(self, jobs) -> list[HistoricalJob]:
+        jobs = list(jobs)
+        with self._cond:
+            self._pending.extend(jobs)
+            self._cond.notify_all()
+        return jobs
+
+    def job(self, reqId: int) -> HistoricalJob | None:
+        '''The in-flight job for a request id, for routing incoming data.'''
+        return self._in_flight.get(reqId)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def start(self):
+        log.info("Starting HistoricalDataScheduler")
+        with self._cond:
+            if self._running:
+                log.info("Scheduler is already running")
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='HistoricalDataScheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops issuing requests, pending jobs stay queued.'''
+        log.info("Stopping HistoricalDataScheduler")
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def wait(self, timeout: float | None = None) -> bool:
+        '''Blocks until there are no pending or in-flight jobs. Returns False on timeout.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._in_flight, timeout)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def historicalDataEnd(self, reqId: int, start: str, end: str):
+        self._complete(reqId)
+
+    def historicalTicks(self, reqId: int, ticks, done: bool):
+        if done:
+            self._complete(reqId)
+
+    def historicalTicksBidAsk(self, reqId: int, ticks, done: bool):
+        if done:
+            self._complete(reqId)
+
+    def historicalTicksLast(self, reqId: int, ticks, done: bool):
+        if done:
+            self._complete(reqId)
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        if reqId == -1:
+            if is_disconnect(errorCode):
+                self._drop_in_flight(errorCode, errorString)
+            return
+        with self._cond:
+            job = self._in_flight.get(reqId)
+            if job is None:
+                return
+            if is_warning(errorCode):
+                log.warning(f"Historical request warning: reqId={reqId}|code={errorCode}|msg={errorString}")
+                return
+            retry = is_pacing_violation(errorCode, errorString) or is_disconnect(errorCode)
+            if retry and job.attempts < self.max_attempts:
+                log.warning(f"Historical request reqId={reqId} failed with {errorCode}, retrying (attempt {job.attempts})")
+                del self._in_flight[reqId]
+                self._retry(job)
+                return
+        log.info(f"Historical request failed: reqId={reqId}|code={errorCode}|msg={errorString}")
+        self._finish(reqId, job.on_error and (lambda: job.on_error(job, errorCode, errorString)))
+
+    def connectionClosed(self):
+        self._drop_in_flight(504, "Connection closed")
+
+    ##
+    # Internals
+    ##
+
+    def _complete(self, reqId: int):
+        job = self._in_flight.get(reqId)
+        if job is not None:
+            self._finish(reqId, job.on_done and (lambda: job.on_done(job)))
+
+    def _retry(self, job: HistoricalJob):
+        # With `_cond` held, `job` already out of `_in_flight`
+        job.req_id = None
+        job.not_before = self._clock() + min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+        self._pending.appendleft(job)
+        self._cond.notify_all()
+
+    def _drop_in_flight(self, errorCode: int, errorString: str):
+        '''Requeues the jobs in flight on a lost connection, fails those out of attempts.'''
+        failed = []
+        with self._cond:
+            if self._in_flight:
+                log.warning(f"Connection lost ({errorCode}), requeueing {len(self._in_flight)} historical requests")
+            for reqId, job in list(self._in_flight.items()):
+                if job.attempts < self.max_attempts:
+                    del self._in_flight[reqId]
+                    self._retry(job)
+                else:
+                    failed.append((reqId, job))
+        for reqId, job in failed:
+            log.info(f"Historical request failed: reqId={reqId}|code={errorCode}|msg={errorString}")
+            self._finish(reqId, job.on_error and (lambda job=job: job.on_error(job, errorCode, errorString)))
+
+    def _finish(self, reqId: int, callback):
+        # The job only leaves `_in_flight` once its callback has run, so that
+        # `wait()` does not return before the results are handed over.
+        try:
+            if callback:
+                callback()
+        finally:
+            with self._cond:
+                self._in_flight.pop(reqId, None)
+                self._cond.notify_all()
+
+    def _prune(self, now: float):
+        limits = self.limits
+        while self._global_sent and now - self._global_sent[0] >= limits.global_window:
+            self._global_sent.popleft()
+        for key in [k for k, sent in self._key_sent.items() if not sent or now - sent[-1] >= limits.same_contract_window]:
+            del self._key_sent[key]
+        for key in [k for k, t in self._identical_sent.items() if now - t >= limits.identical_window]:
+            del self._identical_sent[key]
+
+    def _earliest(self, job: HistoricalJob) -> float:
+        '''Earliest time the job may be issued under the per-contract rules.'''
+        limits = self.limits
+        t = job.not_before
+        last = self._identical_sent.get(job.identity_key())
+        if last is not None:
+            t = max(t, last + limits.identical_window)
+        sent = self._key_sent.get(job.pacing_key())
+        if sent and len(sent) >= limits.same_contract_max:
+            t = max(t, sent[-limits.same_contract_max] + limits.same_contract_window)
+        return t
+
+    def _next_ready(self, now: float) -> tuple[HistoricalJob | None, float | None]:
+        '''Returns a job that may be issued now, otherwise the time to wake up.'''
+        limits = self.limits
+        if len(self._in_flight) >= self.max_in_flight:
+            return None, None # woken up on completion
+        if len(self._global_sent) >= limits.global_max:
+            return None, self._global_sent[0] + limits.global_window
+        wake_at = None
+        for i, job in enumerate(self._pending):
+            t = self._earliest(job)
+            if t <= now:
+                del self._pending[i]
+                return job, None
+            wake_at = t if wake_at is None else min(wake_at, t)
+        return None, wake_at
+
+    def _issue(self, job: HistoricalJob, now: float) -> int:
+        '''Books the job in flight, with `_cond` held. Returns its reqId, to send it with.'''
+        job.req_id = reqId = self.app.nextId
+        job.attempts += 1
+        self._global_sent.append(now)
+        self._key_sent[job.pacing_key()].append(now)
+        self._identical_sent[job.identity_key()] = now
+        self._in_flight[reqId] = job
+        log.debug(f"Issuing {job.kind} request reqId={reqId}|pending={len(self._pending)}|inFlight={len(self._in_flight)}")
+        return reqId
+
+    def _send(self, job: HistoricalJob, reqId: int):
+        # Without `_cond`, errors for the request (e.g. not connected) come straight back to error()
+        if job.kind == BARS:
+            self.app.client.reqHistoricalData(reqId=reqId, contract=job.contract, **job.params)
+        else:
+            self.app.client.reqHistoricalTicks(reqId=reqId, contract=job.contract, **job.params)
+
+    def _next_job(self) -> tuple[HistoricalJob, int] | None:
+        '''Waits for a job that may be issued and issues it, None once stopped.'''
+        with self._cond:
+            while self._running:
+                now = self._clock()
+                self._prune(now)
+                job, wake_at = self._next_ready(now)
+                if job is not None:
+                    return job, self._issue(job, now)
+                timeout = None if wake_at is None else max(0.0, wake_at - now)
+                self._cond.wait(timeout)
+        return None
+
+    def _run(self):
+        while True:
+            issued = self._next_job()
+            if issued is None:
+                break
+            self._send(*issued)
+        log.info("Scheduler stopped, exiting thread")
@@ -0,0 +1,383 @@
+import logging
+import math
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from ibapi.contract import Contract
+
+from brokerplatform.ib.ticks import Interner
+
+log = logging.getLogger(__name__)
+
+# Per position (account, conId), NaN until received
+VALUE_FIELDS = ['position', 'avgCost', 'marketPrice', 'marketValue', 'unrealizedPnL', 'realizedPnL', 'dailyPnL',
+                'updated']
+# Per group, summed over its positions. `grossValue` is the sum of |marketValue|, `positions` the non-zero ones.
+AGG_FIELDS = ['marketValue', 'grossValue', 'unrealizedPnL', 'realizedPnL', 'dailyPnL', 'positions']
+# Account totals as sent by `pnl`
+ACCOUNT_PNL_FIELDS = ['dailyPnL', 'unrealizedPnL', 'realizedPnL']
+
+ACCOUNT, SECTOR, UNDERLYING = 'account', 'sector', 'underlying'
+GROUPS = (ACCOUNT, SECTOR, UNDERLYING)
+UNTAGGED = ''
+
+KEY_DTYPE = np.dtype([('conId', '<i8'), ('account', '<i4'), ('sector', '<i4'), ('underlying', '<i4')])
+
+_V = {name: i for i, name in enumerate(VALUE_FIELDS)}
+_POSITION, _AVG_COST, _PRICE, _VALUE, _UNREALIZED, _REALIZED, _DAILY, _UPDATED = range(len(VALUE_FIELDS))
+
+
+def _unset(value) -> float:
+    # None and Double.MAX_VALUE both mean "not available"
+    if value is None:
+        return math.nan
+    value = float(value)
+    return math.nan if abs(value) > 1e300 else value
+
+
+def _contrib(values: list[float]) -> list[float]:
+    '''What a position adds to its groups' `AGG_FIELDS`.'''
+    mv, unrealized, realized, daily = (0.0 if v != v else v for v in
+                                       (values[_VALUE], values[_UNREALIZED], values[_REALIZED], values[_DAILY]))
+    position = values[_POSITION]
+    return [mv, abs(mv), unrealized, realized, daily, 1.0 if position == position and position != 0 else 0.0]
+
+
+def _symbol(contract: Contract) -> str:
+    # Options and futures carry their underlying's symbol
+    return contract.symbol
+
+
+class PortfolioSnapshot:
+    """
+    Consistent copy of a `PortfolioState`: one row per (account, conId) in
+    `keys` (`KEY_DTYPE`, group codes) and `values` (`VALUE_FIELDS`), and the
+    per group `aggregates[kind]` (`AGG_FIELDS`) for each of `GROUPS`.
+    """
+
+    def __init__(self, version: int, keys: np.ndarray, values: np.ndarray, aggregates: dict[str, np.ndarray],
+                 names: dict[str, list[str]], account_pnl: np.ndarray, summary: dict[str, dict[str, tuple]]):
+        self.version = version
+        self.keys = keys
+        self.values = values
+        self.aggregates = aggregates
+        self.names = names
+        self._account_pnl = account_pnl
+        self._summary = summary
+
+    def field(self, name: str) -> np.ndarray:
+        return self.values[:, _V[name]]
+
+    def by(self, kind: str) -> pd.DataFrame:
+        '''Aggregates of one of `GROUPS`, indexed by group name.'''
+        return pd.DataFrame(self.aggregates[kind], index=pd.Index(self.names[kind], name=kind), columns=AGG_FIELDS)
+
+    def by_account(self) -> pd.DataFrame:
+        return self.by(ACCOUNT)
+
+    def by_sector(self) -> pd.DataFrame:
+        return self.by(SECTOR)
+
+    def by_underlying(self) -> pd.DataFrame:
+        return self.by(UNDERLYING)
+
+    def total(self) -> dict[str, float]:
+        return dict(zip(AGG_FIELDS, self.aggregates[ACCOUNT].sum(axis=0).tolist()))
+
+    def account_pnl(self) -> pd.DataFrame:
+        '''Account totals from `pnl`, which TWS computes itself (NaN if not tracked).'''
+        return pd.DataFrame(self._account_pnl, index=pd.Index(self.names[ACCOUNT], name=ACCOUNT),
+                            columns=ACCOUNT_PNL_FIELDS)
+
+    def summary(self, account: str) -> dict[str, tuple[str, str]]:
+        '''Account summary and account value tags, as tag -> (value, currency).'''
+        return self._summary.get(account, {})
+
+    def frame(self) -> pd.DataFrame:
+        df = pd.DataFrame({'conId': self.keys['conId']})
+        for kind in GROUPS:
+            df[kind] = pd.Categorical.from_codes(self.keys[kind], categories=self.names[kind])
+        for name in VALUE_FIELDS:
+            df[name] = self.field(name)
+        return df
+
+
+class PortfolioState:
+    """
+    Positions and PnL per (account, conId), from `updatePortfolio`,
+    `position`, `pnlSingle`, `pnl`, `accountSummary` and `updateAccountValue`,
+    kept in preallocated NumPy rows.
+
+    Totals per account, per sector tag and per underlying are maintained
+    incrementally: each callback updates one row and adds the difference it
+    makes to that row's three groups, so keeping them up to date is O(1) per
+    callback and risk checks never re-sum the book. Sectors are assigned with
+    `sector(contract)` or `tag()`, the underlying is the contract's symbol
+    unless `underlying(contract)` says otherwise.
+
+    Updates are written under a sequence number (odd while writing) that
+    `snapshot()` and `aggregate()` use as a seqlock: readers copy and retry
+    if a write happened meanwhile, the client's thread never waits for them.
+
+    ```
+    portfolio = PortfolioState(app, sector=lambda c: sectors.get(c.symbol, UNTAGGED))
+
+    class Handler(EWrapper):
+        def updatePortfolio(self, contract, position, marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL, accountName):
+            portfolio.updatePortfolio(contract, position, marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL, accountName)
+        def position(self, account, contract, position, avgCost):
+            portfolio.position(account, contract, position, avgCost)
+        def pnl(self, reqId, dailyPnL, unrealizedPnL, realizedPnL):
+            portfolio.pnl(reqId, dailyPnL, unrealizedPnL, realizedPnL)
+        def pnlSingle(self, reqId, pos, dailyPnL, unrealizedPnL, realizedPnL, value):
+            portfolio.pnlSingle(reqId, pos, dailyPnL, unrealizedPnL, realizedPnL, value)
+        def accountSummary(self, reqId, account, tag, value, currency):
+            portfolio.accountSummary(reqId, account, tag, value, currency)
+
+    app.client.reqPositions()
+    portfolio.track_pnl('U1234567')
+    portfolio.track_pnl('U1234567', contract.conId)
+    ...
+    portfolio.aggregate(UNDERLYING, 'SPY')['unrealizedPnL']
+    snap = portfolio.snapshot()
+    snap.by_sector(), snap.by_account(), snap.frame()
+    ```
+    """
+
+    def __init__(self, app=None, capacity: int = 256, sector: Callable[[Contract], str] | None = None,
+                 underlying: Callable[[Contract], str] = _symbol):
+        assert capacity > 0, "capacity must be greater than 0"
+        self.app = app
+        self.sector = sector
+        self.underlying = underlying
+        self.version = 0
+        self._keys = np.zeros(capacity, dtype=KEY_DTYPE)
+        self._values = np.full((capacity, len(VALUE_FIELDS)), np.nan)
+        self._n = 0
+        self._groups = {kind: Interner() for kind in GROUPS}
+        # Code 0, for positions with no sector or no contract yet
+        self._groups[SECTOR].code(UNTAGGED)
+        self._groups[UNDERLYING].code(UNTAGGED)
+        self._aggregates = {kind: np.zeros((16, len(AGG_FIELDS))) for kind in GROUPS}
+        self._account_pnl = np.full((16, len(ACCOUNT_PNL_FIELDS)), np.nan)
+        self._summary: dict[str, dict[str, tuple[str, str]]] = {}
+        self._rows: dict[tuple[str, int], int] = {} # (account, conId) -> row
+        self._conId_rows: dict[int, list[int]] = {}
+        self._sectors: dict[int, str] = {} # tags set with tag()
+        self._pnl_rows: dict[int, int] = {} # pnlSingle reqId -> row
+        self._pnl_accounts: dict[int, int] = {} # pnl reqId -> account code
+        self._seq = 0
+        self._lock = threading.Lock() # between writers only
+
+    def __len__(self) -> int:
+        return self._n
+
+    def track_pnl(self, account: str, conId: int | None = None, modelCode: str = "") -> int:
+        '''
+        Subscribes to the daily PnL of an account (`pnl`), or of one of its
+        positions (`pnlSingle`). Returns the reqId.
+        '''
+        with self._lock:
+            self._begin()
+            try:
+                if conId is None:
+                    code = self._code(ACCOUNT, account)
+                else:
+                    row = self._row(account, conId, None)
+            finally:
+                self._end()
+        # Routed before sending, the first update can arrive before subscribe returns
+        reqId = self.app.nextId
+        if conId is None:
+            self._pnl_accounts[reqId] = code
+            self.app.subscribe_pnl(account, modelCode, reqId=reqId)
+        else:
+            self._pnl_rows[reqId] = row
+            self.app.subscribe_pnl_single(account, conId, modelCode, reqId=reqId)
+        return reqId
+
+    def untrack_pnl(self, reqId: int):
+        self._pnl_rows.pop(reqId, None)
+        self._pnl_accounts.pop(reqId, None)
+        self.app.unsubscribe(reqId)
+
+    def tag(self, conId: int, sector: str):
+        '''Moves a contract's positions, in all accounts, to a sector.'''
+        self._sectors[conId] = sector
+        with self._lock:
+            self._begin()
+            try:
+                code = self._code(SECTOR, sector)
+                for row in self._conId_rows.get(conId, []):
+                    self._move(row, SECTOR, code)
+            finally:
+                self._end()
+
+    def aggregate(self, kind: str, group: str) -> dict[str, float]:
+        '''One group's `AGG_FIELDS`, e.g. `aggregate(ACCOUNT, 'U1234567')`, without a full snapshot.'''
+        code = self._groups[kind].get(group)
+        if code is None:
+            return dict.fromkeys(AGG_FIELDS, 0.0)
+        while True:
+            seq = self._seq
+            if seq & 1:
+                continue # write in progress
+            values = self._aggregates[kind][code].tolist()
+            if self._seq == seq:
+                return dict(zip(AGG_FIELDS, values))
+
+    def snapshot(self) -> PortfolioSnapshot:
+        '''Consistent copy of the rows and aggregates, copied again if written meanwhile.'''
+        while True:
+            seq = self._seq
+            if seq & 1:
+                continue # write in progress
+            n = self._n
+            keys, values = self._keys[:n].copy(), self._values[:n].copy()
+            names = {kind: list(interner.values) for kind, interner in self._groups.items()}
+            aggregates = {kind: agg[:len(names[kind])].copy() for kind, agg in self._aggregates.items()}
+            account_pnl = self._account_pnl[:len(names[ACCOUNT])].copy()
+            summary = {account: dict(tags) for account, tags in list(self._summary.items())}
+            version = self.version
+            if self._seq == seq:
+                return PortfolioSnapshot(version, keys, values, aggregates, names, account_pnl, summary)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def updatePortfolio(self, contract: Contract, position, marketPrice: float, marketValue: float,
+                        averageCost: float, unrealizedPNL: float, realizedPNL: float, accountName: str):
+        self._apply(accountName, contract.conId, contract, {
+            _POSITION: _unset(position), _PRICE: _unset(marketPrice), _VALUE: _unset(marketValue),
+            _AVG_COST: _unset(averageCost), _UNREALIZED: _unset(unrealizedPNL), _REALIZED: _unset(realizedPNL)})
+
+    def position(self, account: str, contract: Contract, position, avgCost: float):
+        self._apply(account, contract.conId, contract, {_POSITION: _unset(position), _AVG_COST: _unset(avgCost)})
+
+    def pnlSingle(self, reqId: int, pos, dailyPnL: float, unrealizedPnL: float, realizedPnL: float, value: float):
+        row = self._pnl_rows.get(reqId)
+        if row is None:
+            return
+        updates = {_DAILY: _unset(dailyPnL), _UNREALIZED: _unset(unrealizedPnL), _REALIZED: _unset(realizedPnL),
+                   _VALUE: _unset(value)}
+        position = _unset(pos)
+        if position == position:
+            updates[_POSITION] = position
+        with self._lock:
+            self._begin()
+            try:
+                self._write(row, updates)
+            finally:
+                self._end()
+
+    def pnl(self, reqId: int, dailyPnL: float, unrealizedPnL: float, realizedPnL: float):
+        code = self._pnl_accounts.get(reqId)
+        if code is None:
+            return
+        with self._lock:
+            self._begin()
+            try:
+                self._account_pnl[code] = (_unset(dailyPnL), _unset(unrealizedPnL), _unset(realizedPnL))
+            finally:
+                self._end()
+
+    def accountSummary(self, reqId: int, account: str, tag: str, value: str, currency: str):
+        tags = self._summary.get(account)
+        if tags is None:
+            tags = self._summary.setdefault(account, {})
+        tags[tag] = (value, currency)
+
+    def updateAccountValue(self, key: str, val: str, currency: str, accountName: str):
+        self.accountSummary(0, accountName, key, val, currency)
+
+    ##
+    # Internals
+    ##
+
+    def _begin(self):
+        self._seq += 1
+
+    def _end(self):
+        self.version += 1
+        self._seq += 1
+
+    def _apply(self, account: str, conId: int, contract: Contract, updates: dict[int, float]):
+        with self._lock:
+            self._begin()
+            try:
+                self._write(self._row(account, conId, contract), updates)
+            finally:
+                self._end()
+
+    def _write(self, row: int, updates: dict[int, float]):
+        old = self._values[row].tolist()
+        new = old.copy()
+        for i, value in updates.items():
+            new[i] = value
+        new[_UPDATED] = time.time()
+        self._values[row] = new
+        delta = np.subtract(_contrib(new), _contrib(old))
+        key = self._keys[row]
+        for kind in GROUPS:
+            self._aggregates[kind][key[kind]] += delta
+
+    def _row(self, account: str, conId: int, contract: Contract | None) -> int:
+        row = self._rows.get((account, conId))
+        if row is None:
+            if self._n == len(self._keys):
+                self._grow_rows()
+            row = self._n
+            self._keys[row] = (conId, self._code(ACCOUNT, account), self._code(SECTOR, UNTAGGED),
+                               self._code(UNDERLYING, UNTAGGED))
+            self._values[row] = np.nan
+            self._rows[(account, conId)] = row
+            self._conId_rows.setdefault(conId, []).append(row)
+            self._n += 1
+            if conId in self._sectors:
+                self._move(row, SECTOR, self._code(SECTOR, self._sectors[conId]))
+        if contract is not None and self._keys['underlying'][row] == 0:
+            # First time the contract is known (pnlSingle rows are added with the conId only)
+            self._move(row, UNDERLYING, self._code(UNDERLYING, self.underlying(contract)))
+            if self.sector and conId not in self._sectors:
+                self._move(row, SECTOR, self._code(SECTOR, self.sector(contract) or UNTAGGED))
+        return row
+
+    def _move(self, row: int, kind: str, code: int):
+        '''Moves a row to another group of `kind`, taking its contribution along.'''
+        old = self._keys[kind][row]
+        if old == code:
+            return
+        contrib = _contrib(self._values[row].tolist())
+        aggregates = self._aggregates[kind]
+        aggregates[old] -= contrib
+        aggregates[code] += contrib
+        self._keys[kind][row] = code
+
+    def _code(self, kind: str, group: str) -> int:
+        code = self._groups[kind].code(group)
+        if code >= len(self._aggregates[kind]):
+            self._grow_groups(kind)
+        return code
+
+    def _grow_rows(self):
+        capacity = 2 * len(self._keys)
+        log.debug(f"Growing portfolio rows|capacity={capacity}")
+        keys = np.zeros(capacity, dtype=KEY_DTYPE)
+        keys[:self._n] = self._keys[:self._n]
+        values = np.full((capacity, len(VALUE_FIELDS)), np.nan)
+        values[:self._n] = self._values[:self._n]
+        self._keys, self._values = keys, values
+
+    def _grow_groups(self, kind: str):
+        aggregates = self._aggregates[kind]
+        grown = np.zeros((2 * len(aggregates), len(AGG_FIELDS)))
+        grown[:len(aggregates)] = aggregates
+        self._aggregates[kind] = grown
+        if kind == ACCOUNT:
+            account_pnl = np.full((len(grown), len(ACCOUNT_PNL_FIELDS)), np.nan)
+            account_pnl[:len(self._account_pnl)] = self._account_pnl
+            self._account_pnl = account_pnl
@@ -0,0 +1,186 @@
+import datetime as dt
+import logging
+import threading
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from ibapi.contract import Contract
+
+from brokerplatform.ib.history import to_frame
+
+log = logging.getLogger(__name__)
+
+# IB only supports 5 second real time bars
+REALTIME_BAR_SIZE = 5
+
+REALTIME_BAR_DTYPE = np.dtype([('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                               ('volume', '<f8'), ('wap', '<f8'), ('count', '<i8')])
+
+
+def realtime_key(contract: Contract, whatToShow: str, useRTH: bool) -> tuple:
+    c = contract
+    return (c.conId or None, c.symbol, c.secType, c.exchange, c.currency, c.lastTradeDateOrContractMonth,
+            c.localSymbol, whatToShow, bool(useRTH))
+
+
+class BarRing:
+    """
+    One consumer's bars: a preallocated ring of `capacity` bars, written by
+    the hub on the client's thread and read with `poll()` from any thread.
+    A consumer that falls more than `capacity` bars behind loses the oldest
+    ones, counted in `missed`, without holding up the other consumers.
+    """
+
+    def __init__(self, key: tuple, capacity: int = 1024, on_bar: Callable[['BarRing'], None] | None = None):
+        assert capacity > 0, "capacity must be greater than 0"
+        self.key = key
+        self.capacity = capacity
+        self.on_bar = on_bar
+        self.missed = 0
+        self.error: tuple[int, str] | None = None
+        self._bars = np.zeros(capacity, dtype=REALTIME_BAR_DTYPE)
+        self._written = 0 # bars ever written, the next one goes to _written % capacity
+        self._read = 0
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        '''Bars written and not polled yet.'''
+        return min(self._written - self._read, self.capacity)
+
+    @property
+    def latest(self) -> np.void | None:
+        written = self._written
+        return self._bars[(written - 1) % self.capacity].copy() if written else None
+
+    def poll(self) -> np.ndarray:
+        '''The bars written since the last poll, oldest first, as a `REALTIME_BAR_DTYPE` array.'''
+        with self._cond:
+            start, end = self._read, self._written
+            if end - start > self.capacity:
+                self.missed += end - start - self.capacity
+                start = end - self.capacity
+            idx = np.arange(start, end) % self.capacity
+            self._read = end
+            return self._bars[idx]
+
+    def wait(self, timeout: float | None = None) -> bool:
+        '''Blocks until there are bars to poll. Returns False on timeout.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: self._written > self._read, timeout)
+
+    def frame(self, tz=dt.UTC) -> pd.DataFrame:
+        '''Polls the new bars as a frame in the `divdetect.get_ohlcv` layout, plus `wap` and `count`.'''
+        bars = self.poll()
+        df = to_frame({name: bars[name] for name in REALTIME_BAR_DTYPE.names}, tz)
+        df['wap'] = bars['wap']
+        df['count'] = bars['count']
+        return df
+
+    def push(self, bar: tuple):
+        with self._cond:
+            self._bars[self._written % self.capacity] = bar
+            self._written += 1
+            self._cond.notify_all()
+        if self.on_bar:
+            self.on_bar(self)
+
+
+class RealtimeBarHub:
+    """
+    Shares `reqRealTimeBars` subscriptions between consumers in the same
+    process. Subscriptions are de-duplicated by (contract, whatToShow,
+    useRTH): the first consumer subscribes, further ones only add a ring to
+    the fan-out, and the subscription is cancelled when its last consumer
+    unsubscribes. Each consumer gets its own `BarRing`, so a slow strategy
+    never delays another.
+
+    ```
+    hub = RealtimeBarHub(app)
+
+    class Handler(EWrapper):
+        def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+            hub.realtimeBar(reqId, time, open_, high, low, close, volume, wap, count)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            hub.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+
+    bars = hub.subscribe(contract, 'TRADES') # subscribes
+    more = hub.subscribe(contract, 'TRADES') # shares the same subscription
+    while bars.wait():
+        strategy.on_bars(bars.poll())
+    ...
+    hub.unsubscribe(bars)
+    hub.unsubscribe(more) # cancels
+    ```
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._req_ids: dict[tuple, int] = {}
+        self._rings: dict[int, list[BarRing]] = {} # reqId -> consumers
+        self._lock = threading.Lock()
+
+    def subscribe(self, contract: Contract, whatToShow: str = 'TRADES', useRTH: bool = False, capacity: int = 1024,
+                  on_bar: Callable[[BarRing], None] | None = None) -> BarRing:
+        '''
+        Adds a consumer, `on_bar(ring)` is called on the client's thread
+        after each bar is written.
+        '''
+        key = realtime_key(contract, whatToShow, useRTH)
+        ring = BarRing(key, capacity, on_bar)
+        with self._lock:
+            reqId = self._req_ids.get(key)
+            if reqId is None:
+                reqId = self._req_ids[key] = self.app.subscribe_realtime_bars(contract, REALTIME_BAR_SIZE,
+                                                                              whatToShow, useRTH)
+                log.info(f"Subscribed real time bars|reqId={reqId}|symbol={contract.symbol}|whatToShow={whatToShow}")
+            # Copy on write, `realtimeBar` iterates without the lock
+            self._rings[reqId] = self._rings.get(reqId, []) + [ring]
+        return ring
+
+    def unsubscribe(self, ring: BarRing):
+        with self._lock:
+            reqId = self._req_ids.get(ring.key)
+            rings = self._rings.get(reqId, [])
+            if ring not in rings:
+                return
+            rings = [r for r in rings if r is not ring]
+            if rings:
+                self._rings[reqId] = rings
+                return
+            del self._rings[reqId], self._req_ids[ring.key]
+        self.app.unsubscribe(reqId)
+        log.info(f"Cancelled real time bars|reqId={reqId}")
+
+    def consumers(self, contract: Contract, whatToShow: str = 'TRADES', useRTH: bool = False) -> int:
+        reqId = self._req_ids.get(realtime_key(contract, whatToShow, useRTH))
+        return len(self._rings.get(reqId, []))
+
+    @property
+    def subscriptions(self) -> int:
+        return len(self._req_ids)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def realtimeBar(self, reqId: int, time: int, open_: float, high: float, low: float, close: float,
+                    volume, wap, count: int):
+        rings = self._rings.get(reqId)
+        if rings is None:
+            # The first bar can arrive before `subscribe()` has registered the ring
+            with self._lock:
+                rings = self._rings.get(reqId)
+        if not rings:
+            return
+        bar = (time, open_, high, low, close, float(volume), float(wap), count)
+        for ring in rings:
+            ring.push(bar)
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        rings = self._rings.get(reqId)
+        if not rings:
+            return
+        log.warning(f"Real time bars error|reqId={reqId}|code={errorCode}|msg={errorString}")
+        for ring in rings:
+            ring.error = (errorCode, errorString)
@@ -0,0 +1,283 @@
+import copy
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+import numpy as np
+from ibapi.contract import Contract, ContractDetails
+from ibapi.scanner import ScannerSubscription
+
+from brokerplatform.ib.app import MAX_MESSAGES_PER_SECOND
+
+log = logging.getLogger(__name__)
+
+# TWS allows this many scanner subscriptions at once (fewer on some accounts)
+MAX_CONCURRENT_SCANNERS = 10
+# Informational "Historical Market Data Service query message", not a failure
+SCANNER_QUERY_MESSAGE = 165
+# Market data subscriptions sent per second, with headroom under the TWS message rate limit
+SUBSCRIBE_RATE = MAX_MESSAGES_PER_SECOND - 10
+
+SCAN_DTYPE = np.dtype([('rank', '<i4'), ('conId', '<i8')])
+
+
+@dataclass(eq=False)
+class Scan:
+    '''A scanner and the rows of its latest complete cycle, sorted by rank.'''
+    name: str
+    subscription: ScannerSubscription
+    options: list = field(default_factory=list)
+    filter_options: list = field(default_factory=list)
+    rows: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=SCAN_DTYPE))
+    cycles: int = 0
+    updated: float | None = None
+    error: tuple[int, str] | None = None
+    req_id: int | None = field(default=None, repr=False)
+
+    @property
+    def conIds(self) -> np.ndarray:
+        return self.rows['conId']
+
+
+class ScannerManager:
+    """
+    Runs any number of market scanners and keeps market data subscribed for
+    the union of their results.
+
+    Each cycle of `scannerData` rows (up to `scannerDataEnd`) is collected
+    into an array and diffed with the previous cycle of the same scan: only
+    contracts entering the results get `reqMktData`, and contracts leaving all
+    scans get `cancelMktData`, instead of resubscribing everything on every
+    refresh. Subscriptions are reference counted across scans. New
+    subscriptions are queued and sent from a background thread at
+    `SUBSCRIBE_RATE` per second, so a first cycle of hundreds of rows does not
+    exceed the TWS message rate; contracts leaving before their turn are
+    never subscribed.
+
+    At most `max_concurrent` scanners are subscribed at once. Further scans
+    wait in a queue; whenever a scan completes a cycle while others are
+    waiting, it is cancelled and goes to the back of the queue, so they take
+    turns. Scanner and market data subscriptions are made with
+    `TwsApp.subscribe_*`, so they are replayed on reconnect.
+
+    ```
+    scanners = ScannerManager(app, on_change=strategy.on_scan)
+
+    class Handler(EWrapper):
+        def scannerData(self, reqId, rank, contractDetails, distance, benchmark, projection, legsStr):
+            scanners.scannerData(reqId, rank, contractDetails, distance, benchmark, projection, legsStr)
+        def scannerDataEnd(self, reqId):
+            scanners.scannerDataEnd(reqId)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            scanners.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+        def tickPrice(self, reqId, tickType, price, attrib):
+            conId = scanners.conId(reqId)
+            ...
+
+    s = ScannerSubscription()
+    s.instrument, s.locationCode, s.scanCode = 'STK', 'STK.US.MAJOR', 'TOP_PERC_GAIN'
+    scanners.add('gainers', s)
+    ```
+
+    `on_change(scan, entered, left)` is called on the client's thread after
+    each cycle, with the conIds that entered and left the scan's results.
+    """
+
+    def __init__(self, app, max_concurrent: int = MAX_CONCURRENT_SCANNERS, subscribe: bool = True,
+                 generic_tick_list: str = "",
+                 on_change: Callable[[Scan, np.ndarray, np.ndarray], None] | None = None):
+        assert max_concurrent > 0, "max_concurrent must be greater than 0"
+        self.app = app
+        self.max_concurrent = max_concurrent
+        self.subscribe = subscribe
+        self.generic_tick_list = generic_tick_list
+        self.on_change = on_change
+        self.subscribes = 0
+        self.unsubscribes = 0
+        self._scans: dict[str, Scan] = {}
+        self._active: dict[int, Scan] = {}
+        self._waiting: deque[Scan] = deque()
+        self._cycle: dict[int, list[tuple[int, ContractDetails]]] = {} # reqId -> (rank, details) rows
+        self._details: dict[int, ContractDetails] = {} # of the held conIds
+        self._refs: dict[int, int] = {}
+        self._queued: dict[int, None] = {} # conIds waiting for their market data subscription, in order
+        self._mkt_data: dict[int, int] = {} # conId -> reqMktData reqId
+        self._conIds: dict[int, int] = {} # reqMktData reqId -> conId
+        self._lock = threading.RLock()
+        self._drainer = None
+
+    def add(self, name: str, subscription: ScannerSubscription, options: list | None = None,
+            filter_options: list | None = None) -> Scan:
+        scan = Scan(name, subscription, options or [], filter_options or [])
+        with self._lock:
+            assert name not in self._scans, f"scan '{name}' already exists"
+            self._scans[name] = scan
+            self._waiting.append(scan)
+            self._start_waiting()
+        return scan
+
+    def remove(self, name: str):
+        '''Stops a scan, unsubscribing the contracts no other scan holds.'''
+        with self._lock:
+            scan = self._scans.pop(name)
+            if scan.req_id is not None:
+                self._cancel(scan)
+            elif scan in self._waiting:
+                self._waiting.remove(scan)
+            self._release(scan.conIds)
+            scan.rows = np.empty(0, dtype=SCAN_DTYPE)
+            self._start_waiting()
+
+    def stop(self):
+        for name in list(self._scans):
+            self.remove(name)
+
+    def scan(self, name: str) -> Scan:
+        return self._scans[name]
+
+    @property
+    def scans(self) -> list[Scan]:
+        return list(self._scans.values())
+
+    @property
+    def subscribed(self) -> set[int]:
+        '''conIds held by the scans, with market data subscribed or queued.'''
+        return set(self._refs)
+
+    @property
+    def queued(self) -> int:
+        '''Market data subscriptions waiting to be sent.'''
+        return len(self._queued)
+
+    def details(self, conId: int) -> ContractDetails | None:
+        return self._details.get(conId)
+
+    def mkt_data_req_id(self, conId: int) -> int | None:
+        '''The market data reqId of a conId, None while its subscription is queued.'''
+        return self._mkt_data.get(conId)
+
+    def conId(self, reqId: int) -> int | None:
+        '''The conId of a market data reqId, for routing ticks.'''
+        return self._conIds.get(reqId)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def scannerData(self, reqId: int, rank: int, contractDetails: ContractDetails, distance: str, benchmark: str,
+                    projection: str, legsStr: str):
+        if reqId not in self._active:
+            return
+        self._cycle.setdefault(reqId, []).append((rank, contractDetails))
+
+    def scannerDataEnd(self, reqId: int):
+        with self._lock:
+            scan = self._active.get(reqId)
+            if scan is None:
+                return
+            cycle = self._cycle.pop(reqId, [])
+            rows = np.array([(rank, d.contract.conId) for rank, d in cycle], dtype=SCAN_DTYPE)
+            rows.sort(order='rank')
+            for _, d in cycle:
+                self._details[d.contract.conId] = d
+            new, old = np.unique(rows['conId']), np.unique(scan.conIds)
+            entered = np.setdiff1d(new, old, assume_unique=True)
+            left = np.setdiff1d(old, new, assume_unique=True)
+            scan.rows = rows
+            scan.cycles += 1
+            scan.updated = time.time()
+            self._hold(entered)
+            self._release(left)
+            if self._waiting:
+                # Make room for the next scan, this one goes to the back of the queue
+                self._cancel(scan)
+                self._waiting.append(scan)
+                self._start_waiting()
+        log.debug(f"Scan {scan.name}: cycle {scan.cycles}|rows={len(rows)}|entered={len(entered)}|left={len(left)}")
+        if self.on_change and (len(entered) or len(left)):
+            self.on_change(scan, entered, left)
+
+    def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+        if errorCode == SCANNER_QUERY_MESSAGE:
+            return
+        with self._lock:
+            scan = self._active.get(reqId)
+            if scan is None:
+                return
+            log.warning(f"Scan {scan.name} failed: {errorCode}|{errorString}")
+            scan.error = (errorCode, errorString)
+            self._cancel(scan)
+            self._start_waiting()
+
+    ##
+    # Internals
+    ##
+
+    def _start_waiting(self):
+        while self._waiting and len(self._active) < self.max_concurrent:
+            scan = self._waiting.popleft()
+            scan.error = None
+            scan.req_id = self.app.subscribe_scanner(scan.subscription, scan.options, scan.filter_options)
+            self._active[scan.req_id] = scan
+
+    def _cancel(self, scan: Scan):
+        self._active.pop(scan.req_id, None)
+        self._cycle.pop(scan.req_id, None)
+        self.app.unsubscribe(scan.req_id)
+        scan.req_id = None
+
+    def _hold(self, conIds: np.ndarray):
+        for conId in conIds.tolist():
+            refs = self._refs.get(conId, 0)
+            self._refs[conId] = refs + 1
+            if refs == 0 and self.subscribe:
+                self._queued[conId] = None
+        if self._queued and self._drainer is None:
+            self._drainer = threading.Thread(target=self._drain, name='ScannerManager', daemon=True)
+            self._drainer.start()
+
+    def _release(self, conIds: np.ndarray):
+        for conId in conIds.tolist():
+            refs = self._refs.get(conId, 0) - 1
+            if refs > 0:
+                self._refs[conId] = refs
+                continue
+            self._refs.pop(conId, None)
+            self._details.pop(conId, None)
+            self._queued.pop(conId, None)
+            reqId = self._mkt_data.pop(conId, None)
+            if reqId is not None:
+                del self._conIds[reqId]
+                self.app.unsubscribe(reqId)
+                self.unsubscribes += 1
+
+    def _drain(self):
+        # Sends the queued subscriptions, SUBSCRIBE_RATE per second
+        while True:
+            with self._lock:
+                batch = list(itertools.islice(self._queued, SUBSCRIBE_RATE))
+                if not batch:
+                    self._drainer = None
+                    return
+                for conId in batch:
+                    del self._queued[conId]
+                    reqId = self.app.subscribe_mkt_data(_mkt_data_contract(self._details[conId].contract),
+                                                        self.generic_tick_list)
+                    self._mkt_data[conId] = reqId
+                    self._conIds[reqId] = conId
+                    self.subscribes += 1
+            log.debug(f"Subscribed {len(batch)} scanned contracts|queued={len(self._queued)}")
+            time.sleep(1)
+
+
+def _mkt_data_contract(c: Contract) -> Contract:
+    # Scanner results may leave the exchange empty
+    if c.exchange:
+        return c
+    c = copy.copy(c)
+    c.exchange = 'SMART'
+    return c
@@ -0,0 +1,353 @@
+"""
+Shared memory market data bus: one process owns the gateway connection and
+publishes ticks and bars, any number of strategy processes read them.
+
+The shared memory block holds:
+
+* a header (`_HEADER`): layout, the publisher's resource tracker, and the number of
+  events written to each ring,
+* a stream table: (reqId, seq) per market data request, `seq` counting the
+  events published for it,
+* a ring of `TICK_DTYPE` events and a ring of `BAR_DTYPE` events.
+
+There is a single writer. Each event carries its position in the ring
+(`seq`) and in its stream (`stream_seq`), readers keep their own read
+position and detect being lapped by the writer instead of taking any lock.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = 0x49425553 # 'IBUS'
+
+# Event kinds in the tick ring
+PRICE = 1    # tickPrice: price
+SIZE = 2     # tickSize: size
+TRADE = 3    # tickByTickAllLast: price, size
+QUOTE = 4    # tickByTickBidAsk: price/size are the bid, ask/ask_size the ask
+MIDPOINT = 5 # tickByTickMidPoint: price
+
+TICK_DTYPE = np.dtype([('seq', '<i8'), ('stream_seq', '<i8'), ('reqId', '<i4'), ('kind', '<i2'), ('tickType', '<i2'),
+                       ('time', '<f8'), ('price', '<f8'), ('size', '<f8'), ('ask', '<f8'), ('ask_size', '<f8')])
+BAR_DTYPE = np.dtype([('seq', '<i8'), ('stream_seq', '<i8'), ('reqId', '<i4'), ('time', '<i8'), ('open', '<f8'),
+                      ('high', '<f8'), ('low', '<f8'), ('close', '<f8'), ('volume', '<f8'), ('wap', '<f8'),
+                      ('count', '<i8')])
+STREAM_DTYPE = np.dtype([('reqId', '<i8'), ('seq', '<i8')])
+
+# Header slots, all int64
+_MAGIC, _TICK_CAPACITY, _BAR_CAPACITY, _MAX_STREAMS, _TICKS_WRITTEN, _BARS_WRITTEN, _STREAMS, _TRACKER = range(8)
+_HEADER = 8
+
+# Sleep between checks while waiting for events
+POLL_INTERVAL = 0.0005
+
+# Before Python 3.13 attaching to a block registers it with the resource tracker, to be removed at exit
+_ATTACH_TRACKS = sys.version_info < (3, 13)
+
+
+def _layout(tick_capacity: int, bar_capacity: int, max_streams: int) -> tuple[int, int, int, int]:
+    '''Offsets of the stream table, tick ring and bar ring, and the total size.'''
+    streams = _HEADER * 8
+    ticks = streams + max_streams * STREAM_DTYPE.itemsize
+    bars = ticks + tick_capacity * TICK_DTYPE.itemsize
+    return streams, ticks, bars, bars + bar_capacity * BAR_DTYPE.itemsize
+
+
+def _tracker_id() -> int:
+    '''
+    Identifies the resource tracker this process registers with, by the inode
+    of its pipe: forked and spawned children share their parent's tracker.
+    '''
+    fd = resource_tracker._resource_tracker._fd
+    return os.fstat(fd).st_ino if fd is not None else 0
+
+
+class _Views:
+    '''NumPy views over a bus' shared memory block.'''
+
+    def __init__(self, shm: shared_memory.SharedMemory, tick_capacity: int, bar_capacity: int, max_streams: int):
+        streams, ticks, bars, _ = _layout(tick_capacity, bar_capacity, max_streams)
+        buf = shm.buf
+        self.header = np.ndarray(_HEADER, dtype=np.int64, buffer=buf)
+        self.streams = np.ndarray(max_streams, dtype=STREAM_DTYPE, buffer=buf, offset=streams)
+        self.ticks = np.ndarray(tick_capacity, dtype=TICK_DTYPE, buffer=buf, offset=ticks)
+        self.bars = np.ndarray(bar_capacity, dtype=BAR_DTYPE, buffer=buf, offset=bars)
+
+
+class MarketDataBus:
+    """
+    Publishes ticks and real time bars into shared memory, for `BusReader`s
+    in other processes. Forward the callbacks to publish from the message
+    handler, on the client's thread (the bus has a single writer):
+
+    ```
+    bus = MarketDataBus('ibus', tick_capacity=1 << 18)
+
+    class Handler(EWrapper):
+        def tickPrice(self, reqId, tickType, price, attrib):
+            bus.tickPrice(reqId, tickType, price, attrib)
+        def tickSize(self, reqId, tickType, size):
+            bus.tickSize(reqId, tickType, size)
+        def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+            bus.realtimeBar(reqId, time, open_, high, low, close, volume, wap, count)
+
+    # in each strategy process
+    reader = BusReader('ibus')
+    while reader.wait_ticks():
+        ticks = reader.poll_ticks() # zero-copy view
+        strategy.on_ticks(ticks)
+        if not reader.ticks_intact():
+            ... # lapped by the writer while processing, results are suspect
+    ```
+
+    Capacities are rounded up to powers of 2. `close()` releases and removes
+    the block, readers attached to it keep their mapping until they close.
+    """
+
+    def __init__(self, name: str | None = None, tick_capacity: int = 1 << 16, bar_capacity: int = 1 << 12,
+                 max_streams: int = 1024):
+        assert tick_capacity > 0 and bar_capacity > 0, "capacities must be greater than 0"
+        assert max_streams > 0, "max_streams must be greater than 0"
+        tick_capacity = 1 << (tick_capacity - 1).bit_length()
+        bar_capacity = 1 << (bar_capacity - 1).bit_length()
+        size = _layout(tick_capacity, bar_capacity, max_streams)[3]
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        self.tick_capacity = tick_capacity
+        self.bar_capacity = bar_capacity
+        self.max_streams = max_streams
+        self._views = _Views(self.shm, tick_capacity, bar_capacity, max_streams)
+        self._views.streams[:] = 0
+        header = self._views.header
+        header[:] = 0
+        header[_TICK_CAPACITY], header[_BAR_CAPACITY], header[_MAX_STREAMS] = tick_capacity, bar_capacity, max_streams
+        header[_TRACKER] = _tracker_id()
+        header[_MAGIC] = MAGIC # last, readers check it before trusting the rest
+        self._slots: dict[int, int] = {}
+        log.info(f"Market data bus {self.name}: {size / 2**20:.1f} MiB|ticks={tick_capacity}|bars={bar_capacity}")
+
+    def close(self):
+        self._views = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def publish_tick(self, reqId: int, kind: int, tickType: int, price: float = np.nan, size: float = np.nan,
+                     ask: float = np.nan, ask_size: float = np.nan, when: float | None = None):
+        views = self._views
+        header = views.header
+        stream_seq = self._next_stream_seq(reqId)
+        written = int(header[_TICKS_WRITTEN])
+        views.ticks[written & (self.tick_capacity - 1)] = (
+            written + 1, stream_seq, reqId, kind, tickType, time.time() if when is None else when,
+            price, size, ask, ask_size)
+        header[_TICKS_WRITTEN] = written + 1
+
+    def publish_bar(self, reqId: int, when: int, open_: float, high: float, low: float, close: float, volume: float,
+                    wap: float, count: int):
+        views = self._views
+        header = views.header
+        stream_seq = self._next_stream_seq(reqId)
+        written = int(header[_BARS_WRITTEN])
+        views.bars[written & (self.bar_capacity - 1)] = (
+            written + 1, stream_seq, reqId, when, open_, high, low, close, volume, wap, count)
+        header[_BARS_WRITTEN] = written + 1
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib):
+        self.publish_tick(reqId, PRICE, tickType, price=price)
+
+    def tickSize(self, reqId: int, tickType: int, size):
+        self.publish_tick(reqId, SIZE, tickType, size=float(size))
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float, size,
+                          tickAttribLast, exchange: str, specialConditions: str):
+        self.publish_tick(reqId, TRADE, tickType, price=price, size=float(size), when=time)
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize, askSize, tickAttribBidAsk):
+        self.publish_tick(reqId, QUOTE, 0, price=bidPrice, size=float(bidSize), ask=askPrice,
+                          ask_size=float(askSize), when=time)
+
+    def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
+        self.publish_tick(reqId, MIDPOINT, 0, price=midPoint, when=time)
+
+    def realtimeBar(self, reqId: int, time: int, open_: float, high: float, low: float, close: float,
+                    volume, wap, count: int):
+        self.publish_bar(reqId, time, open_, high, low, close, float(volume), float(wap), count)
+
+    ##
+    # Internals
+    ##
+
+    def _next_stream_seq(self, reqId: int) -> int:
+        slot = self._slots.get(reqId)
+        streams = self._views.streams
+        if slot is None:
+            if len(self._slots) == self.max_streams:
+                raise OverflowError(f"All {self.max_streams} bus streams are in use")
+            slot = self._slots[reqId] = len(self._slots)
+            streams[slot] = (reqId, 0)
+            self._views.header[_STREAMS] = len(self._slots)
+        seq = int(streams['seq'][slot]) + 1
+        streams['seq'][slot] = seq
+        return seq
+
+
+class _RingReader:
+    __slots__ = ('ring', 'header', 'slot', 'capacity', 'read', 'batch_start', 'missed')
+
+    def __init__(self, ring: np.ndarray, header: np.ndarray, slot: int, from_start: bool):
+        self.ring = ring
+        self.header = header
+        self.slot = slot
+        self.capacity = len(ring)
+        written = int(header[slot])
+        self.read = max(0, written + 1 - self.capacity) if from_start else written
+        self.batch_start = self.read
+        self.missed = 0
+
+    def available(self) -> int:
+        return int(self.header[self.slot]) - self.read
+
+    def poll(self, max_events: int | None) -> np.ndarray:
+        written = int(self.header[self.slot])
+        # The writer fills event `written` before publishing it, overwriting
+        # event `written - capacity`, so only the events after that are whole
+        oldest = written + 1 - self.capacity
+        if self.read < oldest:
+            self.missed += oldest - self.read
+            self.read = oldest
+        start = self.read & (self.capacity - 1)
+        # Up to the end of the ring, the rest comes with the next poll
+        n = min(written - self.read, self.capacity - start)
+        if max_events is not None:
+            n = min(n, max_events)
+        self.batch_start = self.read
+        self.read += n
+        return self.ring[start:start + n]
+
+    def intact(self) -> bool:
+        '''Whether the last polled batch has not been overwritten since.'''
+        return int(self.header[self.slot]) + 1 - self.capacity <= self.batch_start
+
+
+class BusReader:
+    """
+    Attaches to a `MarketDataBus` by name, from any process. `poll_ticks()`
+    and `poll_bars()` return the events written since the last poll as
+    zero-copy views into the shared ring, oldest first; `ticks_intact()`/
+    `bars_intact()` tell whether the writer has lapped the last batch since
+    (copy the batch, or check afterwards, when processing may be slow).
+
+    Reading starts with the events written from now on, or with everything
+    still in the rings with `from_start=True`. Events overwritten before they
+    were read are counted in `missed_ticks`/`missed_bars`; per reqId, gaps in
+    `stream_seq` show what was missed.
+    """
+
+    def __init__(self, name: str, from_start: bool = False):
+        if _ATTACH_TRACKS:
+            self.shm = shared_memory.SharedMemory(name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        header = np.ndarray(_HEADER, dtype=np.int64, buffer=self.shm.buf)
+        publisher_tracker = int(header[_TRACKER]) if header[_MAGIC] == MAGIC else None
+        if _ATTACH_TRACKS and publisher_tracker != _tracker_id():
+            # Only the publisher removes the block. A tracker shared with the publisher (in its own
+            # process or children) holds the publisher's registration, which must stay.
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        if header[_MAGIC] != MAGIC:
+            self.shm.close()
+            raise ValueError(f"Shared memory block '{name}' is not a market data bus")
+        self.name = name
+        self._views = _Views(self.shm, int(header[_TICK_CAPACITY]), int(header[_BAR_CAPACITY]),
+                             int(header[_MAX_STREAMS]))
+        self._ticks = _RingReader(self._views.ticks, self._views.header, _TICKS_WRITTEN, from_start)
+        self._bars = _RingReader(self._views.bars, self._views.header, _BARS_WRITTEN, from_start)
+
+    def close(self):
+        self._views = self._ticks = self._bars = None
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def missed_ticks(self) -> int:
+        return self._ticks.missed
+
+    @property
+    def missed_bars(self) -> int:
+        return self._bars.missed
+
+    def streams(self) -> np.ndarray:
+        '''Copy of the stream table, (reqId, seq) for each reqId published so far.'''
+        return self._views.streams[:int(self._views.header[_STREAMS])].copy()
+
+    def stream_seq(self, reqId: int) -> int:
+        '''Number of events published for a reqId, 0 if none.'''
+        streams = self._views.streams[:int(self._views.header[_STREAMS])]
+        slot = np.flatnonzero(streams['reqId'] == reqId)
+        return int(streams['seq'][slot[0]]) if len(slot) else 0
+
+    def poll_ticks(self, max_events: int | None = None) -> np.ndarray:
+        return self._ticks.poll(max_events)
+
+    def poll_bars(self, max_events: int | None = None) -> np.ndarray:
+        return self._bars.poll(max_events)
+
+    def ticks_intact(self) -> bool:
+        return self._ticks.intact()
+
+    def bars_intact(self) -> bool:
+        return self._bars.intact()
+
+    def wait_ticks(self, timeout: float | None = None) -> bool:
+        '''Blocks until there are ticks to poll. Returns False on timeout.'''
+        return self._wait(self._ticks, timeout)
+
+    def wait_bars(self, timeout: float | None = None) -> bool:
+        return self._wait(self._bars, timeout)
+
+    async def next_ticks(self, max_events: int | None = None) -> np.ndarray:
+        '''Awaits and polls the next ticks.'''
+        while not self._ticks.available():
+            await asyncio.sleep(POLL_INTERVAL)
+        return self._ticks.poll(max_events)
+
+    async def next_bars(self, max_events: int | None = None) -> np.ndarray:
+        while not self._bars.available():
+            await asyncio.sleep(POLL_INTERVAL)
+        return self._bars.poll(max_events)
+
+    ##
+    # Internals
+    ##
+
+    @staticmethod
+    def _wait(ring: _RingReader, timeout: float | None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not ring.available():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
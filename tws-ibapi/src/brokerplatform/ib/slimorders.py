@@ -0,0 +1,297 @@
+import logging
+from typing import Callable, Iterable
+
+from ibapi.client import EClient
+from ibapi.const import UNSET_DOUBLE
+from ibapi.decoder import Decoder, HandleInfo
+from ibapi.message import IN
+from ibapi.order_condition import OrderCondition
+from ibapi.server_versions import MIN_SERVER_VER_FA_PROFILE_DESUPPORT, MIN_SERVER_VER_ORDER_CONTAINER
+from ibapi.utils import BadMessage, isPegBenchOrder
+
+log = logging.getLogger(__name__)
+
+
+def _str(s: bytes) -> str:
+    return s.decode(errors='backslashreplace')
+
+
+def _int(s: bytes) -> int:
+    return int(s or 0)
+
+
+def _float(s: bytes) -> float:
+    return float(s or 0)
+
+
+def _price(s: bytes) -> float:
+    # Prices are sent empty when unset
+    return float(s) if s else UNSET_DOUBLE
+
+
+def _bool(s: bytes) -> bool:
+    return int(s or 0) != 0
+
+
+# Fields at a fixed position in `openOrder` and `completedOrder` messages, as
+# (offset in openOrder, offset in completedOrder, decoder). Offsets after the FA
+# params move by one while the server still sends the deprecated faProfile.
+_FIXED_FIELDS = {
+    'orderId': (0, None, _int),
+    'conId': (1, 0, _int),
+    'symbol': (2, 1, _str),
+    'secType': (3, 2, _str),
+    'lastTradeDateOrContractMonth': (4, 3, _str),
+    'strike': (5, 4, _float),
+    'right': (6, 5, _str),
+    'multiplier': (7, 6, _str),
+    'exchange': (8, 7, _str),
+    'currency': (9, 8, _str),
+    'localSymbol': (10, 9, _str),
+    'tradingClass': (11, 10, _str),
+    'action': (12, 11, _str),
+    'totalQuantity': (13, 12, _float),
+    'orderType': (14, 13, _str),
+    'lmtPrice': (15, 14, _price),
+    'auxPrice': (16, 15, _price),
+    'tif': (17, 16, _str),
+    'ocaGroup': (18, 17, _str),
+    'account': (19, 18, _str),
+    'orderRef': (22, 21, _str),
+    'clientId': (23, None, _int),
+    'permId': (24, 22, _int),
+    'outsideRth': (25, 23, _bool),
+    'goodTillDate': (34, 31, _str),
+    'parentId': (56, None, _int),
+}
+_FA_PROFILE_AT = (33, 30) # fields from here on follow the faProfile, if sent
+
+# Fields after the variable length sections, the whole message is walked up to them
+_OPEN_ORDER_TAIL = frozenset(['commission', 'warningText'])
+_COMPLETED_ORDER_TAIL = frozenset(['filledQuantity', 'parentPermId', 'completedTime', 'completedStatus'])
+
+SLIM_FIELDS = tuple(_FIXED_FIELDS) + ('status',) + tuple(sorted(_OPEN_ORDER_TAIL | _COMPLETED_ORDER_TAIL))
+DEFAULT_FIELDS = ('orderId', 'permId', 'clientId', 'parentId', 'conId', 'symbol', 'secType', 'exchange', 'currency',
+                  'action', 'totalQuantity', 'orderType', 'lmtPrice', 'auxPrice', 'account', 'status', 'warningText',
+                  'filledQuantity')
+
+# Fields of each order condition type, after the type itself
+_CONDITION_FIELDS = {
+    OrderCondition.Price: 6,
+    OrderCondition.Time: 3,
+    OrderCondition.Margin: 3,
+    OrderCondition.Execution: 4,
+    OrderCondition.Volume: 5,
+    OrderCondition.PercentChange: 5,
+}
+
+
+class SlimOrder:
+    """
+    The fields of an open or completed order an application usually needs,
+    named as in `Contract`, `Order` and `OrderState`, so one record can stand
+    in for all three. Fields that were not decoded keep their defaults.
+    """
+    __slots__ = SLIM_FIELDS
+
+    def __init__(self):
+        self.orderId = 0
+        self.conId = 0
+        self.symbol = ''
+        self.secType = ''
+        self.lastTradeDateOrContractMonth = ''
+        self.strike = 0.0
+        self.right = ''
+        self.multiplier = ''
+        self.exchange = ''
+        self.currency = ''
+        self.localSymbol = ''
+        self.tradingClass = ''
+        self.action = ''
+        self.totalQuantity = 0.0
+        self.orderType = ''
+        self.lmtPrice = UNSET_DOUBLE
+        self.auxPrice = UNSET_DOUBLE
+        self.tif = ''
+        self.ocaGroup = ''
+        self.account = ''
+        self.orderRef = ''
+        self.clientId = 0
+        self.permId = 0
+        self.outsideRth = False
+        self.goodTillDate = ''
+        self.parentId = 0
+        self.status = ''
+        self.commission = UNSET_DOUBLE
+        self.warningText = ''
+        self.filledQuantity = 0.0
+        self.parentPermId = 0
+        self.completedTime = ''
+        self.completedStatus = ''
+
+    def __repr__(self) -> str:
+        return (f"SlimOrder(orderId={self.orderId}, permId={self.permId}, conId={self.conId}, symbol={self.symbol}, "
+                f"action={self.action}, totalQuantity={self.totalQuantity}, orderType={self.orderType}, "
+                f"lmtPrice={self.lmtPrice}, status={self.status})")
+
+
+class SlimOrderDecoder(Decoder):
+    """
+    `Decoder` that decodes `openOrder` and `completedOrder` messages into a
+    `SlimOrder` with only the declared `fields` (see `SLIM_FIELDS`), instead
+    of running the whole `OrderDecoder` over 100+ `Order`, `Contract` and
+    `OrderState` attributes. Fixed position fields are read by offset, the
+    variable length sections (combo legs, algo params, conditions...) are
+    stepped over by their counts without decoding them.
+
+    The handler's `openOrder(orderId, contract, order, orderState)` and
+    `completedOrder(contract, order, orderState)` get the same record as
+    contract, order and order state. Quantities are floats rather than
+    `Decimal`. Servers older than order containers (145) send the order
+    version and more optional fields, those are decoded as usual.
+    """
+
+    def __init__(self, wrapper, serverVersion, fields: Iterable[str] = DEFAULT_FIELDS):
+        super().__init__(wrapper, serverVersion)
+        fields = set(fields)
+        unknown = fields - set(SLIM_FIELDS)
+        assert not unknown, f"unsupported fields {sorted(unknown)}, see SLIM_FIELDS"
+        self.fields = fields
+        fa_profile = 1 if serverVersion < MIN_SERVER_VER_FA_PROFILE_DESUPPORT else 0
+        self._open_fixed = _offsets(fields, 0, fa_profile)
+        self._completed_fixed = _offsets(fields, 1, fa_profile)
+        self._fa_profile = fa_profile
+        self._open_tail = bool(fields & _OPEN_ORDER_TAIL)
+        self._completed_tail = bool(fields & _COMPLETED_ORDER_TAIL)
+        self._slim = serverVersion >= MIN_SERVER_VER_ORDER_CONTAINER
+
+    def processOpenOrder(self, fields):
+        if not self._slim:
+            return super().processOpenOrder(fields)
+        next(fields)
+        f = tuple(fields)
+        order = SlimOrder()
+        try:
+            for name, i, conv in self._open_fixed:
+                setattr(order, name, conv(f[i]))
+            i = 62 + self._fa_profile
+            if f[i - 2]: # deltaNeutralOrderType
+                i += 8
+            i = self._skip_sections(f, i + 2, basis_points=True, opt_out=True)
+            order.status = _str(f[i + 1]) # after whatIf
+            if self._open_tail:
+                i += 2 + 6 + 3 # whatIf, status, margin fields before and after
+                order.commission = _price(f[i])
+                order.warningText = _str(f[i + 4])
+        except (IndexError, ValueError) as e:
+            raise BadMessage(f"openOrder: {e}")
+        self.wrapper.openOrder(order.orderId, order, order, order)
+
+    def processCompletedOrderMsg(self, fields):
+        if not self._slim:
+            return super().processCompletedOrderMsg(fields)
+        next(fields)
+        f = tuple(fields)
+        order = SlimOrder()
+        try:
+            for name, i, conv in self._completed_fixed:
+                setattr(order, name, conv(f[i]))
+            i = 53 + self._fa_profile
+            if f[i - 2]: # deltaNeutralOrderType
+                i += 4
+            i = self._skip_sections(f, i + 2, basis_points=False, opt_out=False)
+            order.status = _str(f[i])
+            if self._completed_tail:
+                i += 3 # randomize flags
+                if isPegBenchOrder(_str(f[_FIXED_FIELDS['orderType'][1]])):
+                    i += 5
+                count = _int(f[i])
+                i += 1
+                for _ in range(count):
+                    cond_type = _int(f[i])
+                    if cond_type not in _CONDITION_FIELDS:
+                        raise BadMessage(f"completedOrder: unknown condition type {cond_type}")
+                    i += 1 + _CONDITION_FIELDS[cond_type]
+                if count > 0:
+                    i += 2 # conditionsIgnoreRth, conditionsCancelOrder
+                i += 6 # trailStopPrice, lmtPriceOffset, cashQty, dontUseAutoPriceForHedge, isOmsContainer, autoCancelDate
+                order.filledQuantity = _float(f[i])
+                order.parentPermId = _int(f[i + 6])
+                order.completedTime = _str(f[i + 7])
+                order.completedStatus = _str(f[i + 8])
+        except (IndexError, ValueError) as e:
+            raise BadMessage(f"completedOrder: {e}")
+        self.wrapper.completedOrder(order, order, order)
+
+    msgId2handleInfo = {
+        **Decoder.msgId2handleInfo,
+        IN.OPEN_ORDER: HandleInfo(proc=processOpenOrder),
+        IN.COMPLETED_ORDER: HandleInfo(proc=processCompletedOrderMsg),
+    }
+
+    ##
+    # Internals
+    ##
+
+    @staticmethod
+    def _skip_sections(f: tuple, i: int, basis_points: bool, opt_out: bool) -> int:
+        '''
+        Steps from the trail params over to the solicited flag, returns the
+        index after it.
+        '''
+        i += 2 # trailStopPrice, trailingPercent
+        if basis_points:
+            i += 2
+        i += 1 # comboLegsDescrip
+        i += 1 + 8 * max(_int(f[i]), 0) # combo legs
+        i += 1 + max(_int(f[i]), 0) # order combo leg prices
+        i += 1 + 2 * max(_int(f[i]), 0) # smart combo routing params
+        i += 2 # scaleInitLevelSize, scaleSubsLevelSize
+        increment = f[i]
+        i += 1
+        if increment and float(increment) > 0.0:
+            i += 7
+        hedge_type = f[i]
+        i += 2 if hedge_type else 1
+        if opt_out:
+            i += 1
+        i += 3 # clearingAccount, clearingIntent, notHeld
+        i += 4 if _bool(f[i]) else 1 # delta neutral contract
+        algo = f[i]
+        i += 1
+        if algo:
+            i += 1 + 2 * max(_int(f[i]), 0)
+        return i + 1 # solicited
+
+
+class SlimOrderClient(EClient):
+    """
+    `EClient` decoding open and completed orders with a `SlimOrderDecoder`,
+    for use as `TwsApp.client_factory`:
+
+    ```
+    app = TwsApp(message_handler=handler,
+                 client_factory=lambda wrapper: SlimOrderClient(wrapper, fields=DEFAULT_FIELDS + ('orderRef',)))
+    ```
+    """
+
+    def __init__(self, wrapper, fields: Iterable[str] = DEFAULT_FIELDS):
+        super().__init__(wrapper)
+        self.fields = tuple(fields)
+
+    def connect(self, host, port, clientId):
+        super().connect(host, port, clientId)
+        if self.decoder is not None:
+            self.decoder = SlimOrderDecoder(self.wrapper, self.serverVersion(), self.fields)
+
+
+def _offsets(fields: set[str], which: int, fa_profile: int) -> list[tuple[str, int, Callable[[bytes], object]]]:
+    offsets = []
+    for name, spec in _FIXED_FIELDS.items():
+        i = spec[which]
+        if name not in fields or i is None:
+            continue
+        if i >= _FA_PROFILE_AT[which]:
+            i += fa_profile
+        offsets.append((name, i, spec[2]))
+    return offsets
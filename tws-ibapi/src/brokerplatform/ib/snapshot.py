@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from ibapi.ticktype import TickTypeEnum
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FIELDS = ['bid', 'ask', 'last', 'bid_size', 'ask_size', 'last_size',
+                   'open', 'high', 'low', 'close', 'volume', 'last_time', 'halted', 'updated']
+# All float64, so a row can also be addressed by column number
+SNAPSHOT_DTYPE = np.dtype([(name, '<f8') for name in SNAPSHOT_FIELDS])
+
+# Tick type -> field, delayed ticks land in the same fields as live ones
+_TICK_FIELDS = {
+    TickTypeEnum.BID: 'bid',
+    TickTypeEnum.ASK: 'ask',
+    TickTypeEnum.LAST: 'last',
+    TickTypeEnum.BID_SIZE: 'bid_size',
+    TickTypeEnum.ASK_SIZE: 'ask_size',
+    TickTypeEnum.LAST_SIZE: 'last_size',
+    TickTypeEnum.OPEN: 'open',
+    TickTypeEnum.HIGH: 'high',
+    TickTypeEnum.LOW: 'low',
+    TickTypeEnum.CLOSE: 'close',
+    TickTypeEnum.VOLUME: 'volume',
+    TickTypeEnum.LAST_TIMESTAMP: 'last_time',
+    TickTypeEnum.HALTED: 'halted',
+    TickTypeEnum.DELAYED_BID: 'bid',
+    TickTypeEnum.DELAYED_ASK: 'ask',
+    TickTypeEnum.DELAYED_LAST: 'last',
+    TickTypeEnum.DELAYED_BID_SIZE: 'bid_size',
+    TickTypeEnum.DELAYED_ASK_SIZE: 'ask_size',
+    TickTypeEnum.DELAYED_LAST_SIZE: 'last_size',
+    TickTypeEnum.DELAYED_OPEN: 'open',
+    TickTypeEnum.DELAYED_HIGH: 'high',
+    TickTypeEnum.DELAYED_LOW: 'low',
+    TickTypeEnum.DELAYED_CLOSE: 'close',
+    TickTypeEnum.DELAYED_VOLUME: 'volume',
+    TickTypeEnum.DELAYED_LAST_TIMESTAMP: 'last_time',
+    TickTypeEnum.DELAYED_HALTED: 'halted',
+}
+_TICK_COLUMNS = {tick: SNAPSHOT_FIELDS.index(name) for tick, name in _TICK_FIELDS.items()}
+_UPDATED = SNAPSHOT_FIELDS.index('updated')
+
+
+class MarketSnapshots:
+    """
+    Latest market data per `reqMktData` subscription, in a preallocated NumPy
+    record array (see `SNAPSHOT_DTYPE`) with one row per reqId.
+
+    The wrapper thread updates rows in place. Each row has a sequence number
+    used as a seqlock: it is odd while the row is being written, so readers on
+    other threads retry instead of taking a lock, and never stall the thread
+    decoding messages.
+
+    ```
+    snapshots = MarketSnapshots(capacity=500)
+
+    class Handler(EWrapper):
+        def tickPrice(self, reqId, tickType, price, attrib):
+            snapshots.tickPrice(reqId, tickType, price, attrib)
+        def tickSize(self, reqId, tickType, size):
+            snapshots.tickSize(reqId, tickType, size)
+        def tickString(self, reqId, tickType, value):
+            snapshots.tickString(reqId, tickType, value)
+        def tickGeneric(self, reqId, tickType, value):
+            snapshots.tickGeneric(reqId, tickType, value)
+
+    req_id = app.nextId
+    snapshots.add(req_id)
+    app.client.reqMktData(req_id, contract, '', False, False, [])
+    ...
+    row = snapshots.get(req_id) # from any thread
+    row['bid'], row['ask']
+    ```
+    """
+
+    def __init__(self, capacity: int = 1000):
+        assert capacity > 0, "capacity must be greater than 0"
+        self.capacity = capacity
+        self._data = np.full(capacity, np.nan, dtype=SNAPSHOT_DTYPE)
+        # Same memory, addressed as [row, column]
+        self._values = self._data.view(np.float64).reshape(capacity, len(SNAPSHOT_FIELDS))
+        self._seq = np.zeros(capacity, dtype=np.int64)
+        self._rows: dict[int, int] = {}
+        self._free = list(range(capacity - 1, -1, -1))
+        # Only guards adding and removing rows, never taken on updates or reads
+        self._lock = threading.Lock()
+
+    def add(self, reqId: int) -> int:
+        '''Assigns a row to a subscription, call before requesting market data.'''
+        with self._lock:
+            if reqId in self._rows:
+                return self._rows[reqId]
+            if not self._free:
+                raise OverflowError(f"All {self.capacity} snapshot rows are in use")
+            row = self._free.pop()
+            self._reset_row(row)
+            self._rows[reqId] = row
+            return row
+
+    def remove(self, reqId: int):
+        with self._lock:
+            row = self._rows.pop(reqId, None)
+            if row is not None:
+                self._free.append(row)
+
+    def row(self, reqId: int) -> int | None:
+        return self._rows.get(reqId)
+
+    def get(self, reqId: int) -> np.void | None:
+        '''Consistent copy of a subscription's row, or None if unknown.'''
+        row = self._rows.get(reqId)
+        if row is None:
+            return None
+        seq = self._seq
+        while True:
+            s = seq[row]
+            if s & 1:
+                continue # write in progress
+            snap = self._data[row].copy()
+            if seq[row] == s:
+                return snap
+
+    def get_many(self, reqIds) -> np.ndarray:
+        '''Consistent copies of several rows, as a `SNAPSHOT_DTYPE` array (NaN rows for unknown reqIds).'''
+        rows = np.array([self._rows.get(r, -1) for r in reqIds], dtype=np.int64)
+        known = rows >= 0
+        out = np.full(len(rows), np.nan, dtype=SNAPSHOT_DTYPE)
+        rows = rows[known]
+        while True:
+            s = self._seq[rows]
+            if (s & 1).any():
+                continue
+            snap = self._data[rows]
+            if (self._seq[rows] == s).all():
+                out[known] = snap
+                return out
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def tickPrice(self, reqId: int, tickType: int, price: float, attrib):
+        self._update(reqId, tickType, price)
+
+    def tickSize(self, reqId: int, tickType: int, size):
+        self._update(reqId, tickType, float(size))
+
+    def tickString(self, reqId: int, tickType: int, value: str):
+        if tickType in (TickTypeEnum.LAST_TIMESTAMP, TickTypeEnum.DELAYED_LAST_TIMESTAMP):
+            try:
+                t = float(value) if value else np.nan
+            except ValueError:
+                log.warning(f"Bad timestamp tick: reqId={reqId}|tickType={tickType}|value={value}")
+                t = np.nan
+            self._update(reqId, tickType, t)
+
+    def tickGeneric(self, reqId: int, tickType: int, value: float):
+        self._update(reqId, tickType, value)
+
+    ##
+    # Internals
+    ##
+
+    def _update(self, reqId: int, tickType: int, value: float):
+        row = self._rows.get(reqId)
+        col = _TICK_COLUMNS.get(tickType)
+        if row is None or col is None:
+            return
+        seq = self._seq
+        seq[row] += 1
+        self._values[row, col] = value
+        self._values[row, _UPDATED] = time.time()
+        seq[row] += 1
+
+    def _reset_row(self, row: int):
+        self._seq[row] += 1
+        self._values[row] = np.nan
+        self._seq[row] += 1
@@ -0,0 +1,349 @@
+import datetime as dt
+import logging
+import threading
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from ibapi.client import EClient
+from ibapi.contract import Contract
+from ibapi.decoder import Decoder, HandleInfo
+from ibapi.message import IN
+from ibapi.utils import BadMessage, decode
+
+from brokerplatform.ib.backfill import UTC_FORMAT
+from brokerplatform.ib.history import utc
+from brokerplatform.ib.pacing import TICKS, HistoricalDataScheduler, HistoricalJob
+
+log = logging.getLogger(__name__)
+
+# One row per tick, `time` in epoch seconds and `mask` as sent (the bits of
+# `TickAttribBidAsk`/`TickAttribLast`), exchange and special conditions as
+# `Interner` codes.
+MIDPOINT_TICK_DTYPE = np.dtype([('time', '<i8'), ('price', '<f8'), ('size', '<f8')])
+BID_ASK_TICK_DTYPE = np.dtype([('time', '<i8'), ('mask', 'u1'), ('priceBid', '<f8'), ('priceAsk', '<f8'),
+                               ('sizeBid', '<f8'), ('sizeAsk', '<f8')])
+LAST_TICK_DTYPE = np.dtype([('time', '<i8'), ('mask', 'u1'), ('price', '<f8'), ('size', '<f8'),
+                            ('exchange', '<i4'), ('specialConditions', '<i4')])
+TICK_DTYPES = {'MIDPOINT': MIDPOINT_TICK_DTYPE, 'BID_ASK': BID_ASK_TICK_DTYPE, 'TRADES': LAST_TICK_DTYPE}
+
+# Most ticks IB returns per reqHistoricalTicks
+MAX_TICKS_PER_REQUEST = 1000
+
+FORWARD, BACKWARD = 'forward', 'backward'
+
+
+class Interner:
+    '''Maps strings to small integer codes, in order of first appearance.'''
+
+    def __init__(self):
+        self.values: list[str] = []
+        self._codes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = self._codes[value] = len(self.values)
+                    self.values.append(value)
+        return code
+
+    def get(self, value: str) -> int | None:
+        '''The code of a value, None if not interned yet.'''
+        return self._codes.get(value)
+
+    def codes(self, values: np.ndarray) -> np.ndarray:
+        '''Codes of an array of strings (or bytes), interning each distinct value once.'''
+        uniques, inverse = np.unique(values, return_inverse=True)
+        lookup = np.array([self.code(u.decode() if isinstance(u, bytes) else str(u)) for u in uniques], dtype=np.int32)
+        return lookup[inverse]
+
+    def categorical(self, codes: np.ndarray) -> pd.Categorical:
+        return pd.Categorical.from_codes(codes, categories=list(self.values))
+
+
+# Shared by default, so codes mean the same across clients and reconnects
+EXCHANGES = Interner()
+SPECIAL_CONDITIONS = Interner()
+
+
+def as_tick_array(ticks, what_to_show: str) -> np.ndarray:
+    '''
+    Converts the `HistoricalTick*` lists of the standard decoder to the array
+    layout, arrays are returned as they are.
+    '''
+    if isinstance(ticks, np.ndarray):
+        return ticks
+    dtype = TICK_DTYPES[what_to_show]
+    if dtype is MIDPOINT_TICK_DTYPE:
+        rows = [(t.time, t.price, float(t.size)) for t in ticks]
+    elif dtype is BID_ASK_TICK_DTYPE:
+        rows = [(t.time, t.tickAttribBidAsk.askPastHigh | t.tickAttribBidAsk.bidPastLow << 1,
+                 t.priceBid, t.priceAsk, float(t.sizeBid), float(t.sizeAsk)) for t in ticks]
+    else:
+        rows = [(t.time, t.tickAttribLast.pastLimit | t.tickAttribLast.unreported << 1, t.price, float(t.size),
+                 EXCHANGES.code(t.exchange), SPECIAL_CONDITIONS.code(t.specialConditions)) for t in ticks]
+    return np.array(rows, dtype=dtype)
+
+
+def _columns(fields, count: int, width: int) -> np.ndarray:
+    '''The next `count` ticks of `width` fields each, as a (count, width) bytes array.'''
+    flat = list(islice(fields, count * width))
+    if len(flat) != count * width:
+        raise BadMessage("no more fields")
+    return np.array(flat, dtype=bytes).reshape(count, width)
+
+
+class TickArrayDecoder(Decoder):
+    """
+    `Decoder` that decodes each page of historical ticks straight into a
+    NumPy structured array (`MIDPOINT_TICK_DTYPE`, `BID_ASK_TICK_DTYPE`,
+    `LAST_TICK_DTYPE`), column by column, instead of a `HistoricalTick*`
+    object plus a `TickAttrib*` object per tick. The handler's
+    `historicalTicks`, `historicalTicksBidAsk` and `historicalTicksLast` get
+    the array in place of the list. Every other message is decoded as usual.
+    """
+
+    def __init__(self, wrapper, serverVersion, exchanges: Interner = EXCHANGES,
+                 special_conditions: Interner = SPECIAL_CONDITIONS):
+        super().__init__(wrapper, serverVersion)
+        self.exchanges = exchanges
+        self.special_conditions = special_conditions
+
+    def processHistoricalTicks(self, fields):
+        next(fields)
+        reqId = decode(int, fields)
+        count = decode(int, fields)
+        cols = _columns(fields, count, 4) # time, unused, price, size
+        ticks = np.empty(count, dtype=MIDPOINT_TICK_DTYPE)
+        ticks['time'] = cols[:, 0].astype(np.int64)
+        ticks['price'] = cols[:, 2].astype(np.float64)
+        ticks['size'] = cols[:, 3].astype(np.float64)
+        done = decode(bool, fields)
+        self.wrapper.historicalTicks(reqId, ticks, done)
+
+    def processHistoricalTicksBidAsk(self, fields):
+        next(fields)
+        reqId = decode(int, fields)
+        count = decode(int, fields)
+        cols = _columns(fields, count, 6)
+        ticks = np.empty(count, dtype=BID_ASK_TICK_DTYPE)
+        for i, name in enumerate(BID_ASK_TICK_DTYPE.names):
+            ticks[name] = cols[:, i].astype(BID_ASK_TICK_DTYPE[name])
+        done = decode(bool, fields)
+        self.wrapper.historicalTicksBidAsk(reqId, ticks, done)
+
+    def processHistoricalTicksLast(self, fields):
+        next(fields)
+        reqId = decode(int, fields)
+        count = decode(int, fields)
+        cols = _columns(fields, count, 6) # time, mask, price, size, exchange, specialConditions
+        ticks = np.empty(count, dtype=LAST_TICK_DTYPE)
+        ticks['time'] = cols[:, 0].astype(np.int64)
+        ticks['mask'] = cols[:, 1].astype(np.uint8)
+        ticks['price'] = cols[:, 2].astype(np.float64)
+        ticks['size'] = cols[:, 3].astype(np.float64)
+        ticks['exchange'] = self.exchanges.codes(cols[:, 4])
+        ticks['specialConditions'] = self.special_conditions.codes(cols[:, 5])
+        done = decode(bool, fields)
+        self.wrapper.historicalTicksLast(reqId, ticks, done)
+
+    msgId2handleInfo = {
+        **Decoder.msgId2handleInfo,
+        IN.HISTORICAL_TICKS: HandleInfo(proc=processHistoricalTicks),
+        IN.HISTORICAL_TICKS_BID_ASK: HandleInfo(proc=processHistoricalTicksBidAsk),
+        IN.HISTORICAL_TICKS_LAST: HandleInfo(proc=processHistoricalTicksLast),
+    }
+
+
+class TickArrayClient(EClient):
+    """
+    `EClient` decoding historical ticks with a `TickArrayDecoder`, for use as
+    `TwsApp.client_factory`:
+
+    ```
+    app = TwsApp(message_handler=handler, client_factory=TickArrayClient)
+    ```
+    """
+
+    def __init__(self, wrapper, exchanges: Interner = EXCHANGES, special_conditions: Interner = SPECIAL_CONDITIONS):
+        super().__init__(wrapper)
+        self.exchanges = exchanges
+        self.special_conditions = special_conditions
+
+    def connect(self, host, port, clientId):
+        super().connect(host, port, clientId)
+        if self.decoder is not None:
+            self.decoder = TickArrayDecoder(self.wrapper, self.serverVersion(), self.exchanges, self.special_conditions)
+
+
+class HistoricalTicksPager:
+    """
+    Pulls all the historical ticks between `start` and `end` (a trading day,
+    say) in pages of `MAX_TICKS_PER_REQUEST`, walking `endDateTime` back from
+    `end` (BACKWARD) or `startDateTime` on from `start` (FORWARD). Each page is
+    requested through the `HistoricalDataScheduler` once the previous one
+    has arrived, ticks of the boundary second already received are dropped.
+
+    Pages are kept as tick arrays, see `TICK_DTYPES`; use a `TickArrayClient`
+    so they are decoded as arrays in the first place, lists of tick objects
+    are converted.
+
+    ```
+    class Handler(EWrapper):
+        def historicalTicksLast(self, reqId, ticks, done):
+            pager.historicalTicksLast(reqId, ticks, done)
+            scheduler.historicalTicksLast(reqId, ticks, done)
+        def error(self, reqId, errorCode, errorString, advancedOrderRejectJson=""):
+            scheduler.error(reqId, errorCode, errorString, advancedOrderRejectJson)
+
+    app = TwsApp(message_handler=Handler(), client_factory=TickArrayClient)
+    pager = HistoricalTicksPager(scheduler, contract, start=dt.datetime(2024, 6, 3, 22),
+                                 end=dt.datetime(2024, 6, 4, 21), what_to_show='TRADES')
+    df = pager.run()
+    ```
+    """
+
+    def __init__(self, scheduler: HistoricalDataScheduler, contract: Contract, start: dt.datetime, end: dt.datetime,
+                 what_to_show: str = 'TRADES', use_rth: bool = False, direction: str = BACKWARD, tz=dt.UTC,
+                 ignore_size: bool = False):
+        assert what_to_show in TICK_DTYPES, f"what_to_show must be one of {list(TICK_DTYPES)}"
+        assert direction in (FORWARD, BACKWARD), f"direction must be '{FORWARD}' or '{BACKWARD}'"
+        self.scheduler = scheduler
+        self.contract = contract
+        self.start_time = utc(start)
+        self.end_time = utc(end)
+        assert self.start_time < self.end_time, "start must be before end"
+        self.what_to_show = what_to_show
+        self.use_rth = use_rth
+        self.direction = direction
+        self.tz = tz
+        self.ignore_size = ignore_size
+        self.pages = 0
+        self.failed: tuple[int, str] | None = None
+        self._dtype = TICK_DTYPES[what_to_show]
+        self._received: dict[int, list[np.ndarray]] = {}
+        self._chunks: list[np.ndarray] = []
+        # Time of the furthest tick held, and how many ticks of that second are held
+        self._edge: int | None = None
+        self._edge_count = 0
+        self._done = threading.Event()
+
+    def start(self):
+        self._request(self.end_time if self.direction == BACKWARD else self.start_time)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def run(self, timeout: float | None = None) -> pd.DataFrame:
+        self.start()
+        if not self.wait(timeout):
+            raise TimeoutError(f"Historical ticks for {self.contract.symbol} did not complete within {timeout}s")
+        return self.frame()
+
+    def ticks(self) -> np.ndarray:
+        '''The ticks received, in time order and trimmed to [start, end).'''
+        chunks = self._chunks[::-1] if self.direction == BACKWARD else self._chunks
+        ticks = np.concatenate([np.empty(0, dtype=self._dtype)] + chunks)
+        t = ticks['time']
+        return ticks[(t >= int(self.start_time.timestamp())) & (t < int(self.end_time.timestamp()))]
+
+    def frame(self) -> pd.DataFrame:
+        '''The ticks as a DataFrame indexed by time in `tz`, exchanges and conditions as categoricals.'''
+        ticks = self.ticks()
+        idx = pd.to_datetime(ticks['time'], unit='s', utc=True).tz_convert(self.tz)
+        columns = {}
+        for name in self._dtype.names[1:]:
+            if name == 'exchange':
+                columns[name] = EXCHANGES.categorical(ticks[name])
+            elif name == 'specialConditions':
+                columns[name] = SPECIAL_CONDITIONS.categorical(ticks[name])
+            else:
+                columns[name] = ticks[name]
+        return pd.DataFrame(columns, index=idx)
+
+    ##
+    # EWrapper callbacks, to be forwarded from the message handler.
+    ##
+
+    def historicalTicks(self, reqId: int, ticks, done: bool):
+        self._receive(reqId, ticks)
+
+    def historicalTicksBidAsk(self, reqId: int, ticks, done: bool):
+        self._receive(reqId, ticks)
+
+    def historicalTicksLast(self, reqId: int, ticks, done: bool):
+        self._receive(reqId, ticks)
+
+    ##
+    # Internals
+    ##
+
+    def _receive(self, reqId: int, ticks):
+        job = self.scheduler.job(reqId)
+        if job is None or job.tag is not self:
+            return
+        self._received.setdefault(reqId, []).append(as_tick_array(ticks, self.what_to_show))
+
+    def _request(self, at: dt.datetime):
+        backward = self.direction == BACKWARD
+        self.scheduler.submit(HistoricalJob(TICKS, self.contract, dict(
+            startDateTime='' if backward else at.strftime(UTC_FORMAT),
+            endDateTime=at.strftime(UTC_FORMAT) if backward else '',
+            numberOfTicks=MAX_TICKS_PER_REQUEST,
+            whatToShow=self.what_to_show,
+            useRth=int(self.use_rth),
+            ignoreSize=self.ignore_size,
+            miscOptions=[],
+        ), on_done=self._on_done, on_error=self._on_error, tag=self))
+
+    def _on_done(self, job: HistoricalJob):
+        page = np.concatenate([np.empty(0, dtype=self._dtype)] + self._received.pop(job.req_id, []))
+        self.pages += 1
+        if len(page) == 0:
+            self._finish()
+            return
+        backward = self.direction == BACKWARD
+        t = page['time']
+        if self._edge is not None and self._edge_count:
+            # The page starts (ends, going backward) with the boundary second again
+            at_edge = np.flatnonzero(t == self._edge)
+            drop = at_edge[-self._edge_count:] if backward else at_edge[:self._edge_count]
+            page = np.delete(page, drop)
+            t = page['time']
+        if len(page) == 0:
+            # More ticks in the boundary second than a page holds, move past it
+            log.warning(f"Historical ticks for {self.contract.symbol}: stepping over second {self._edge}, "
+                        f"its ticks may be incomplete")
+            self._edge += -1 if backward else 1
+            self._edge_count = 0
+        else:
+            edge = int(t[0] if backward else t[-1])
+            count = int(np.count_nonzero(t == edge))
+            self._edge_count = count + self._edge_count if edge == self._edge else count
+            self._edge = edge
+            self._chunks.append(page)
+        log.debug(f"Historical ticks for {self.contract.symbol}: page {self.pages}|ticks={len(page)}|edge={self._edge}")
+        at = dt.datetime.fromtimestamp(self._edge, dt.UTC)
+        if (at < self.start_time) if backward else (at >= self.end_time):
+            self._finish()
+        else:
+            self._request(at)
+
+    def _on_error(self, job: HistoricalJob, errorCode: int, errorString: str):
+        self._received.pop(job.req_id, None)
+        if 'no data' not in errorString.lower():
+            log.warning(f"Historical ticks for {self.contract.symbol} failed: {errorCode}|{errorString}")
+            self.failed = (errorCode, errorString)
+        self._finish()
+
+    def _finish(self):
+        log.info(f"Historical ticks for {self.contract.symbol}: {sum(len(c) for c in self._chunks)} ticks "
+                 f"in {self.pages} pages")
+        self._done.set()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# brokerplatform is used from the source tree, not installed
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+from ibapi.contract import Contract
+from ibapi.order import Order
+from ibapi.order_state import OrderState
+
+from brokerplatform.ib.orders import FILLED, SUBMITTED, OrderManager
+
+
+class FakeClient:
+    def __init__(self):
+        self.placed = []
+
+    def placeOrder(self, orderId, contract, order):
+        self.placed.append(orderId)
+
+
+def _order_state(status: str) -> OrderState:
+    state = OrderState()
+    state.status = status
+    return state
+
+
+def test_unqualified_contract_is_reindexed_under_its_conid():
+    orders = OrderManager(SimpleNamespace(client=FakeClient()))
+    orders.nextValidId(1)
+
+    contract = Contract()
+    contract.symbol, contract.secType, contract.exchange, contract.currency = 'AAPL', 'STK', 'SMART', 'USD'
+    order = Order()
+    order.action, order.orderType, order.totalQuantity, order.lmtPrice = 'BUY', 'LMT', 10, 100.0
+    order_id = orders.place(contract, order)
+    assert [r.orderId for r in orders.open_orders(0)] == [order_id]
+
+    # TWS sends the qualified contract back
+    qualified = Contract()
+    qualified.conId, qualified.symbol, qualified.secType = 265598, 'AAPL', 'STK'
+    order.permId = 123
+    orders.openOrder(order_id, qualified, order, _order_state(SUBMITTED))
+    assert orders.open_orders(0) == []
+    assert [r.orderId for r in orders.open_orders(265598)] == [order_id]
+    assert [r.orderId for r in orders.open_orders()] == [order_id]
+
+    orders.orderStatus(order_id, FILLED, 10, 0, 100.0, 123, 0, 100.0, 0, '', 0.0)
+    assert orders.get(order_id).status == FILLED
+    assert orders.open_orders() == []
+    assert orders.open_orders(265598) == []